@@ -0,0 +1,249 @@
+from .expectation_maximization import ExpectationMaximization
+from .embody import _em_step_body
+from scipy.sparse.csgraph import connected_components
+from scipy.stats import norm
+import numpy as np
+import os
+
+
+def _em_blocks_shared(arrays, start, stop, blocks, num_ord, fit, threshold, max_iter, num_ord_updates, sigma_dtype, weighted=False, targets=None):
+    """
+    Runs the blocks start:stop of a block diagonal copula on their columns of the latent arrays Z, r_lower and r_upper,
+    held in shared memory by a SharedMemoryPool (or in a plain dict). If fit, the correlation of each block is estimated by standard EM
+    starting from its block of sigma; otherwise a single E-step is run with it.
+    The updated latent values and the imputed latent values are written into the columns of the block in Z and Z_imp.
+
+    Args:
+        blocks (list): the latent column indices of each block, sorted, so that the ordinals of a block come first
+        num_ord (int): the number of ordinal columns of the latent arrays
+        fit (bool): whether to estimate the correlation of the blocks
+        weighted (bool): whether the rows are weighted by the array weights when fitting
+        targets (array or None): boolean, true at the latent columns to impute, see _em_step_body
+    Returns:
+        sigmas (list): the correlation of each block
+    """
+    em = ExpectationMaximization(sigma_dtype=sigma_dtype)
+    weights = arrays['weights'] if weighted else None
+    sigmas = []
+    for b in range(start, stop):
+        cols = blocks[b]
+        ord_cols = cols[cols < num_ord]
+        Z = arrays['Z'][:, cols]
+        r_lower = arrays['r_lower'][:, ord_cols]
+        r_upper = arrays['r_upper'][:, ord_cols]
+        em.sigma = arrays['sigma'][np.ix_(cols, cols)]
+        Z_imp = np.where(np.isnan(Z), 0, Z)
+        if fit:
+            for i in range(max_iter):
+                prev_sigma = em.sigma
+                em.sigma, Z_imp, Z = em._em_step(Z, r_lower, r_upper, 1, num_ord_updates, weights)
+                if em._get_scaled_diff(prev_sigma, em.sigma) < threshold:
+                    break
+        else:
+            block_targets = None if targets is None else targets[cols]
+            _, Z_imp, Z = _em_step_body(Z, r_lower, r_upper, em.sigma, num_ord_updates, targets=block_targets)
+        arrays['Z'][:, cols] = Z
+        arrays['Z_imp'][:, cols] = Z_imp
+        sigmas.append(em.sigma)
+    return sigmas
+
+
+def _default_screen_threshold(n, p, alpha=0.01):
+    """
+    The default screen_threshold: the absolute correlation above which two of p variables are linked, 
+    such that no pair of independent variables is linked with probability about 1 - alpha.
+    Under independence, the sample correlation of n rows is approximately N(0, 1/n), also for the mean imputed latent values
+    (the zeros shrink both the covariance and the variances), so that a pair exceeds z/sqrt(n) with probability 2*(1 - Phi(z)).
+    The threshold is the Bonferroni bound over the p(p-1)/2 pairs, z = Phi^-1(1 - alpha/(p(p-1))). 
+    It decreases as 1/sqrt(n) with no floor, so that weak but real correlations link their variables once n is large enough to detect them.
+    For frequency weighted rows (collapse_duplicates), n counts the duplicates: the correlation is computed with the frequency weights, 
+    and its sampling noise is the one of all the rows.
+
+    Args:
+        n (float): the number of rows
+        p (int): the number of variables
+        alpha (float): the probability that some pair of independent variables is linked
+    Returns:
+        screen_threshold (float): the threshold on the absolute initial latent correlation
+    """
+    num_pairs = max(p*(p - 1)/2, 1)
+    return norm.isf(alpha/(2*num_pairs))/np.sqrt(n)
+
+
+class BlockExpectationMaximization(ExpectationMaximization):
+    '''
+    A Gaussian copula model whose correlation is block diagonal: the variables are split into blocks that are modeled as independent,
+    each with its own correlation estimated by standard EM on the columns of the block. The blocks are fitted in parallel,
+    and each E-step solve scales with the size of a block instead of the number of variables p.
+    The blocks are either provided as groups of columns or found by screening the latent correlation:
+    the blocks are the connected components of the graph linking the variables whose initial latent correlation exceeds screen_threshold in absolute value.
+    By default, screen_threshold is the Bonferroni bound at which all pairs of independent variables stay unlinked 
+    with probability 1 - screen_alpha, of order sqrt(log(p)/n) for n data points, see _default_screen_threshold.
+
+    Attributes
+    ----------
+    blocks: list
+        the column indices of each block, in the original column order.
+    sigma: numpy array
+        numpy array of shape (p, p), the block diagonal copula correlation matrix.
+
+    Methods
+    -------
+    impute_missing:
+        fit a block diagonal Gaussian copula model from incomplete data and then use the fitted model to impute the missing entries.
+    fit:
+        fit a block diagonal Gaussian copula model from incomplete data, without imputing it.
+    transform:
+        impute the missing entries of new data points from the fitted model, without updating the model.
+    '''
+    def __init__(self, var_types=None, max_ord=20, blocks=None, screen_threshold=None, screen_alpha=0.01, dtype=np.float64, sigma_dtype=np.float64):
+        '''
+        blocks is a list of arrays of column indices that partitions the columns of the data.
+        If blocks is None, they are found from the initial latent correlation with screen_threshold. 
+        If screen_threshold is None, it is chosen from the data so that pairs of independent variables are linked 
+        with probability at most about screen_alpha in total, see _default_screen_threshold.
+        '''
+        super().__init__(var_types=var_types, max_ord=max_ord, dtype=dtype, sigma_dtype=sigma_dtype)
+        self.blocks = None if blocks is None else [np.asarray(block) for block in blocks]
+        self.screen_threshold = screen_threshold
+        self.screen_alpha = screen_alpha
+
+    def _fit_covariance(self, X,
+                        threshold=0.01, max_iter=100, max_workers=1, num_ord_updates=1,
+                        batch_size=100, batch_c=0,
+                        verbose=False, seed=1,
+                        active_tol=None, rows=None, weights=None, **kwargs):
+        """
+        Fits the correlation of each block of the copula by standard EM on its columns and returns the imputed latent values of X.
+        Mini-batch and active-set EM are not available for block diagonal copulas.
+
+        Args:
+            X (matrix): data matrix with entries to be imputed
+            threshold (float): the threshold for scaled difference between the covariance estimates of a block at which its EM stops
+            max_iter (int): the maximum number of iterations for each block
+            max_workers (positive int): the maximum number of workers for parallelism, each fitting one block at a time
+            rows (array or None): if provided, only these rows of X are fitted
+            weights (array or None): the number of times each fitted row is counted, such as its number of duplicates in X
+
+        Returns:
+            Z_imp (matrix): estimates of latent values, of the fitted rows
+        """
+        if batch_c > 0 or active_tol is not None:
+            raise ValueError('Mini-batch and active-set EM are not available for block diagonal copulas')
+        self._memory_phase('latent')
+        Z_ord_lower, Z_ord_upper = self.transform_function.get_ord_latent()
+        Z_cont = self.transform_function.get_cont_latent()
+        if rows is not None:
+            Z_ord_lower, Z_ord_upper, Z_cont = Z_ord_lower[rows], Z_ord_upper[rows], Z_cont[rows]
+        rng = np.random.default_rng(seed)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, rng, self._row_chunk_size())
+        # Latent variable matrix with columns sorted as ordinal, continuous
+        Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        # mean impute the missing values for the sake of the initial correlation and of the screening
+        Z_imp = np.where(np.isnan(Z), 0, Z)
+        if weights is None:
+            corr = np.corrcoef(Z_imp, rowvar=False, dtype=Z_imp.dtype)
+        else:
+            cov = np.cov(Z_imp, rowvar=False, fweights=weights, dtype=Z_imp.dtype)
+            std = np.sqrt(np.diag(cov))
+            corr = cov / np.outer(std, std)
+        corr = np.atleast_2d(corr).astype(self.sigma_dtype)
+
+        _order = np.array(self.back_to_original_order())
+        if self.blocks is None:
+            screen_threshold = self.screen_threshold
+            if screen_threshold is None:
+                n = Z.shape[0] if weights is None else np.sum(weights)
+                screen_threshold = _default_screen_threshold(n, Z.shape[1], self.screen_alpha)
+            _, labels = connected_components(np.abs(corr) > screen_threshold, directed=False)
+            latent_to_original = np.argsort(_order)
+            self.blocks = [np.sort(latent_to_original[labels == label]) for label in range(labels.max()+1)]
+        latent_blocks = self._latent_blocks(X.shape[1])
+        if verbose:
+            print(f'Fitting {len(latent_blocks)} blocks, of sizes up to {max(len(cols) for cols in latent_blocks)}')
+        self._memory_phase('em')
+        self.sigma, Z_imp, Z = self._run_blocks(Z, Z_ord_lower, Z_ord_upper, corr, latent_blocks, True,
+                                                threshold, max_iter, max_workers, num_ord_updates, weights)
+        return Z_imp
+
+    def transform(self, X, num_ord_updates=1, max_workers=1, seed=1, target_columns=None):
+        """
+        Imputes the missing entries of new data points X from the fitted model, without updating it, one block at a time.
+        See ExpectationMaximization.transform
+        """
+        targets, latent_targets = self._target_masks(target_columns, X.shape[1])
+        Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, np.random.default_rng(seed))
+        Z_cont = self.transform_function.partial_evaluate_cont_latent(X)
+        Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        _, Z_imp, _ = self._run_blocks(Z, Z_ord_lower, Z_ord_upper, self.sigma, self._latent_blocks(X.shape[1]), False,
+                                       max_workers=max_workers, num_ord_updates=num_ord_updates, targets=latent_targets)
+        # Rearrange Z_imp so that it's columns correspond to the columns of X
+        _order = self.back_to_original_order()
+        Z_imp_rearranged = Z_imp[:,_order]
+        X_imp = np.empty(X.shape)
+        X_imp[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X, targets)
+        X_imp[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X, targets)
+        return X_imp
+
+    def _memory_estimate(self, shape, chunk_size, max_workers, impute=True, batch_size=None):
+        """
+        The planned peak memory of each phase, see ExpectationMaximization._memory_estimate. 
+        The blocks are fitted on all their rows at once, so the E-step is planned without chunks
+        """
+        phases = super()._memory_estimate(shape, chunk_size, max_workers, impute, batch_size)
+        phases['em'] = super()._memory_estimate(shape, shape[0], max_workers, impute, batch_size)['em']
+        return phases
+
+    def _latent_blocks(self, p):
+        """
+        Checks that the blocks partition the p columns and returns their latent column indices (ordinals first), sorted
+        """
+        columns = np.concatenate(self.blocks) if len(self.blocks) > 0 else np.zeros(0, dtype=int)
+        if len(columns) != p or not np.array_equal(np.sort(columns), np.arange(p)):
+            raise ValueError(f'The blocks must partition the {p} columns, each column appearing in exactly one block')
+        _order = np.array(self.back_to_original_order())
+        return [np.sort(_order[block]) for block in self.blocks]
+
+    def _run_blocks(self, Z, r_lower, r_upper, sigma, latent_blocks, fit,
+                    threshold=0.01, max_iter=100, max_workers=1, num_ord_updates=1, weights=None, targets=None):
+        """
+        Runs _em_blocks_shared over the blocks, in the worker pool of the estimator if max_workers is not 1,
+        one block per task with the largest blocks first.
+
+        Returns:
+            sigma (matrix): the block diagonal correlation
+            Z_imp (matrix): estimates of latent values
+            Z (matrix): Updated latent values
+        """
+        n, p = Z.shape
+        num_ord = r_lower.shape[1]
+        if max_workers is None:
+            max_workers = min(32, os.cpu_count()+4)
+        args = (latent_blocks, num_ord, fit, threshold, max_iter, num_ord_updates, self.sigma_dtype, weights is not None, targets)
+        if max_workers == 1:
+            arrays = {'Z': Z, 'r_lower': r_lower, 'r_upper': r_upper, 'sigma': sigma, 'Z_imp': np.empty_like(Z)}
+            if weights is not None:
+                arrays['weights'] = weights
+            block_sigmas = _em_blocks_shared(arrays, 0, len(latent_blocks), *args)
+            Z_imp = arrays['Z_imp']
+        else:
+            pool = self._get_pool(max_workers)
+            pool.put('Z', Z)
+            pool.put('r_lower', r_lower)
+            pool.put('r_upper', r_upper)
+            pool.put('sigma', sigma)
+            if weights is not None:
+                pool.put('weights', weights)
+            pool.empty('Z_imp', Z.shape, Z.dtype)
+            order = sorted(range(len(latent_blocks)), key=lambda b: -len(latent_blocks[b]))
+            results = pool.map(_em_blocks_shared, [(b, b+1) for b in order], *args)
+            block_sigmas = [None] * len(latent_blocks)
+            for b, res in zip(order, results):
+                block_sigmas[b] = res[0]
+            Z[:] = pool.view('Z')
+            Z_imp = np.copy(pool.view('Z_imp'))
+        sigma = np.zeros((p, p), dtype=self.sigma_dtype)
+        for cols, block_sigma in zip(latent_blocks, block_sigmas):
+            sigma[np.ix_(cols, cols)] = block_sigma
+        return sigma, Z_imp, Z
@@ -1,5 +1,11 @@
 import numpy as np
-from scipy.stats import norm, truncnorm
+import warnings
+from scipy.stats import norm
+from scipy.special import log_ndtr
+from scipy.linalg import cho_factor, cho_solve
+from scipy import sparse
+
+_LOG_SQRT_2PI = 0.5 * np.log(2 * np.pi)
 
 def _em_step_body_(args):
     """
@@ -7,26 +13,101 @@ def _em_step_body_(args):
     """
     return _em_step_body(*args)
 
-def _em_step_body(Z, r_lower, r_upper, sigma, num_ord_updates):
+def _em_step_body(Z, r_lower, r_upper, sigma, num_ord_updates, weights=None, targets=None, precision=None):
     """
-    Iterate the rows over provided matrix 
+    Iterate over the missingness patterns of the provided matrix. 
+    Rows sharing the same pattern are updated together by _em_step_body_group.
+    The precision matrix is computed once, so that patterns with few missing entries are conditioned through it.
+    Complete rows are split out before grouping: without ordinals they are left as they are, 
+    and otherwise they form one group whose ordinals are updated through the precision matrix.
+    If weights is provided, the conditional covariance terms of each row are counted weights times, as for duplicated rows.
+    If targets (boolean, over the latent columns) is provided, only the missing entries in these columns are imputed, 
+    the others are left missing and the conditional covariance terms are not computed.
+    If precision is provided, it is used as the inverse of sigma instead of being computed.
+    The latent ordinals of Z are updated in place, and Z is also returned for the callers that pass a copy
     """
     num, p = Z.shape
+    num_ord = r_upper.shape[1]
     Z_imp = np.copy(Z)
     C = np.zeros((p,p))
     trunc_warn = False
-    for i in range(num):
-        c, z_imp, z, warn = _em_step_body_row(Z[i,:], r_lower[i,:], r_upper[i,:], sigma, num_ord_updates)
-        Z_imp[i,:] = z_imp
-        Z[i,:] = z
-        C += c
+    missing = np.isnan(Z)
+    complete = ~missing.any(axis=1)
+    incomplete_rows = np.nonzero(~complete)[0]
+    groups = [incomplete_rows[rows] for rows in _group_by_pattern(missing[incomplete_rows])]
+    if num_ord > 0 and complete.any():
+        groups.insert(0, np.nonzero(complete)[0])
+    if precision is None and any(2*missing[rows[0]].sum() < p for rows in groups):
+        precision = _precision(sigma)
+    for rows in groups:
+        group_weights = None if weights is None else weights[rows]
+        _, z_imp, z, warn = _em_step_body_group(Z[rows], r_lower[rows], r_upper[rows], sigma, num_ord_updates, precision, C, group_weights, targets)
+        Z_imp[rows] = z_imp
+        Z[rows] = z
         trunc_warn = trunc_warn or warn
-    # TO DO: no need to return Z, just edit it during the process
     if trunc_warn:
-        print('Bad truncated normal stats appear, suggesting the existence of outliers. We skipped the outliers now. More numerically stable version to come...')
+        warnings.warn('Bad truncated normal stats appear, suggesting the existence of outliers. We skipped the outliers now.', RuntimeWarning)
     return C, Z_imp, Z
 
 
+def _em_step_body_shared(arrays, start, stop, num_ord_updates, weighted=False, targets=None):
+    """
+    Does a step of the EM algorithm on the rows start:stop of the arrays held in shared memory by a SharedMemoryPool.
+    Z is updated in place and the imputed rows are written into Z_imp; only C is sent back to the caller.
+    The rows are weighted by the shared array weights if weighted, and only the targets are imputed if provided
+    """
+    Z = arrays['Z'][start:stop]
+    weights = arrays['weights'][start:stop] if weighted else None
+    C, Z_imp, _ = _em_step_body(Z, arrays['r_lower'][start:stop], arrays['r_upper'][start:stop], arrays['sigma'], num_ord_updates, weights, targets)
+    arrays['Z_imp'][start:stop] = Z_imp
+    return C
+
+
+def _precision(sigma):
+    """
+    The inverse of the correlation matrix sigma, from its Cholesky factor. None if sigma is not numerically positive definite
+    """
+    try:
+        factor = cho_factor(sigma)
+    except np.linalg.LinAlgError:
+        return None
+    return cho_solve(factor, np.identity(len(sigma), dtype=sigma.dtype))
+
+
+def _group_by_pattern(missing):
+    """
+    Group the rows of a boolean missingness matrix by their pattern
+
+    Args:
+        missing (matrix): boolean, true at missing entries
+    Returns:
+        groups (list): one array of row indices for each distinct missingness pattern
+    """
+    if missing.shape[0] == 0:
+        return []
+    # one bit per entry, in the same lexicographic order as the boolean rows
+    _, inverse, counts = np.unique(np.packbits(missing, axis=1), axis=0, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    return np.split(order, np.cumsum(counts)[:-1])
+
+
+def _unique_rows(X):
+    """
+    Find the distinct rows of a data matrix, comparing both the observed values and the missingness masks
+
+    Args:
+        X (matrix): data matrix, with nan at missing entries
+    Returns:
+        rows (array): the index of one occurrence of each distinct row
+        inverse (array): for each row of X, the position of its distinct row in rows
+        counts (array): the number of occurrences of each distinct row
+    """
+    missing = np.isnan(X)
+    keys = np.concatenate((np.where(missing, 0, X), missing), axis=1)
+    _, rows, inverse, counts = np.unique(keys, axis=0, return_index=True, return_inverse=True, return_counts=True)
+    return rows, inverse.ravel(), counts
+
+
 def _em_step_body_row(Z_row, r_lower_row, r_upper_row, sigma, num_ord_updates):
     """
     The body of the em algorithm for each row
@@ -45,77 +126,429 @@ def _em_step_body_row(Z_row, r_lower_row, r_upper_row, sigma, num_ord_updates):
         Z_imp_row (array): Z_row with latent ordinals updated and missing entries imputed 
         Z_row (array): input Z_row with latent ordinals updated
     """
-    Z_imp_row = np.copy(Z_row)
-    p = Z_imp_row.shape[0]
-    num_ord = r_upper_row.shape[0]
-    C = np.zeros((p,p))
+    C, Z_imp_group, Z_group, truncnorm_warn = _em_step_body_group(Z_row[np.newaxis,:], r_lower_row[np.newaxis,:], r_upper_row[np.newaxis,:], sigma, num_ord_updates)
+    Z_row[:] = Z_group[0]
+    return C, Z_imp_group[0], Z_row, truncnorm_warn
+
+
+def _em_step_body_group(Z_group, r_lower_group, r_upper_group, sigma, num_ord_updates, precision=None, C=None, weights=None, targets=None):
+    """
+    The body of the em algorithm for a group of rows sharing the same missingness pattern.
+    The observed block of sigma is factored once for the whole group, and the conditional mean 
+    and covariance updates are batched matrix products over the rows of the group. 
+    If the precision matrix P is provided and fewer entries are missing than observed, the conditionals come from Schur complements in P instead: 
+    the conditional regression is -P_om P_mm^-1, the conditional covariance of the missing entries P_mm^-1, 
+    and the inverse observed block P_oo - P_om P_mm^-1 P_mo is only applied through products, so that only |missing| by |missing| systems are solved.
 
-    # TO DO: obs_indices = np.argwhere(~np.isnan(x)).flatten()
-    obs_indices = np.where(~np.isnan(Z_row))[0] 
-    missing_indices = np.setdiff1d(np.arange(p), obs_indices) 
-    # TO DO: ord_in_obs = np.argwhere(obs_indices < num_ord).flatten()
+    Args:
+        Z_group (matrix): (potentially missing) latent entries for the data points of the group
+        r_lower_group (matrix): (potentially missing) lower range of ordinal entries for the data points of the group
+        r_upper_group (matrix): (potentially missing) upper range of ordinal entries for the data points of the group
+        sigma (matrix): estimate of covariance
+        num_ord_updates (int): the number of times to re-estimate the latent ordinals
+        precision (matrix or None): the inverse of sigma
+        C (matrix or None): the matrix the conditional covariance terms are added to, a new zero matrix if None
+        weights (array or None): the number of times each row is counted in C, once if None
+        targets (array or None): boolean, true at the columns whose missing entries are imputed. 
+            If provided, the other missing entries are left missing and C is not updated
+
+    Returns:
+        C (matrix): results in the updated covariance when added to the empircal covariance, summed over the group
+        Z_imp_group (matrix): Z_group with latent ordinals updated and missing entries imputed 
+        Z_group (matrix): input Z_group with latent ordinals updated
+    """
+    Z_imp_group = np.copy(Z_group)
+    m, p = Z_imp_group.shape
+    num_ord = r_upper_group.shape[1]
+    if C is None:
+        C = np.zeros((p,p))
+    if weights is None:
+        weights = np.ones(m)
+
+    missing_row = np.isnan(Z_group[0,:])
+    obs_indices = np.where(~missing_row)[0]
+    missing_indices = np.where(missing_row)[0]
+    # the missing entries to impute, as positions in missing_indices
+    imputed = np.arange(len(missing_indices)) if targets is None else np.where(targets[missing_indices])[0]
     ord_in_obs = np.where(obs_indices < num_ord)[0]
     ord_obs_indices = obs_indices[ord_in_obs]
     # obtain correlation sub-matrices
     # obtain submatrices by indexing a "cartesian-product" of index arrays
-    sigma_obs_obs = sigma[np.ix_(obs_indices,obs_indices)]
-    sigma_obs_missing = sigma[np.ix_(obs_indices, missing_indices)]
-    sigma_missing_missing = sigma[np.ix_(missing_indices, missing_indices)]
-
-    if len(missing_indices) > 0:
-        tot_matrix = np.concatenate((np.identity(len(sigma_obs_obs)), sigma_obs_missing), axis=1)
-        intermed_matrix = np.linalg.solve(sigma_obs_obs, tot_matrix)
-        sigma_obs_obs_inv = intermed_matrix[:, :len(sigma_obs_obs)]
-        J_obs_missing = intermed_matrix[:, len(sigma_obs_obs):]
+    # sigma_obs_obs_inv_ord: the columns of the inverse of sigma_obs_obs at the observed ordinals, and inv_diag_ord their diagonal entries
+    # cond_cov_missing: the conditional covariance of the missing entries given the observed ones
+    use_precision = precision is not None and len(missing_indices) < len(obs_indices)
+    if len(obs_indices) == 0:
+        sigma_obs_obs_inv_ord = np.zeros((0,0), dtype=sigma.dtype)
+        J_obs_missing = np.zeros((0, len(missing_indices)), dtype=sigma.dtype)
+        cond_cov_missing = sigma[np.ix_(missing_indices, missing_indices)]
+    elif use_precision and len(missing_indices) == 0:
+        J_obs_missing = np.zeros((len(obs_indices), 0), dtype=sigma.dtype)
+        cond_cov_missing = np.zeros((0,0), dtype=sigma.dtype)
+        inv_diag_ord = np.diagonal(precision)[ord_obs_indices]
+        precision_ord = precision[:, ord_obs_indices].astype(Z_group.dtype, copy=False)
+    elif use_precision:
+        # the conditional mean of any missing entry needs the whole block P_mm
+        precision_obs_missing = precision[:, missing_indices][obs_indices]
+        cond_cov_missing = np.linalg.inv(precision[np.ix_(missing_indices, missing_indices)])
+        J_obs_missing = -np.dot(precision_obs_missing, cond_cov_missing)
+        inv_diag_ord = np.diagonal(precision)[ord_obs_indices] + np.sum(J_obs_missing[ord_in_obs] * precision_obs_missing[ord_in_obs], axis=1)
+        # the ordinal columns of the precision, multiplied by the latent rows with zeros at the missing entries
+        precision_ord = precision[:, :num_ord].astype(Z_group.dtype, copy=False)
     else:
-        sigma_obs_obs_inv = np.linalg.solve(sigma_obs_obs, np.identity(len(sigma_obs_obs)))
-    # initialize vector of variances for observed ordinal dimensions
-    var_ordinal = np.zeros(p)
+        sigma_obs_obs = sigma[np.ix_(obs_indices,obs_indices)]
+        if targets is not None:
+            # only the columns of the missing targets are solved for, and the conditional covariance is not needed
+            missing_indices, imputed = missing_indices[imputed], np.arange(len(imputed))
+        sigma_obs_missing = sigma[np.ix_(obs_indices, missing_indices)]
+        # only the columns of the inverse at the observed ordinals are needed
+        tot_matrix = np.concatenate((np.identity(len(sigma_obs_obs), dtype=sigma.dtype)[:, ord_in_obs], sigma_obs_missing), axis=1)
+        intermed_matrix = np.linalg.solve(sigma_obs_obs, tot_matrix)
+        sigma_obs_obs_inv_ord = intermed_matrix[:, :len(ord_in_obs)]
+        inv_diag_ord = sigma_obs_obs_inv_ord[ord_in_obs, np.arange(len(ord_in_obs))]
+        J_obs_missing = intermed_matrix[:, len(ord_in_obs):]
+        if targets is None:
+            cond_cov_missing = sigma[np.ix_(missing_indices, missing_indices)] - np.matmul(J_obs_missing.T, sigma_obs_missing)
+    # initialize the variances for observed ordinal dimensions
+    var_ordinal = np.zeros((m, len(ord_obs_indices)))
 
     # OBSERVED ORDINAL ELEMENTS
     # when there is an observed ordinal to be imputed and another observed dimension, impute this ordinal
     truncnorm_warn = False
     if len(obs_indices) >= 2 and len(ord_obs_indices) >= 1:
+        # the conditional variance of each observed ordinal given the other observed entries is shared by the group
+        new_var = 1.0/inv_diag_ord
+        new_std = np.sqrt(new_var)
+        r_lower_obs = r_lower_group[:, ord_obs_indices]
+        r_upper_obs = r_upper_group[:, ord_obs_indices]
         for update_iter in range(num_ord_updates):
             # used to efficiently compute conditional mean
-            sigma_obs_obs_inv_Z_row = np.dot(sigma_obs_obs_inv, Z_row[obs_indices])
-            for ind in range(len(ord_obs_indices)):
-                j = obs_indices[ind]
-                not_j_in_obs = np.setdiff1d(np.arange(len(obs_indices)),ind) 
-                v = sigma_obs_obs_inv[:,ind]
-                new_var_ij = 1.0/v[ind]
-                new_var_ij = new_var_ij.item()
-                new_std_ij = np.sqrt(new_var_ij)
-                #new_mean_ij = np.dot(v[not_j_in_obs], Z_row[obs_indices[not_j_in_obs]]) * (-new_var_ij)
-                new_mean_ij = Z_row[j] - new_var_ij*sigma_obs_obs_inv_Z_row[ind]
-                a_ij, b_ij = (r_lower_row[j] - new_mean_ij) / new_std_ij, (r_upper_row[j] - new_mean_ij) / new_std_ij
-                try:
-                    mean, var = truncnorm.stats(a=a_ij,b=b_ij,
-                        loc=new_mean_ij,
-                        scale=new_std_ij,
-                        moments='mv')
-                    if np.isfinite(var):
-                        var_ordinal[j] = var
-                        if update_iter == num_ord_updates - 1:
-                            C[j,j] = C[j,j] + var 
-                    if np.isfinite(mean):
-                        Z_row[j] = mean
-                except RuntimeWarning:
-                    #print(f'Bad truncated normal stats: lower {r_lower_row[j]}, upper {r_upper_row[j]}, a {a_ij}, b {b_ij}, mean {new_mean_ij}, std {new_std_ij}')
-                    truncnorm_warn = True
-    
+            if use_precision and len(missing_indices) == 0:
+                sigma_obs_obs_inv_Z = np.dot(Z_group, precision_ord)
+            elif use_precision:
+                sigma_obs_obs_inv_Z = np.dot(np.where(missing_row, 0, Z_group), precision_ord)[:, ord_obs_indices]
+                sigma_obs_obs_inv_Z += np.dot(np.dot(Z_group[:, obs_indices], J_obs_missing), precision_obs_missing[ord_in_obs].T).astype(Z_group.dtype, copy=False)
+            else:
+                sigma_obs_obs_inv_Z = np.dot(Z_group[:, obs_indices], sigma_obs_obs_inv_ord.astype(Z_group.dtype, copy=False))
+            Z_ord_obs = Z_group[:, ord_obs_indices]
+            new_mean = Z_ord_obs - new_var * sigma_obs_obs_inv_Z
+            a, b = (r_lower_obs - new_mean) / new_std, (r_upper_obs - new_mean) / new_std
+            mean, var = _truncnorm_mean_var(a, b, loc=new_mean, scale=new_std)
+            finite_var = np.isfinite(var)
+            finite_mean = np.isfinite(mean)
+            var_ordinal[finite_var] = var[finite_var]
+            Z_ord_obs[finite_mean] = mean[finite_mean]
+            Z_group[:, ord_obs_indices] = Z_ord_obs
+            truncnorm_warn = truncnorm_warn or not (finite_var.all() and finite_mean.all())
+        if targets is None:
+            C[ord_obs_indices, ord_obs_indices] += np.dot(weights, np.where(finite_var, var, 0))
+    var_ordinal_sum = np.dot(weights, var_ordinal)
 
     # MISSING ELEMENTS
-    Z_obs = Z_row[obs_indices]
-    Z_imp_row[obs_indices] = Z_obs
-    if len(missing_indices) > 0:
-        Z_imp_row[missing_indices] = np.matmul(J_obs_missing.T,Z_obs) 
+    Z_obs = Z_group[:, obs_indices]
+    Z_imp_group[:, obs_indices] = Z_obs
+    if targets is not None:
+        if len(imputed) > 0:
+            Z_imp_group[:, missing_indices[imputed]] = np.matmul(Z_obs, J_obs_missing[:, imputed].astype(Z_obs.dtype, copy=False))
+    elif len(missing_indices) > 0:
+        # the products with the rows are done in the precision of the latent values
+        Z_imp_group[:, missing_indices] = np.matmul(Z_obs, J_obs_missing.astype(Z_obs.dtype, copy=False))
         # variance expectation and imputation
-        if len(ord_obs_indices) >= 1 and len(obs_indices) >= 2 and np.sum(var_ordinal) > 0: 
-            cov_missing_obs_ord = J_obs_missing[ord_in_obs].T * var_ordinal[ord_obs_indices]
+        C[np.ix_(missing_indices, missing_indices)] += weights.sum() * cond_cov_missing
+        if len(ord_obs_indices) >= 1 and len(obs_indices) >= 2 and np.sum(var_ordinal_sum) > 0: 
+            cov_missing_obs_ord = J_obs_missing[ord_in_obs].T * var_ordinal_sum
             C[np.ix_(missing_indices, ord_obs_indices)] += cov_missing_obs_ord
             C[np.ix_(ord_obs_indices, missing_indices)] += cov_missing_obs_ord.T
-            C[np.ix_(missing_indices, missing_indices)] += sigma_missing_missing - np.matmul(J_obs_missing.T, sigma_obs_missing) + np.matmul(cov_missing_obs_ord, J_obs_missing[ord_in_obs])
-        else:
-            C[np.ix_(missing_indices, missing_indices)] += sigma_missing_missing - np.matmul(J_obs_missing.T, sigma_obs_missing)
-    return C, Z_imp_row, Z_row, truncnorm_warn
\ No newline at end of file
+            C[np.ix_(missing_indices, missing_indices)] += np.matmul(cov_missing_obs_ord, J_obs_missing[ord_in_obs])
+    return C, Z_imp_group, Z_group, truncnorm_warn
+
+
+def _init_Z_ord(Z_ord_lower, Z_ord_upper, rng, chunk_size=None):
+    """
+    Initializes the observed latent ordinal values by sampling from a standard
+    Gaussian trucated to the inveral of Z_ord_lower, Z_ord_upper. 
+    All cells are sampled at once by inverting the Gaussian CDF at uniform draws, 
+    so the result only depends on the state of rng (and not on chunk_size).
+
+    Args:
+        Z_ord_lower (matrix): lower range for ordinals
+        Z_ord_upper (matrix): upper range for ordinals
+        rng (np.random.Generator): the random generator to draw from
+        chunk_size (positive int or None): the number of rows sampled at once, to bound the memory of temporaries. All rows if None
+
+    Returns:
+        Z_ord (range): Samples drawn from gaussian truncated between Z_ord_lower and Z_ord_upper
+    """
+    n, k = Z_ord_lower.shape
+    Z_ord = np.empty((n, k), dtype=Z_ord_lower.dtype)
+    Z_ord[:] = np.nan
+    if chunk_size is None:
+        chunk_size = max(n, 1)
+    for start in range(0, n, chunk_size):
+        Z_ord_chunk = Z_ord[start:start+chunk_size]
+        obs_indices = ~np.isnan(Z_ord_lower[start:start+chunk_size]) & ~np.isnan(Z_ord_upper[start:start+chunk_size])
+        u_lower = norm.cdf(Z_ord_lower[start:start+chunk_size][obs_indices])
+        u_upper = norm.cdf(Z_ord_upper[start:start+chunk_size][obs_indices])
+        assert np.all(0<=u_lower) and np.all(u_lower <= u_upper) and np.all(u_upper<=1)
+        # cells whose interval has positive probability
+        sampled = (u_upper > 0) & (u_lower < 1)
+        obs_indices[obs_indices] = sampled
+        Z_ord_chunk[obs_indices] = norm.ppf(rng.uniform(u_lower[sampled], u_upper[sampled]))
+    return Z_ord
+
+
+def _truncnorm_mean_var(a, b, loc=0.0, scale=1.0):
+    """
+    Vectorized mean and variance of the normal distribution N(loc, scale^2) truncated to [loc + a*scale, loc + b*scale]. 
+    Agrees with truncnorm.stats(a, b, loc, scale, moments='mv') but evaluates all entries at once, 
+    and works with the Mills ratios phi(x)/(Phi(b)-Phi(a)) in log space so that intervals far in the tails stay stable.
+
+    Args:
+        a, b (array): standardized lower and upper truncation points, possibly infinite
+        loc, scale (array): location and scale of the untruncated normal, broadcastable against a and b
+    Returns:
+        mean (array): the truncated normal mean, nan for empty intervals
+        var (array): the truncated normal variance, nan for empty intervals
+    """
+    a, b, loc, scale = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (a, b, loc, scale)])
+    # reflect intervals lying in the upper tail to the lower tail, where log_ndtr keeps full precision
+    flip = (a + b) > 0
+    lower = np.where(flip, -b, a)
+    upper = np.where(flip, -a, b)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore', under='ignore'):
+        log_cdf_lower = log_ndtr(lower)
+        log_cdf_upper = log_ndtr(upper)
+        # log(Phi(upper) - Phi(lower))
+        log_mass = log_cdf_upper + np.log(-np.expm1(log_cdf_lower - log_cdf_upper))
+        ratio_lower = np.exp(-0.5 * lower**2 - _LOG_SQRT_2PI - log_mass)
+        ratio_upper = np.exp(-0.5 * upper**2 - _LOG_SQRT_2PI - log_mass)
+        # x*phi(x) vanishes at infinite end points
+        x_ratio_lower = np.where(np.isinf(lower), 0.0, lower * ratio_lower)
+        x_ratio_upper = np.where(np.isinf(upper), 0.0, upper * ratio_upper)
+        mean = ratio_lower - ratio_upper
+        var = 1.0 + x_ratio_lower - x_ratio_upper - mean**2
+        # The closed form for the variance cancels catastrophically on narrow intervals and deep in the tails.
+        # There the truncated density is close to an exponential with rate -mid around the midpoint mid, whose moments are used instead
+        width = upper - lower
+        bad = ~(np.isfinite(mean) & np.isfinite(var) & (mean >= lower) & (mean <= upper) & (var >= 0) & (var <= width**2 / 4))
+        bad |= var < 1e-9 * (1.0 + np.abs(x_ratio_lower) + np.abs(x_ratio_upper) + mean**2)
+        bad &= np.isfinite(width) & (width >= 0)
+        mid, half = (lower + upper) / 2.0, width / 2.0
+        rate_half = mid * half
+        small = np.abs(rate_half) < 1e-2
+        safe_mid = np.where(small, 1.0, mid)
+        safe_rate_half = np.where(small, 1.0, rate_half)
+        mean = np.where(bad, mid + np.where(small, -mid * half**2 / 3.0, 1.0 / safe_mid - half / np.tanh(safe_rate_half)), mean)
+        var = np.where(bad, np.where(small, half**2 / 3.0, 1.0 / safe_mid**2 - (half / np.sinh(safe_rate_half))**2), var)
+        empty = ~(lower <= upper)
+        mean = np.where(empty, np.nan, mean)
+        var = np.where(empty, np.nan, var)
+    mean = np.where(flip, -mean, mean)
+    return loc + scale * mean, var * scale**2
+
+
+def _low_rank_e_step(Z, r_lower, r_upper, U, d, sigma, chunk_size=4096, weights=None, num_ord_updates=1):
+    """
+    E-step of the low rank Gaussian copula: updates the latent ordinals in Z in place and 
+    accumulates the conditional moments of the factors into the per column sums used by the M-step.
+    Rows are processed in chunks of chunk_size, with stacked rank by rank inverses and matrix products over the rows of a chunk, 
+    and the conditional moments of a chunk are folded into the sums before the next chunk, 
+    so that memory does not grow with n beyond Z and the sparse C.
+    If weights is provided, the sums and the log likelihood count each row weights times, as for duplicated rows, while C is not weighted.
+    With num_ord_updates above one, the latent ordinals of a chunk are re-estimated num_ord_updates-1 times before the pass 
+    that computes its conditional moments, reusing the rank by rank inverses of the chunk.
+    Args:
+        Z (matrix): the transformed value, at observed continuous entry; 
+                    current conditional mean, at observed ordinal entry (updated in place); NA elsewhere
+        r_lower, r_upper (matrix): the lower and upper bounds for the latent ordinals
+        U, d (matrix, array): left singular vectors and singular values of W
+        sigma (scalar): the latent noise variance
+        chunk_size (positive int): the number of rows processed at once
+        weights (array or None): the number of times each row is counted, once if None
+        num_ord_updates (positive int): the number of times to re-estimate the latent ordinals
+    Returns:
+        F (array): p by rank by rank, for each column j the sum over the rows i observed at j of SS_i + sigma A_i, 
+                   where A_i is the conditional covariance factor and SS_i the conditional second moment of the factors of row i
+        R (matrix): p by rank, for each column j the sum over the rows i observed at j of S_i Z_ij + A_i C_ij U_j, 
+                    where S_i is the conditional mean of the factors of row i
+        C (sparse matrix): 0 at observed continuous entry; the conditional variance, at observed ordinal entry; NA elsewhere
+        z_sq (scalar): the sum of squares of the observed entries of the updated Z
+        negloglik: the negative log likelihood, up to constants
+    """
+    n,p = Z.shape
+    rank = U.shape[1]
+    num_ord = r_lower.shape[1]
+    F = np.zeros((p, rank, rank))
+    R = np.zeros((p, rank))
+    z_sq = 0
+    if weights is None:
+        weights = np.ones(n)
+    negloglik = weights.sum() * p * np.log(sigma)
+    C_rows, C_cols, C_values = [], [], []
+    D_inv = np.diag(1.0/np.square(d))
+    # U_obs^T U_obs of a row is the product of its observed indicators with the outer products of the rows of U
+    UU_outer = (U[:,:,np.newaxis] * U[:,np.newaxis,:]).reshape(p, rank*rank)
+    U_z = U.astype(Z.dtype, copy=False)
+    UU_outer_z = UU_outer.astype(Z.dtype, copy=False)
+
+    for start in range(0, n, chunk_size):
+        Z_chunk = Z[start:start+chunk_size]
+        m = Z_chunk.shape[0]
+        w = weights[start:start+m].astype(Z.dtype, copy=False)
+        obs = ~np.isnan(Z_chunk)
+        Z_zero = np.where(obs, Z_chunk, 0)
+
+        UU_obs = np.dot(obs.astype(U.dtype), UU_outer).reshape(m, rank, rank)
+        # used in both ordinal and factor block
+        A = np.linalg.inv(UU_obs + sigma * D_inv).astype(Z.dtype, copy=False)
+        # when there is an observed ordinal to be imputed and another observed dimension, impute this ordinal
+        update = obs[:,:num_ord] & (np.sum(obs, axis=1) >= 2)[:,np.newaxis]
+        if update.any():
+            # u_j^T A_i u_j for all rows i and ordinals j
+            sigma_ij = sigma/(1 - np.dot(A.reshape(m, rank*rank), UU_outer_z[:num_ord].T))
+            for _ in range(num_ord_updates - 1):
+                S = np.matmul(A, np.dot(Z_zero, U_z)[:,:,np.newaxis])[:,:,0]
+                _low_rank_update_ord(Z_chunk, Z_zero, S, U_z, sigma, sigma_ij, r_lower[start:start+m], r_upper[start:start+m], update)
+        UZ = np.dot(Z_zero, U_z)
+        # the factor moments use the latent ordinals before their last update
+        S = np.matmul(A, UZ[:,:,np.newaxis])[:,:,0]
+        SS = S[:,:,np.newaxis] * S[:,np.newaxis,:]
+        _, logdet = np.linalg.slogdet(np.identity(rank) + np.outer(d/sigma, d) * UU_obs)
+        negloglik = negloglik + np.dot(w, logdet + np.sum(Z_zero**2, axis=1) - np.sum(S * UZ, axis=1))
+
+        if update.any():
+            C_ord = _low_rank_update_ord(Z_chunk, Z_zero, S, U_z, sigma, sigma_ij, r_lower[start:start+m], r_upper[start:start+m], update)
+            # A U_obs^T diag(C) U_obs A
+            UCU = np.dot(C_ord, UU_outer_z[:num_ord]).reshape(m, rank, rank)
+            SS += np.matmul(np.matmul(A, UCU), A)
+            # A_i C_ij U_j summed over the rows observed at each ordinal j
+            AC = np.dot(C_ord.T * w, A.reshape(m, rank*rank)).reshape(num_ord, rank, rank)
+            R[:num_ord] += np.matmul(AC, U[:num_ord,:,np.newaxis])[:,:,0]
+            rows, cols = np.nonzero(C_ord)
+            C_rows.append(rows + start)
+            C_cols.append(cols)
+            C_values.append(C_ord[rows, cols])
+
+        R += np.dot(Z_zero.T * w, S)
+        F += np.dot(obs.T * w, (SS + sigma*A).reshape(m, rank*rank)).reshape(p, rank, rank)
+        z_sq += np.dot(w, np.sum(Z_zero**2, axis=1))
+
+    if len(C_values) > 0:
+        C = sparse.csr_matrix((np.concatenate(C_values), (np.concatenate(C_rows), np.concatenate(C_cols))), shape=(n,p))
+    else:
+        C = sparse.csr_matrix((n,p), dtype=Z.dtype)
+    return F, R, C, z_sq, negloglik
+
+
+def _low_rank_update_ord(Z, Z_zero, S, U, sigma, sigma_ij, r_lower, r_upper, update):
+    """
+    Updates in place the latent ordinals of Z flagged in update, and the same entries of Z_zero (Z with zeros at missing entries), 
+    to their truncated conditional means given the factor means S of their rows.
+    Args:
+        sigma_ij (matrix): the conditional variances of the latent ordinals given the other observed entries of their rows
+        r_lower, r_upper (matrix): the lower and upper bounds for the latent ordinals
+        update (matrix): boolean, true at the latent ordinals to update
+    Returns:
+        C_ord (matrix): the conditional variances of the updated latent ordinals, 0 elsewhere
+    """
+    num_ord = update.shape[1]
+    mu = (Z_zero[:,:num_ord] - np.dot(S, U[:num_ord].T))/sigma
+    Z_ord = Z[:,:num_ord]
+    Z_ord_obs = Z_ord[update]
+    mu_ij = Z_ord_obs - mu[update] * sigma_ij[update]
+    std_ij = np.sqrt(sigma_ij[update])
+    mu_ij_new, sigma_ij_new = _truncnorm_mean_var(
+        a=(r_lower[update] - mu_ij) / std_ij,
+        b=(r_upper[update] - mu_ij) / std_ij,
+        loc=mu_ij, scale=std_ij)
+    finite_var = np.isfinite(sigma_ij_new)
+    C_ord = np.zeros(update.shape, dtype=Z.dtype)
+    C_ord[update] = np.where(finite_var, sigma_ij_new, 0)
+    if not finite_var.all():
+        warnings.warn("variance was not finite and is: " +str(sigma_ij_new[~finite_var]), RuntimeWarning)
+    finite_mean = np.isfinite(mu_ij_new)
+    Z_ord[update] = np.where(finite_mean, mu_ij_new, Z_ord_obs)
+    if not finite_mean.all():
+        warnings.warn("mean was not finite and is: " +str(mu_ij_new[~finite_mean]), RuntimeWarning)
+    Z_zero[:,:num_ord] = np.where(update, Z_ord, Z_zero[:,:num_ord])
+    return C_ord
+
+
+def _low_rank_comp_S(Z, U, d, sigma, chunk_size=4096):
+    """
+    Intermidiate step.
+    It seems that S must be updated using the last obtained W and sigma, otherwise numerical instability happens. 
+    Such problem is not seen in R implementation. Keep an eye.
+    Rows are sorted by observation pattern and processed in chunks of chunk_size: 
+    the rank by rank system of each pattern is formed and inverted once, and the rows of a chunk are solved as stacked products.
+    Args:
+        Z (matrix): the transformed value, at observed continuous entry; the conditional mean, at observed ordinal entry; NA elsewhere
+        U, d (matrix, array): left singular vectors and singular values of W, the latent coefficient matrix of the low rank Gaussian copula
+        sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
+    Returns:
+        S: a factor used for imputation
+    """
+    n, p = Z.shape
+    k = U.shape[1]
+    S = np.zeros((n,k), dtype=Z.dtype)
+    D_inv = sigma * np.diag(1.0/np.square(d))
+    UU_outer = (U[:,:,np.newaxis] * U[:,np.newaxis,:]).reshape(p, k*k)
+    U_z = U.astype(Z.dtype, copy=False)
+    missing = np.isnan(Z)
+    order = np.concatenate(_group_by_pattern(missing)) if n > 0 else np.arange(0)
+    for start in range(0, n, chunk_size):
+        rows = order[start:start+chunk_size]
+        patterns, inverse = np.unique(~missing[rows], axis=0, return_inverse=True)
+        # U_obs^T U_obs of each pattern
+        UU_obs = np.dot(patterns.astype(U.dtype), UU_outer).reshape(len(patterns), k, k)
+        A = np.linalg.inv(UU_obs + D_inv).astype(Z.dtype, copy=False)
+        UZ = np.dot(np.where(missing[rows], 0, Z[rows]), U_z)
+        S[rows] = np.matmul(A[inverse.ravel()], UZ[:,:,np.newaxis])[:,:,0]
+    return S
+
+
+def _low_rank_impute(Z, S, U, chunk_size=4096, targets=None):
+    """
+    Impute missing values of the low rank Gaussian copula, in row chunks of chunk_size
+    Args:
+        Z (matrix): the transformed value, at observed continuous entry; the conditional mean, at observed ordinal entry; NA elsewhere
+        S: a factor used for imputation
+        U (matrix): left singular vectors of W, the latent coefficient matrix of the low rank Gaussian copula
+        targets (array or None): boolean, true at the columns whose missing entries are imputed, all columns if None
+    Returns:
+        Zimp (matrix): a copy of Z, but with missing entries (in the target columns) replaced by their conditional mean imputation.
+    """
+    n,p = Z.shape
+    Zimp = np.copy(Z)
+    U_z = U.astype(Z.dtype, copy=False)
+    if targets is not None:
+        columns = np.flatnonzero(targets)
+        U_z = U_z[columns]
+    for start in range(0, n, chunk_size):
+        Zimp_chunk = Zimp[start:start+chunk_size] if targets is None else Zimp[start:start+chunk_size, columns]
+        index_m = np.isnan(Zimp_chunk)
+        Zimp_chunk[index_m] = np.dot(S[start:start+chunk_size], U_z.T)[index_m]
+        if targets is not None:
+            Zimp[start:start+chunk_size, columns] = Zimp_chunk
+    return Zimp
+
+
+def _low_rank_e_step_shared(arrays, start, stop, U, d, sigma, weighted=False, chunk_size=4096, num_ord_updates=1):
+    """
+    Does the low rank E-step on the rows start:stop of the arrays held in shared memory by a SharedMemoryPool.
+    The latent ordinals of Z are updated in place; only the per column sums, the conditional variances of the rows 
+    and the log likelihood term are sent back to the caller. The rows are weighted by the shared array weights if weighted
+    """
+    weights = arrays['weights'][start:stop] if weighted else None
+    return _low_rank_e_step(arrays['Z'][start:stop], arrays['r_lower'][start:stop], arrays['r_upper'][start:stop], U, d, sigma, 
+                            chunk_size=chunk_size, weights=weights, num_ord_updates=num_ord_updates)
+
+
+def _low_rank_impute_shared(arrays, start, stop, U, d, sigma, targets=None, chunk_size=4096):
+    """
+    Computes the factor S and the imputed latent values of the rows start:stop of Z held in shared memory by a SharedMemoryPool,
+    and writes them into the shared arrays S and Z_imp
+    """
+    Z = arrays['Z'][start:stop]
+    S = _low_rank_comp_S(Z, U, d, sigma, chunk_size)
+    arrays['S'][start:stop] = S
+    arrays['Z_imp'][start:stop] = _low_rank_impute(Z, S, U, chunk_size, targets)
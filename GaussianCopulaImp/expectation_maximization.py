@@ -1,11 +1,16 @@
-from .transform_function import TransformFunction
+from .transform_function import TransformFunction, _sorted_columns_from_chunks
 from .online_transform_function import OnlineTransformFunction
-from .embody import _em_step_body_, _em_step_body, _em_step_body_row
+from .embody import _em_step_body_, _em_step_body, _em_step_body_row, _em_step_body_shared, _group_by_pattern, _unique_rows, _init_Z_ord
+from .worker_pool import SharedMemoryPool
+from .memory_plan import MemoryPlan, _WORKER_BYTES, _ARRAY_BYTES, _PPF_BYTES, _CDF_BYTES, _TRUNCNORM_BYTES, _FIXED_BYTES
+from .online_snapshot import OnlineSnapshot
 from scipy.stats import norm, truncnorm
+from contextlib import contextmanager
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
 import warnings
-from scipy.linalg import svdvals
+from scipy.linalg import svdvals, cho_factor, cho_solve
 from collections import defaultdict
 
 class ExpectationMaximization():
@@ -22,26 +27,49 @@ class ExpectationMaximization():
         int. When cont_indices and ord_indices are not specified, variables whose numbers of unique values are regarded as continuous variables and others as ordinal variables.
     sigma: numpy array
         numpy array of shape (p, p), the copula correlation matrix. 
+    dtype: numpy dtype
+        the floating point type of the latent matrices and bounds, and of the chunk buffers. 
+    sigma_dtype: numpy dtype
+        the floating point type of the copula correlation matrix, in which its sub-matrices are factored.
+    memory_plan: MemoryPlan or None
+        the plan of the last fit run with a memory_limit, with the planned and observed peak memory of its phases.
+    snapshot: OnlineSnapshot or None
+        the latest version of the model fitted online, published after each batch of partial_fit_and_predict, 
+        from which other threads can impute while the next batches are ingested.
 
     Methods
     -------
     impute_missing:
         fit a Gaussian copula model from incomplete data and then use the fitted model to impute the missing entries.
+    fit:
+        fit a Gaussian copula model from incomplete data, without imputing it.
+    transform:
+        impute the missing entries of new data points from the fitted model, without updating the model.
+    add_columns:
+        extend the fitted model by new columns of the same rows, without refitting the existing columns.
+    impute_missing_chunked:
+        fit a Gaussian copula model and impute the missing entries, reading the data in row chunks for tables larger than memory.
     impute_missing_online:
         At each sequentially observed data batch, fit a Gaussian copula model from incomplete data and then use the fitted model to impute the missing entries.
+    close:
+        shut down the worker pool used for parallelism, if any.
     '''
 
-    def __init__(self, var_types=None, max_ord=20, sigma_init = None):
+    def __init__(self, var_types=None, max_ord=20, sigma_init = None, dtype=np.float64, sigma_dtype=np.float64):
         '''
         The user can tell the model which variables are continuous and which are ordinal by the following two ways:
         (1) input a dict var_types that contains valid assignmetns of cont_indices and ord_indices;
         (2) input a max_ord so that the variables whose number of unique observation below max_ord will be treated as ordinal variables.
         If both are provided, only var_types will be used.
+        Using np.float32 for dtype halves the memory and bandwidth of the latent matrices, while sigma_dtype=np.float64 
+        keeps the correlation estimate and its factorizations in double precision.
 
         Args:
             var_types: dict
             max_ord: int
             sigma_init: None or numpy array
+            dtype: np.float64 or np.float32
+            sigma_dtype: np.float64 or np.float32
         '''
         if var_types is not None:
             if not all(var_types['cont'] ^ var_types['ord']):
@@ -52,15 +80,22 @@ class ExpectationMaximization():
             self.cont_indices = None
             self.ord_indices = None 
         self.max_ord = max_ord
+        self.dtype = np.dtype(dtype)
+        self.sigma_dtype = np.dtype(sigma_dtype)
         if sigma_init is not None:
             message = 'the intial correlation matrix must be nonsingular, while the input has the smallest singular value below 1e-7'
             assert svdvals(sigma_init).min() > 1e-7, message
+            sigma_init = np.asarray(sigma_init, dtype=self.sigma_dtype)
         self.sigma = sigma_init
+        self.memory_plan = None
+        self.snapshot = None
+        self._pool = None
 
     def impute_missing(self, X, threshold=0.01, max_iter=50, max_workers=1, num_ord_updates=1, 
                        batch_size=100, batch_c=0, 
                        window_size=200, const_decay = -1, 
-                       verbose=False, seed=1):
+                       active_tol=None, active_check=10, active_refresh=0.05, 
+                       collapse_duplicates=False, target_columns=None, memory_limit=None, verbose=False, seed=1):
         """
         Fits a Gaussian Copula and imputes missing values in X.
 
@@ -72,35 +107,629 @@ class ExpectationMaximization():
             max_iter (int): the maximum number of iterations for copula estimation
             max_workers: the maximum number of workers for parallelism
             max_ord: maximum number of levels in any ordinal for detection of ordinal indices
+            active_tol, active_check, active_refresh: active-set EM settings, see _fit_covariance
+            collapse_duplicates (bool): if True, identical rows (same observed values and missingness mask) are fitted once, 
+                weighted by their number of occurrences, and share their imputation. The latent ordinals of a distinct row are drawn 
+                once by _init_Z_ord, so all its copies start from the same draw instead of independent ones
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute. 
+                The model is fitted on all columns, but only the missing entries of these columns are transformed back, the others are left missing
+            memory_limit (int, str or None): the memory budget of the fit, in bytes or as a string such as '4GB'. 
+                If provided, the row chunk size and the number of workers (at most max_workers) are chosen so that the planned peak memory fits, 
+                a MemoryError describing the plan is raised before fitting if it cannot, and the plan is kept in memory_plan, see MemoryPlan
         Returns:
             X_imp (matrix): X with missing values imputed
             sigma_rearragned (matrix): an estimate of the covariance of the copula
         """
-        if self.cont_indices is None:
-            self.cont_indices = self.get_cont_indices(X, self.max_ord)
-            self.ord_indices = ~self.cont_indices
+        self._set_var_types(X)
+        estimate = lambda chunk_size, workers: self._memory_estimate(X.shape, chunk_size, workers, batch_size=batch_size if batch_c > 0 else None)
+        with self._memory_planned(memory_limit, estimate, X.shape[0], max_workers) as max_workers:
+            Z_imp = self._fit(X, threshold, max_iter, max_workers, num_ord_updates, batch_size, batch_c, verbose, seed, 
+                              collapse_duplicates=collapse_duplicates, 
+                              active_tol=active_tol, active_check=active_check, active_refresh=active_refresh)
+            self._memory_phase('impute')
+            # rearrange sigma so it corresponds to the column ordering of X ## first few dims are always continuous, after always ordinal
+            _order = self.back_to_original_order()
+            targets, _ = self._target_masks(target_columns, X.shape[1])
+            X_imp = np.empty(X.shape)
+            # transform back one chunk of rows at a time under a memory plan, all rows otherwise
+            chunk_size = self._row_chunk_size(max(X.shape[0], 1))
+            for start in range(0, X.shape[0], chunk_size):
+                rows = slice(start, start+chunk_size)
+                # Rearrange Z_imp so that it's columns correspond to the columns of X
+                Z_imp_rearranged = Z_imp[rows][:,_order]
+                if np.sum(self.cont_indices) > 0:
+                    X_imp[rows,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X[rows], targets)
+                if np.sum(self.ord_indices) >0:
+                    X_imp[rows,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X[rows], targets)
+        sigma_rearranged = self.sigma[np.ix_(_order, _order)]
+
+        return {'imputed_data':X_imp, 'copula_corr':sigma_rearranged}
+
+    def fit(self, X, threshold=0.01, max_iter=50, max_workers=1, num_ord_updates=1, 
+            batch_size=100, batch_c=0, 
+            active_tol=None, active_check=10, active_refresh=0.05, 
+            collapse_duplicates=False, memory_limit=None, verbose=False, seed=1):
+        """
+        Fits a Gaussian Copula on X without imputing it. The estimated marginals and copula correlation are kept,
+        so that transform can later impute new data points from the fitted model.
+
+        Args:
+            X (matrix): data matrix to fit the model on
+            threshold (float): the threshold for scaled difference between covariance estimates at which to stop early
+            max_iter (int): the maximum number of iterations for copula estimation
+            max_workers: the maximum number of workers for parallelism
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals per iteration
+            batch_size, batch_c: mini-batch EM is used when batch_c is positive
+            active_tol, active_check, active_refresh: active-set EM settings, see _fit_covariance
+            collapse_duplicates (bool): if True, identical rows are fitted once, weighted by their number of occurrences
+            memory_limit (int, str or None): the memory budget of the fit, see impute_missing
+        Returns:
+            self
+        """
+        self._set_var_types(X)
+        estimate = lambda chunk_size, workers: self._memory_estimate(X.shape, chunk_size, workers, impute=False, batch_size=batch_size if batch_c > 0 else None)
+        with self._memory_planned(memory_limit, estimate, X.shape[0], max_workers) as max_workers:
+            self._fit(X, threshold, max_iter, max_workers, num_ord_updates, batch_size, batch_c, verbose, seed, 
+                      collapse_duplicates=collapse_duplicates, 
+                      active_tol=active_tol, active_check=active_check, active_refresh=active_refresh)
+        return self
 
+    def _fit(self, X, threshold=0.01, max_iter=50, max_workers=1, num_ord_updates=1, 
+             batch_size=100, batch_c=0, 
+             verbose=False, seed=1, collapse_duplicates=False, **kwargs):
+        """
+        Estimates the marginals and the copula correlation from X and returns the imputed latent values of X. 
+        With collapse_duplicates, the marginals are estimated from all rows and the copula correlation from the distinct rows, 
+        weighted by their number of occurrences
+        """
+        self._set_var_types(X)
+        self._memory_phase('marginals')
         #self._fit_initial_transformation(X, window_size)
-        self.transform_function = TransformFunction(X, self.cont_indices, self.ord_indices)
-        Z_imp = self._fit_covariance(X, threshold, max_iter, max_workers, num_ord_updates, batch_size, batch_c, verbose, seed)
-        # rearrange sigma so it corresponds to the column ordering of X ## first few dims are always continuous, after always ordinal
-        _order = self.back_to_original_order()
+        self.transform_function = TransformFunction(X, self.cont_indices, self.ord_indices, dtype=self.dtype)
+        if not collapse_duplicates:
+            return self._fit_covariance(X, threshold, max_iter, max_workers, num_ord_updates, batch_size, batch_c, verbose, seed, **kwargs)
+        rows, inverse, counts = _unique_rows(X)
+        Z_imp = self._fit_covariance(X, threshold, max_iter, max_workers, num_ord_updates, batch_size, batch_c, verbose, seed, 
+                                     rows=rows, weights=counts, **kwargs)
+        return Z_imp[inverse]
+
+    def transform(self, X, num_ord_updates=1, max_workers=1, seed=1, target_columns=None):
+        """
+        Imputes the missing entries of new data points X from the fitted model, without updating it. 
+        The stored marginals and copula correlation are used as they are and no EM iteration is run: 
+        the latent ordinals are re-estimated num_ord_updates times and the missing entries are set to their conditional means.
+
+        Args:
+            X (matrix): data matrix with entries to be imputed, with the same columns as the data the model was fitted on
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals
+            max_workers (positive int): the maximum number of workers for parallelism
+            seed: the seed for the initialization of the latent ordinals
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute. Only the conditional means 
+                of the missing entries of these columns are computed, and the other missing entries are left missing
+        Returns:
+            X_imp (matrix): X with missing values imputed
+        """
+        targets, latent_targets = self._target_masks(target_columns, X.shape[1])
+        Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, np.random.default_rng(seed))
+        Z_cont = self.transform_function.partial_evaluate_cont_latent(X)
+        Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        if max_workers == 1:
+            _, Z_imp, _ = _em_step_body(Z, Z_ord_lower, Z_ord_upper, self.sigma, num_ord_updates, targets=latent_targets)
+        else:
+            _, Z_imp, _ = self._em_step_parallel(Z, Z_ord_lower, Z_ord_upper, self.sigma, max_workers, num_ord_updates, targets=latent_targets)
         # Rearrange Z_imp so that it's columns correspond to the columns of X
+        _order = self.back_to_original_order()
         Z_imp_rearranged = Z_imp[:,_order]
         X_imp = np.empty(X.shape)
-        if np.sum(self.cont_indices) > 0:
-            X_imp[:,self.cont_indices] = self.transform_function.impute_cont_observed(Z_imp_rearranged)
-        if np.sum(self.ord_indices) >0:
-            X_imp[:,self.ord_indices] = self.transform_function.impute_ord_observed(Z_imp_rearranged)
-        sigma_rearranged = self.sigma[np.ix_(_order, _order)]
+        X_imp[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X, targets)
+        X_imp[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X, targets)
+        return X_imp
+
+    def add_columns(self, X_new, X=None, var_types=None, threshold=0.01, max_iter=50, num_ord_updates=1, verbose=False, seed=1):
+        """
+        Extends a model fitted by impute_missing, fit or impute_missing_chunked by new columns X_new of the same rows, without a full refit.
+        The marginals of the new columns are estimated and appended after the existing ones, and only the new rows and columns 
+        of sigma are estimated by EM, with the existing block of sigma held fixed: the existing latent values are imputed once 
+        by an E-step of the fitted model, and each iteration then costs O(n p q) for q new columns, see _fit_new_columns.
+        The new columns come after the existing ones in the original variable order.
+
+        Args:
+            X_new (matrix): the new columns, with one row per row of the data the model was fitted on, in the same order
+            X (matrix or None): the data the model was fitted on, needed if the model does not keep it (impute_missing_chunked)
+            var_types (dict or None): 'cont' and 'ord' over the new columns, detected from max_ord if None
+            threshold (float): the threshold for scaled difference between estimates of the new columns of sigma at which to stop early
+            max_iter (int): the maximum number of iterations
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals per iteration
+            seed: the seed for the initialization of the latent ordinals
+        Returns:
+            self
+        """
+        if self.sigma is None or not isinstance(getattr(self, 'transform_function', None), TransformFunction):
+            raise ValueError('add_columns extends a model fitted by impute_missing, fit or impute_missing_chunked')
+        if X is None:
+            X = self.transform_function.X
+            if X is None:
+                raise ValueError('The model does not keep the data it was fitted on, which must then be passed as X')
+        X_new = np.asarray(X_new)
+        if X_new.ndim == 1:
+            X_new = X_new[:, np.newaxis]
+        if X_new.shape[0] != X.shape[0] or X.shape[0] != self.transform_function.n:
+            raise ValueError(f'The new columns must have one row per row of the data, {self.transform_function.n}, got {X_new.shape[0]}')
+        if var_types is not None:
+            if not all(var_types['cont'] ^ var_types['ord']):
+                raise ValueError('Inconcistent specification of variable types indexing')
+            cont_new = np.asarray(var_types['cont'], dtype=bool)
+        else:
+            cont_new = self.get_cont_indices(X_new, self.max_ord)
+        rng = np.random.default_rng(seed)
+        # the latent values of the existing columns are imputed once, by the fitted model
+        Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, rng)
+        Z = np.concatenate((Z_ord, self.transform_function.partial_evaluate_cont_latent(X)), axis=1)
+        C, Z_imp, _ = _em_step_body(Z, Z_ord_lower, Z_ord_upper, self.sigma, num_ord_updates)
+        new_transform_function = TransformFunction(X_new, cont_new, ~cont_new, dtype=self.dtype)
+        W_ord_lower, W_ord_upper = new_transform_function.get_ord_latent()
+        W_ord = self._init_Z_ord(W_ord_lower, W_ord_upper, rng)
+        W = np.concatenate((W_ord, new_transform_function.get_cont_latent()), axis=1)
+        sigma = self._fit_new_columns(Z_imp, C, W, W_ord_lower, W_ord_upper, threshold, max_iter, num_ord_updates, verbose)
+        # from the latent order of the existing columns followed by the new ones, to ordinals first
+        p, k = Z.shape[1], Z_ord.shape[1]
+        q, l = W.shape[1], W_ord.shape[1]
+        order = np.concatenate((np.arange(k), p + np.arange(l), np.arange(k, p), np.arange(p+l, p+q)))
+        self.sigma = sigma[np.ix_(order, order)]
+        self.cont_indices = np.concatenate((self.cont_indices, cont_new))
+        self.ord_indices = ~self.cont_indices
+        self.transform_function.add_columns(new_transform_function)
+        return self
+
+    def _fit_new_columns(self, Z, C, W, r_lower, r_upper, threshold=0.01, max_iter=50, num_ord_updates=1, verbose=False):
+        """
+        EM for the new rows and columns of sigma, with its existing block S held fixed. The new latent values w are regressed 
+        on the existing ones z, w = B^T z + e with e of covariance Psi independent of z, so that sigma has the blocks S, S B and B^T S B + Psi.
+        z is only known through its conditional mean z_hat given the observed entries, of conditional covariance V = C/n on average, 
+        so that w given z_hat has mean B^T z_hat and covariance Psi + B^T V B, under which the new latent values are imputed at the E-step.
+        The M-step regresses the imputed new values on z_hat, and the result is projected to a correlation matrix, 
+        which scales the new rows and columns only since the diagonal of S is one. S and the Gram matrix of z_hat are factored once.
+
+        Args:
+            Z (matrix): the conditional means of the existing latent values, ordinals first
+            C (matrix): the sum over the rows of the conditional covariances of the existing latent values
+            W (matrix): the new latent values, ordinals first
+            r_lower, r_upper (matrix): the bounds of the new latent ordinals
+        Returns:
+            sigma (matrix): the correlation of the existing latent columns followed by the new ones
+        """
+        n, p = Z.shape
+        q, k = W.shape[1], r_lower.shape[1]
+        S = np.asarray(self.sigma, dtype=np.float64)
+        S_factor = cho_factor(S)
+        V = C/n
+        G_factor = cho_factor(np.dot(Z.T, Z)/n)
+        W_imp = np.where(np.isnan(W), 0, W)
+        C_new = np.zeros((q, q))
+        sigma = None
+        for i in range(max_iter):
+            # M-step: the residual covariance given z_hat is Psi + B^T V B
+            H = np.dot(Z.T, W_imp)/n
+            B = cho_solve(G_factor, H)
+            Psi = (np.dot(W_imp.T, W_imp) + C_new)/n - np.dot(H.T, B) - np.linalg.multi_dot((B.T, V, B))
+            eigenvalues, eigenvectors = np.linalg.eigh((Psi + Psi.T)/2)
+            Psi = np.dot(eigenvectors * np.maximum(eigenvalues, 1e-6), eigenvectors.T)
+            S12 = np.dot(S, B)
+            covariance = np.block([[S, S12], [S12.T, np.dot(B.T, S12) + Psi]])
+            prev_sigma, sigma = sigma, self._project_to_correlation(covariance)
+            if prev_sigma is not None:
+                err = self._get_scaled_diff(prev_sigma[p:], sigma[p:])
+                if verbose: print(f'Iter {i+1}: change of the new columns {err:.4f}')
+                if err < threshold:
+                    break
+            # E-step: the residuals of the new latent values given z_hat
+            B = cho_solve(S_factor, sigma[:p, p:])
+            Psi = sigma[p:, p:] - np.dot(sigma[p:, :p], B) + np.linalg.multi_dot((B.T, V, B))
+            M = np.dot(Z, B).astype(W.dtype, copy=False)
+            C_new, R_imp, R = _em_step_body(W - M, r_lower - M[:, :k], r_upper - M[:, :k], Psi.astype(self.sigma_dtype, copy=False), num_ord_updates)
+            W = R + M
+            W_imp = R_imp + M
+        return sigma
+
+    def _target_masks(self, target_columns, p):
+        """
+        Returns the boolean mask of target_columns, given as column indices or as a boolean mask, over the p columns of X, 
+        and the same mask over the latent columns (ordinals first). Both are None if target_columns is None
+        """
+        if target_columns is None:
+            return None, None
+        target_columns = np.asarray(target_columns)
+        if target_columns.dtype == bool:
+            if target_columns.shape != (p,):
+                raise ValueError(f'target_columns as a boolean mask must have one entry per column, {p}, got shape {target_columns.shape}')
+            targets = target_columns
+        else:
+            targets = np.zeros(p, dtype=bool)
+            targets[target_columns] = True
+        return targets, np.concatenate((targets[self.ord_indices], targets[self.cont_indices]))
+
+    def _set_var_types(self, X):
+        """
+        Detects the continuous and ordinal columns of X from max_ord, unless they are already set
+        """
+        if self.cont_indices is None:
+            self.cont_indices = self.get_cont_indices(X, self.max_ord)
+            self.ord_indices = ~self.cont_indices
+
+    @contextmanager
+    def _memory_planned(self, memory_limit, estimate, max_chunk_size, max_workers, hint=None):
+        """
+        Plans the fit run in the block within memory_limit, see MemoryPlan.choose, keeps the plan in memory_plan and traces the memory of its phases within trace_memory.
+        Yields the number of workers to use, max_workers if memory_limit is None
+        """
+        if memory_limit is None:
+            self.memory_plan = None
+            yield max_workers
+            return
+        if hint is None:
+            hint = ('impute_missing_chunked keeps the data and the latent values out of memory, '
+                    'and LowRankExpectationMaximization needs memory linear in the number of columns.')
+        self.memory_plan = MemoryPlan.choose(memory_limit, estimate, max_chunk_size, max_workers, hint=hint)
+        with self.memory_plan.trace():
+            yield self.memory_plan.max_workers
 
+    def _memory_phase(self, name):
+        """
+        Starts the phase name of the memory plan, if any
+        """
+        if self.memory_plan is not None:
+            self.memory_plan.phase(name)
+
+    def _row_chunk_size(self, default=None):
+        """
+        The number of rows processed at once, from the memory plan if any and default otherwise
+        """
+        return default if self.memory_plan is None else self.memory_plan.chunk_size
+
+    def _memory_estimate(self, shape, chunk_size, max_workers, impute=True, batch_size=None):
+        """
+        The planned peak memory of each phase of impute_missing (or of fit if not impute) for a data matrix of the provided shape, 
+        as (bytes of this process, bytes of the worker pool), for MemoryPlan. 
+        Each term is the size of an array of the fit, from its shape and dtype, or the temporaries of a numpy or scipy kernel 
+        per element (see memory_plan). The arrays kept by a phase are counted in the later phases, 
+        and the temporaries of the chunked parts are proportional to the rows of a chunk. 
+        An EM iteration runs on batch_size rows if provided (mini-batch EM)
+        """
+        n, p = shape
+        k = int(np.sum(self.ord_indices))
+        b = self.dtype.itemsize
+        s = np.dtype(self.sigma_dtype).itemsize
+        m = n if batch_size is None else min(batch_size, n)
+        chunk_size = min(chunk_size, m)
+        marginals, marginals_peak = self._marginals_memory(n, p, k)
+        latent, latent_peak = self._latent_memory(n, p, k, chunk_size)
+        # Z_imp, then either its missing mask or its copy by np.corrcoef, and then Z
+        latent_peak = max(latent_peak, latent + b*n*p + max(n*p, b*n*p))
+        latent += 2*b*n*p
+        # sigma, in dtype and then in sigma_dtype
+        latent += (b + s)*p*p
+        phases = {'marginals': (marginals + marginals_peak, 0), 
+                  'latent': (marginals + latent_peak + (b + s)*p*p, 0)}
+        # the permutation of the rows and the previous sigma, 
+        # and in mini-batch EM the indices of a batch and the copies of its rows of Z and of the bounds
+        kept = marginals + latent + 8*n + s*p*p
+        if batch_size is not None:
+            kept += 8*m + b*m*(p + 2*k)
+        process, pool = self._em_step_memory(m, p, k, chunk_size, max_workers)
+        phases['em'] = (kept + process, pool)
+        if impute:
+            # Z_imp and X_imp, and the temporaries of a chunk of rows transformed back
+            chunk_size = min(chunk_size, n)
+            phases['impute'] = (marginals + b*n*p + 8*n*p + self._transform_back_memory(chunk_size, p, k), 0)
+        return phases
+
+    def _memory_estimate_online(self, shape, chunk_size, max_workers, batch_size, window_size):
+        """
+        The planned peak memory of each phase of a batch of impute_missing_online for a data matrix of the provided shape, see _memory_estimate. 
+        The marginals are the window of each column and its sorted copy, and the imputed data of all rows is kept through the fit, 
+        together with the copy of the batch, the imputed previous batch, and the published snapshot. 
+        The latent values of a batch are kept until it is transformed back
+        """
+        n, p = shape
+        k = int(np.sum(self.ord_indices))
+        b = self.dtype.itemsize
+        s = np.dtype(self.sigma_dtype).itemsize
+        m = min(batch_size, n)
+        w = window_size
+        chunk_size = min(chunk_size, m)
+        # the imputed data, float64, the window of each column and its sorted copy, sigma, 
+        # the indices and the copy of the rows of a batch, the imputed previous batch, 
+        # and the snapshot, with its copies of the sorted windows, sigma and its precision, twice while a new one replaces the previous one
+        kept = 8*n*p + 2*8*w*p + s*p*p + 8*m + 2*8*m*p + 2*(8*w*p + 2*s*p*p) + _FIXED_BYTES
+        # the first batch initializes the windows: the float64 copy of its continuous columns and the temporaries of np.nanstd 
+        # (the copy, its missing mask, the deviations and their squares), the random windows and their sorted copy
+        first = 8*m*p + 3*8*m*p + m*p + 2*8*w*p
+        # a column of a batch updates its window: its missing mask, its observed values, their positions in the window and the values they evict. 
+        # The evicted values are removed from the sorted window by _replace_sorted, from their sorted copy and three integer arrays 
+        # of positions, and the sorted new values are inserted at their positions in a copy of the window without them
+        column = m*(1 + 8 + 8 + 8) + m*(8 + 3*8 + 8 + 8) + 2*8*w
+        phases = {'marginals': (kept + max(first, column), 0)}
+        # the lower and upper bounds of the latent ordinals
+        bounds = 2*b*m*k
+        # the float64 copy of the ordinal columns and of their windows, the bounds, and for a column its missing mask and its negation, 
+        # its observed values and the empirical CDF at the lower bound, the lower bound and the norm.ppf temporaries at the upper bound
+        bounds_peak = 8*(m + w)*k + bounds + m*(2 + 8 + 2*8 + 8 + _PPF_BYTES) if k > 0 else 0
+        # the latent ordinals drawn, see _latent_memory
+        draws_peak = bounds + b*m*k + chunk_size*k*(3 + 2*8 + 1 + 8 + _PPF_BYTES)
+        # the latent continuous values
+        cont = b*m*(p - k)
+        # the float64 copy of the continuous columns and of their windows, the values, and for a column its missing mask and its negation, 
+        # its observed values, their empirical CDF and its zero mask, and the norm.ppf temporaries
+        cont_peak = bounds + b*m*k + 8*(m + w)*(p - k) + cont + m*(2 + 8 + 2*8 + 1 + _PPF_BYTES) if k < p else 0
+        # Z, concatenated from the ordinals and the continuous values
+        latent = bounds + b*m*k + cont + b*m*p
+        phases['latent'] = (kept + max(bounds_peak, draws_peak, cont_peak, latent), 0)
+        # the new sigma and its blend with the previous one
+        process, pool = self._em_step_memory(m, p, k, chunk_size, max_workers)
+        phases['em'] = (kept + latent + process + 2*s*p*p, pool)
+        # Z_imp of the batch and X_imp, and the temporaries of the batch transformed back, 
+        # with the copies of the sorted windows and of the continuous or ordinal columns of the batch
+        phases['impute'] = (kept + latent + b*m*p + 8*m*p + self._transform_back_memory(m, p, k) + 8*(w + m)*max(k, p - k), 0)
+        return phases
+
+    def _marginals_memory(self, n, p, k):
+        """
+        The memory kept by the marginals of a data matrix with n rows and p columns, k of them ordinal, and the peak of their temporaries
+        """
+        # the sorted observed values of each column, at most n float64 each, and their array objects
+        kept = 8*n*p + _ARRAY_BYTES*p + _FIXED_BYTES
+        # while a column is sorted: its missing mask and its negation, and its observed values. 
+        # The level spacing of an ordinal column then takes the differences of its sorted values and their positive mask, 
+        # and then its distinct levels and the differences between them
+        peak = max(n*(2 + 8), n*(8 + 1 + 8 + 8) if k > 0 else 0)
+        return kept, peak
+
+    def _latent_memory(self, n, p, k, chunk_size):
+        """
+        The memory kept by the latent ordinal bounds, the latent continuous values and the latent ordinals drawn 
+        for a data matrix with n rows and p columns, k of them ordinal, and the peak of their temporaries
+        """
+        b = self.dtype.itemsize
+        # the lower and upper bounds of the latent ordinals
+        bounds = 2*b*n*k
+        # the float64 copy of the ordinal columns of X and the bounds, and for a column its missing mask, 
+        # its shifted values, their empirical CDF and the norm.ppf temporaries
+        bounds_peak = 8*n*k + bounds + n*(1 + 8 + 8 + _PPF_BYTES) if k > 0 else 0
+        # the latent continuous values
+        cont = b*n*(p - k)
+        # the float64 copy of the continuous columns of X and the values, and for a column its missing mask, 
+        # its empirical CDF, its quantiles and their zero mask, and the norm.ppf temporaries
+        cont_peak = bounds + 8*n*(p - k) + cont + n*(1 + 8 + 8 + 1 + _PPF_BYTES) if k < p else 0
+        # the latent ordinals, and for a chunk of rows the missing masks of the bounds and their observed mask, 
+        # the float64 CDF at the bounds, the mask of intervals of positive probability, the uniform draws and the norm.ppf temporaries
+        draws_peak = bounds + cont + b*n*k + chunk_size*k*(3 + 2*8 + 1 + 8 + _PPF_BYTES)
+        return bounds + cont + b*n*k, max(bounds_peak, cont_peak, draws_peak)
+
+    def _em_step_memory(self, m, p, k, chunk_size, max_workers):
+        """
+        The peak memory of the temporaries of _em_step on m rows with p columns, k of them ordinal, 
+        as (bytes of this process, bytes of the worker pool)
+        """
+        b = self.dtype.itemsize
+        s = np.dtype(self.sigma_dtype).itemsize
+        # the new sigma and its projection to a correlation
+        sigma = 8*p*p + 2*s*p*p
+        if max_workers == 1:
+            # the new Z_imp, built by the E-step of all rows or filled by the E-step of each chunk
+            e_step = self._e_step_memory(chunk_size, p, k) + (b*m*p if chunk_size < m else 0)
+            # the covariance of Z_imp from the copy made by np.cov, or from its float64 weighted chunks and the float64 row weights
+            covariance = b*m*p + (b*m*p if chunk_size >= m else 8*m + 8*chunk_size*p)
+            return max(e_step, covariance) + sigma, 0
+        # the missing mask of Z and its grouping by pattern, the order of the rows, and the copy of Z or of a bound in that order, 
+        # then the new Z_imp and its copy by np.cov, with the conditional covariance terms sent back by each worker
+        process = 8*m + max(m*p + self._pattern_memory(m, p), b*m*p) + 2*b*m*p + 8*p*p*max_workers + sigma
+        # the shared Z, bounds, Z_imp and sigma, and for each worker its process and the E-step temporaries of its rows
+        pool = b*m*(2*p + 2*k) + s*p*p + max_workers*(_WORKER_BYTES + self._e_step_memory(-(-m // max_workers), p, k))
+        return process, pool
+
+    def _pattern_memory(self, rows, p):
+        """
+        The peak memory of the temporaries of embody._group_by_pattern on rows rows with p columns
+        """
+        # the packed missing masks and their sorted copy, the mask of first occurrences, the sort permutation, 
+        # the inverse and the order of the rows, and for each pattern its count, their cumulative sum and the array object of its group
+        return rows*(2*(-(-p // 8)) + 1 + 3*8) + self._num_patterns(rows, p)*(2*8 + _ARRAY_BYTES)
+
+    def _num_patterns(self, rows, p):
+        """
+        The largest number of missingness patterns among rows rows with p columns
+        """
+        return rows if p >= 62 else min(rows, 2**p)
+
+    def _e_step_memory(self, rows, p, k):
+        """
+        The peak memory of the temporaries of embody._em_step_body on rows rows with p columns, k of them ordinal. 
+        A group of rows sharing a missingness pattern may hold all the rows
+        """
+        b = self.dtype.itemsize
+        # Z_imp, the missing mask and its copy at the incomplete rows, the masks of complete and incomplete rows, and their indices
+        body = rows*(b*p + 2*p + 2 + 2*8)
+        # the rows of each group, with a slot in the list and an array object per pattern
+        groups = 8*rows + self._num_patterns(rows, p)*(8 + _ARRAY_BYTES)
+        # for the rows of a group: the copies of their latent values and bounds, Z_imp of the group, the weights, 
+        # the variances of the observed ordinals and the latent rows with zeros at the missing entries
+        group = rows*(b*(p + 2*k) + b*p + 8 + 8*k + b*p)
+        # the update of the observed ordinals: the copies of their bounds and values, their products with the inverse, 
+        # the float64 conditional means and standardized bounds, the truncated normal temporaries and the masks of finite moments
+        ordinals = rows*k*(4*b + 3*8 + _TRUNCNORM_BYTES + 2)
+        # the imputation of the missing entries: the observed values and their products with the conditional regression
+        imputed = rows*2*b*p
+        # C, the precision and its factorization, and the blocks of sigma or of the precision for a pattern, 
+        # at most p by p float64 each
+        blocks = 8*8*p*p
+        return body + max(self._pattern_memory(rows, p) + groups, groups + group + max(ordinals, imputed)) + blocks + _FIXED_BYTES
+
+    def _transform_back_memory(self, rows, p, k):
+        """
+        The peak memory of the temporaries of transforming back rows rows of Z_imp with p columns, k of them ordinal
+        """
+        b = self.dtype.itemsize
+        # Z_imp with its columns in the original order, the copies of its continuous or ordinal columns and of those of X, 
+        # then either the gather of the columns of X that is copied, or for a column its missing mask, 
+        # its latent values at the missing entries, the norm.cdf temporaries and the float64 temporaries of the quantiles (at most eight at once)
+        columns = max(k, p - k)
+        return b*rows*p + (b + 8)*rows*columns + max(8*rows*columns, rows*(1 + b + _CDF_BYTES + 8*8)) + _FIXED_BYTES
+
+    def impute_missing_chunked(self, X, out=None, chunk_size=10000, 
+                               threshold=0.01, max_iter=50, max_workers=1, num_ord_updates=1, 
+                               scratch_dir=None, verbose=False, seed=1):
+        """
+        Fits a Gaussian Copula and imputes missing values in X without holding X in memory, for tables larger than RAM.
+        X is read in row chunks at each EM iteration: the sufficient statistics of the correlation update (the sums of the imputed 
+        latent values, of their outer products and of the conditional covariance terms) are accumulated chunk by chunk, 
+        The marginals (the sorted observed values of each column) are sorted out of core in a memory-mapped scratch file, 
+        and the latent ordinals are kept in another one between iterations, so that memory use is bounded by a few chunks. 
+        Once the iterations stop, a last pass imputes each chunk with the final copula correlation and writes it into out.
+
+        Args:
+            X: a path to a .npy file, which is memory-mapped, an array supporting row slicing such as a np.memmap, 
+                or a callable returning a new iterable over the row chunks of the data, always in the same order, each time it is called
+            out: None, a path of a .npy file to create, or an array of the shape of X to write the imputed data into. 
+                If None, the imputed data is returned as an in-memory float64 array of the shape of X, which must then fit in memory: 
+                pass a path for tables larger than memory
+            chunk_size (positive int): the number of rows read at once when X is a path or an array
+            threshold (float): the threshold for scaled difference between covariance estimates at which to stop early
+            max_iter (int): the maximum number of iterations for copula estimation
+            max_workers: the maximum number of workers for parallelism, applied within each chunk
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals per iteration
+            scratch_dir: the directory of the scratch files holding the marginals and the latent ordinals. The default temporary directory if None
+        Returns:
+            X_imp (matrix): out, with X with missing values imputed
+            sigma_rearragned (matrix): an estimate of the covariance of the copula
+        """
+        read_chunks = self._chunk_reader(X, chunk_size)
+        sorted_columns, n = _sorted_columns_from_chunks(read_chunks, scratch_dir)
+        p = len(sorted_columns)
+        if self.cont_indices is None:
+            # same rule as get_cont_indices, counting the distinct values of the sorted columns
+            self.cont_indices = np.array([len(col) > 0 and np.count_nonzero(np.diff(col)) + 1 > self.max_ord for col in sorted_columns])
+            self.ord_indices = ~self.cont_indices
+        self.transform_function = TransformFunction.from_sorted_columns(sorted_columns, n, self.cont_indices, self.ord_indices, dtype=self.dtype)
+        del sorted_columns
+
+        if out is None:
+            X_imp = np.empty((n,p))
+        elif isinstance(out, (str, os.PathLike)):
+            X_imp = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(n,p))
+        else:
+            X_imp = out
+        k = int(np.sum(self.ord_indices))
+        with tempfile.TemporaryFile(dir=scratch_dir) as scratch:
+            # latent ordinals, the only latent values that are not recomputed from X at each pass
+            Z_ord_store = np.memmap(scratch, dtype=self.dtype, mode='w+', shape=(n,k)) if k > 0 else np.empty((n,0), dtype=self.dtype)
+            rng = np.random.default_rng(seed)
+            sum_Z = np.zeros(p)
+            sum_ZZ = np.zeros((p,p))
+            start = 0
+            for X_chunk in read_chunks():
+                X_chunk = np.asarray(X_chunk, dtype=np.float64)
+                Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X_chunk)
+                Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, rng)
+                Z_ord_store[start:start+len(X_chunk)] = Z_ord
+                Z_imp = np.concatenate((Z_ord, self.transform_function.partial_evaluate_cont_latent(X_chunk)), axis=1)
+                # mean impute the missing continuous values for the sake of covariance estimation
+                Z_imp[np.isnan(Z_imp)] = 0.0
+                sum_Z += Z_imp.sum(axis=0)
+                sum_ZZ += Z_imp.T @ Z_imp
+                start += len(X_chunk)
+            # initialize the correlation matrix
+            if self.sigma is None:
+                self.sigma = self._project_to_correlation(sum_ZZ - np.outer(sum_Z, sum_Z)/n)
+
+            for i in range(max_iter):
+                prev_sigma = self.sigma
+                if np.isnan(prev_sigma).any():
+                    raise ValueError(f'Unexpected nan in updated sigma at iteration {i}')
+                self.sigma = self._em_pass_chunked(read_chunks, Z_ord_store, n, max_workers, num_ord_updates)
+                # stop early if the change in the correlation estimation is below the threshold
+                sigmaudpate = self._get_scaled_diff(prev_sigma, self.sigma)
+                if sigmaudpate < threshold:
+                    if verbose: 
+                        print('Convergence at iteration '+str(i+1))
+                    break
+                if verbose: 
+                    print("Copula correlation change ratio: ", np.round(sigmaudpate, 4))
+            if verbose and i == max_iter-1: 
+                print("Convergence not achieved at maximum iterations")
+
+            self._em_pass_chunked(read_chunks, Z_ord_store, n, max_workers, num_ord_updates, X_imp)
+            del Z_ord_store
+        if isinstance(X_imp, np.memmap):
+            X_imp.flush()
+        _order = self.back_to_original_order()
+        sigma_rearranged = self.sigma[np.ix_(_order, _order)]
         return {'imputed_data':X_imp, 'copula_corr':sigma_rearranged}
 
+    def _em_pass_chunked(self, read_chunks, Z_ord_store, n, max_workers=1, num_ord_updates=1, X_imp=None):
+        """
+        Executes one step of the EM algorithm over the row chunks of the data. The latent ordinals in Z_ord_store are updated in place 
+        and the imputed latent values only enter the sums from which the covariance is computed, as in np.cov.
+
+        Args:
+            read_chunks (callable): returns a new iterable over the row chunks of the data
+            Z_ord_store (matrix): the latent ordinals of all rows
+            n (int): the number of rows of the data
+            X_imp (matrix or None): if provided, the imputed data is written into it
+        Returns:
+            sigma (matrix): an estimate of the covariance of the copula
+        """
+        p = self.sigma.shape[0]
+        k = Z_ord_store.shape[1]
+        if max_workers is None: 
+            max_workers = min(32, os.cpu_count()+4)
+        sum_Z = np.zeros(p)
+        sum_ZZ = np.zeros((p,p))
+        C = np.zeros((p,p))
+        start = 0
+        for X_chunk in read_chunks():
+            X_chunk = np.asarray(X_chunk, dtype=np.float64)
+            stop = start + len(X_chunk)
+            Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X_chunk)
+            Z_cont = self.transform_function.partial_evaluate_cont_latent(X_chunk)
+            Z = np.concatenate((Z_ord_store[start:stop], Z_cont), axis=1)
+            if max_workers == 1:
+                C_chunk, Z_imp, Z = _em_step_body(Z, Z_ord_lower, Z_ord_upper, self.sigma, num_ord_updates)
+            else:
+                C_chunk, Z_imp, Z = self._em_step_parallel(Z, Z_ord_lower, Z_ord_upper, self.sigma, max_workers, num_ord_updates)
+            Z_ord_store[start:stop] = Z[:,:k]
+            C += C_chunk
+            sum_Z += Z_imp.sum(axis=0)
+            sum_ZZ += Z_imp.T @ Z_imp
+            if X_imp is not None:
+                Z_imp_rearranged = Z_imp[:,self.back_to_original_order()]
+                X_imp_chunk = np.empty(X_chunk.shape)
+                X_imp_chunk[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X_chunk)
+                X_imp_chunk[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X_chunk)
+                X_imp[start:stop] = X_imp_chunk
+            start = stop
+        sigma = (sum_ZZ - np.outer(sum_Z, sum_Z)/n)/(n-1) + C/n
+        return self._project_to_correlation(sigma)
+
+    def _chunk_reader(self, X, chunk_size):
+        """
+        Returns a callable that returns a new iterable over the row chunks of X each time it is called. 
+        X is either such a callable, a path to a .npy file that is memory-mapped, or an array supporting row slicing
+        """
+        if callable(X):
+            return X
+        if isinstance(X, (str, os.PathLike)):
+            X = np.load(X, mmap_mode='r')
+        return lambda: (X[start:start+chunk_size] for start in range(0, X.shape[0], chunk_size))
+
 
     def _fit_covariance(self, X, 
                         threshold=0.01, max_iter=100, max_workers=4, num_ord_updates=1, 
                         batch_size=100, batch_c=0, 
-                        verbose=False, seed=1):
+                        verbose=False, seed=1, 
+                        active_tol=None, active_check=10, active_refresh=0.05, 
+                        rows=None, weights=None):
         """
         Fits the covariance matrix of the gaussian copula using the data 
         in X and returns the imputed latent values corresponding to 
@@ -113,29 +742,47 @@ class ExpectationMaximization():
             threshold (float): the threshold for scaled difference between covariance estimates at which to stop early
             max_iter (int): the maximum number of iterations for copula estimation
             max_workers (positive int): the maximum number of workers for parallelism 
+            active_tol (float or None): if not None, standard EM skips converged rows. A row whose imputed latent values changed 
+                by less than active_tol (in max norm) at the last iteration is updated once more, its contributions to the covariance 
+                are cached, and it is frozen: later iterations reuse these contributions instead of updating the row
+            active_check (positive int): all rows are updated again, and may be frozen again, every active_check iterations
+            active_refresh (float): all rows are also updated again when the scaled difference between sigma and its value 
+                at the last such refresh exceeds active_refresh
+            rows (array or None): if provided, only these rows of X are fitted
+            weights (array or None): the number of times each fitted row is counted, such as its number of duplicates in X
 
         Returns:
             sigma (matrix): an estimate of the covariance of the copula
-            Z_imp (matrix): estimates of latent values
+            Z_imp (matrix): estimates of latent values, of the fitted rows
         """
-        n,p = X.shape
+        self._memory_phase('latent')
         Z_ord_lower, Z_ord_upper = self.transform_function.get_ord_latent()
-        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, seed)
         Z_cont = self.transform_function.get_cont_latent()
+        if rows is not None:
+            Z_ord_lower, Z_ord_upper, Z_cont = Z_ord_lower[rows], Z_ord_upper[rows], Z_cont[rows]
+        n,p = len(Z_cont), X.shape[1]
+        rng = np.random.default_rng(seed)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, rng, self._row_chunk_size())
 
         Z_imp = np.concatenate((Z_ord,Z_cont), axis=1)
         # mean impute the missing continuous values for the sake of covariance estimation
         Z_imp[np.isnan(Z_imp)] = 0.0
         # initialize the correlation matrix
-        sigma = np.corrcoef(Z_imp, rowvar=False)
-        if self.sigma is None:
-            self.sigma = np.corrcoef(Z_imp, rowvar=False)
+        if self.sigma is None and weights is None:
+            self.sigma = np.corrcoef(Z_imp, rowvar=False, dtype=Z_imp.dtype).astype(self.sigma_dtype)
+        elif self.sigma is None:
+            cov = np.cov(Z_imp, rowvar=False, fweights=weights, dtype=Z_imp.dtype)
+            std = np.sqrt(np.diag(cov))
+            self.sigma = (cov / np.outer(std, std)).astype(self.sigma_dtype)
         # Latent variable matrix with columns sorted as ordinal, continuous
         Z = np.concatenate((Z_ord, Z_cont), axis=1)
             
 
         # permutation of indices of data for stochastic fitting
-        training_permutation = np.random.permutation(n)
+        training_permutation = rng.permutation(n)
+        if active_tol is not None and batch_c <= 0:
+            active_set = _ActiveSet(n, p, active_check, active_refresh)
+        self._memory_phase('em')
         for i in range(max_iter):
             # track previous sigma for the purpose of early stopping
             prev_sigma = self.sigma
@@ -151,14 +798,18 @@ class ExpectationMaximization():
                     indices = np.concatenate((training_permutation[batch_lower:], training_permutation[:batch_upper]))
                 else:
                     indices = training_permutation[batch_lower:batch_upper]
-                sigma, Z_imp_batch, Z_batch = self._em_step(Z[indices], Z_ord_lower[indices], Z_ord_upper[indices], max_workers, num_ord_updates)
+                batch_weights = None if weights is None else weights[indices]
+                sigma, Z_imp_batch, Z_batch = self._em_step(Z[indices], Z_ord_lower[indices], Z_ord_upper[indices], max_workers, num_ord_updates, batch_weights)
                 Z_imp[indices] = Z_imp_batch
                 Z[indices] = Z_batch
                 decay_coef = batch_c/(i + 1 + batch_c)
                 self.sigma = sigma*decay_coef + (1 - decay_coef)*prev_sigma
+            # active-set EM: converged rows are frozen and their cached contributions reused
+            elif active_tol is not None:
+                self.sigma = self._em_step_active(Z, Z_imp, Z_ord_lower, Z_ord_upper, active_set, active_tol, i, max_workers, num_ord_updates, weights)
             # standard EM: each iteration uses all data points
             else:
-                sigma, Z_imp, Z = self._em_step(Z, Z_ord_lower, Z_ord_upper, max_workers, num_ord_updates)
+                sigma, Z_imp, Z = self._em_step(Z, Z_ord_lower, Z_ord_upper, max_workers, num_ord_updates, weights)
                 #print(f"at iteration {i}, sigma has {np.isnan(sigma).sum()} nan entries, Z_imp has {np.isnan(Z_imp).sum()} nan entries")
                 self.sigma = sigma
             # stop early if the change in the correlation estimation is below the threshold
@@ -177,7 +828,7 @@ class ExpectationMaximization():
     def impute_missing_online(self, X, 
                               threshold=0.01, max_workers=1, num_ord_updates=1, 
                               batch_size=100, batch_c=0, window_size=200, const_decay = -1, 
-                              verbose=False, seed=1, sigma_diff=['F']):
+                              verbose=False, seed=1, sigma_diff=['F'], memory_limit=None):
         """
         Fit the Gaussian copula model at each new batch of data points. If the provided X is not an iterable but a numpy array, 
         an iterable will be constructed by sequentially iterating over X using the specified batch size. To take mutiple passes 
@@ -192,42 +843,46 @@ class ExpectationMaximization():
             max_workers: the maximum number of workers for parallelism
             max_ord: maximum number of levels in any ordinal for detection of ordinal indices
             sigma_diff: A subset of ['F', 'S', 'N']. 'F' for Frobenius norm, 'S' for spectral norm and 'N' for nuclear norm. 
+            memory_limit (int, str or None): the memory budget of the fit, see impute_missing. The phases of the plan are those of a batch, 
+                and their observed peaks are the largest over the batches
         Returns:
             X_imp (matrix): X with missing values imputed
             sigma_rearragned (matrix): an estimate of the covariance of the copula
         """
         assert self.cont_indices is not None and self.ord_indices is not None, 'Variable types must be provided for online fit'
-        self.transform_function = OnlineTransformFunction(self.cont_indices, self.ord_indices, window_size=window_size)
+        self.transform_function = OnlineTransformFunction(self.cont_indices, self.ord_indices, window_size=window_size, dtype=self.dtype)
         n,p = X.shape
-        X_imp = np.zeros_like(X)
         if self.sigma is None:
-            self.sigma = np.identity(p)
+            self.sigma = np.identity(p, dtype=self.sigma_dtype)
         sigma_diff_output = defaultdict(list)
 
-        i=0
-        while True:
-            batch_lower= i*batch_size
-            batch_upper=min((i+1)*batch_size, n)
-            if batch_lower>= n:
-                break 
-            indices = np.arange(batch_lower, batch_upper, 1)
-            decay_coef = const_decay if 0<const_decay<1 else batch_c/(i + 1 + batch_c)
-            out = self.partial_fit_and_predict(X[indices,:], max_workers=max_workers, decay_coef=decay_coef, num_ord_updates=num_ord_updates, sigma_diff=sigma_diff)
-            X_imp[indices,:] = out['imputed']
-            for k,v in out['sigma_diff'].items():
-                sigma_diff_output[k].append(v)
-
-            i+=1
+        estimate = lambda chunk_size, workers: self._memory_estimate_online(X.shape, chunk_size, workers, batch_size, window_size)
+        hint = 'A smaller batch_size or window_size lowers the memory of each batch.'
+        with self._memory_planned(memory_limit, estimate, min(batch_size, n), max_workers, hint) as max_workers:
+            X_imp = np.zeros_like(X)
+            i=0
+            while True:
+                batch_lower= i*batch_size
+                batch_upper=min((i+1)*batch_size, n)
+                if batch_lower>= n:
+                    break 
+                indices = np.arange(batch_lower, batch_upper, 1)
+                decay_coef = const_decay if 0<const_decay<1 else batch_c/(i + 1 + batch_c)
+                out = self.partial_fit_and_predict(X[indices,:], max_workers=max_workers, decay_coef=decay_coef, num_ord_updates=num_ord_updates, sigma_diff=sigma_diff)
+                X_imp[indices,:] = out['imputed']
+                for k,v in out['sigma_diff'].items():
+                    sigma_diff_output[k].append(v)
+
+                i+=1
         _order = self.back_to_original_order()
         sigma_rearranged = self.sigma[np.ix_(_order, _order)]
         return {'imputed_data':X_imp, 'copula_corr':sigma_rearranged, 'copula_corr_change':sigma_diff_output}
 
-    # TO DO: add a function attribute which takes estimated model and new point as input to return immediate imputaiton
-    #  that would serve as out-of-sample prediction without updating the model parameter. Computation will be smaller but the complexity is still O(p^3)
     def partial_fit_and_predict(self, X_batch, max_workers=4, num_ord_updates=2, decay_coef=0.5, sigma_update=True, marginal_update = True, seed = 1, sigma_diff=None):
         """
         Updates the fit of the copula using the data in X_batch and returns the 
-        imputed values and the new correlation for the copula
+        imputed values and the new correlation for the copula.
+        The updated model is published as a new OnlineSnapshot in snapshot, before the batch is transformed back
 
         Args:
             X_batch (matrix): data matrix with entries to use to update copula and be imputed
@@ -241,6 +896,7 @@ class ExpectationMaximization():
         #if not update:
             #old_window = self.transform_function.window
             #old_update_pos = self.transform_function.update_pos
+        self._memory_phase('marginals')
         if marginal_update:
             self.transform_function.partial_fit(X_batch)
         # update marginals with the new batch
@@ -248,17 +904,23 @@ class ExpectationMaximization():
         # print("X_batch", X_batch)
         #
         # _fit_covariance step
+        self._memory_phase('latent')
         Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X_batch)
-        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, seed)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, np.random.default_rng(seed), self._row_chunk_size())
         Z_cont = self.transform_function.partial_evaluate_cont_latent(X_batch) 
         Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        self._memory_phase('em')
         sigma, Z_imp, Z = self._em_step(Z, Z_ord_lower, Z_ord_upper, max_workers, num_ord_updates)
         prev_sigma = self.sigma
         if sigma_update:
             self.sigma = sigma*decay_coef + (1-decay_coef)*self.sigma
 
         diff = None if sigma_diff is None else self.get_matrix_diff(prev_sigma, self.sigma, sigma_diff)
+        if self.snapshot is None or sigma_update or marginal_update:
+            # a single reference assignment, so that readers see either the previous version or this one
+            self.snapshot = OnlineSnapshot(self, 1 if self.snapshot is None else self.snapshot.version + 1)
 
+        self._memory_phase('impute')
         # rearrange sigma so it corresponds to the column ordering of X ## first few dims are always continuous, after always ordinal
         _order = self.back_to_original_order()
         Z_imp_rearranged = Z_imp[:,_order]
@@ -268,10 +930,11 @@ class ExpectationMaximization():
         return {'imputed':X_imp, 'sigma_diff':diff}
 
 
-    def _em_step(self, Z, r_lower, r_upper, max_workers=1, num_ord_updates=1):
+    def _em_step(self, Z, r_lower, r_upper, max_workers=1, num_ord_updates=1, weights=None):
         """
         Executes one step of the EM algorithm to update the covariance 
-        of the copula
+        of the copula. Within each worker, rows sharing a missingness pattern 
+        are processed together so that the observed block of sigma is factored once per pattern.
 
         Args:
             Z (matrix): Latent values
@@ -279,6 +942,7 @@ class ExpectationMaximization():
             r_upper (matrix): upper bound on latent ordinals
             sigma (matrix): correlation estimate
             max_workers (positive int): maximum number of workers for parallelism
+            weights (array or None): the number of times each row is counted
 
         Returns:
             sigma (matrix): an estimate of the covariance of the copula
@@ -288,37 +952,158 @@ class ExpectationMaximization():
         """
         n,p = Z.shape
         assert n>0, 'EM step receives empty input'
-        if max_workers ==1:
-            args = (Z, r_lower, r_upper, self.sigma, num_ord_updates)
-            C, Z_imp, Z = _em_step_body_(args)
-            C = C/n
+        C, Z_imp, Z = self._e_step_body(Z, r_lower, r_upper, max_workers, num_ord_updates, weights)
+        if weights is not None:
+            n = weights.sum()
+        C = C/n
+
+        chunk_size = self._row_chunk_size()
+        if chunk_size is None or chunk_size >= len(Z_imp):
+            sigma = np.cov(Z_imp, rowvar=False, dtype=Z_imp.dtype, fweights=weights) + C 
         else:
-            if max_workers is None: 
-                max_workers = min(32, os.cpu_count()+4)
-            divide = n/max_workers * np.arange(max_workers+1)
-            divide = divide.astype(int)
-            args = [(
-                    np.copy(Z[divide[i]:divide[i+1],:]), 
-                    r_lower[divide[i]:divide[i+1],:], 
-                    r_upper[divide[i]:divide[i+1],:], 
-                    self.sigma, num_ord_updates
-                    ) for i in range(max_workers)]
-            Z_imp = np.empty((n,p))
-            C = np.zeros((p,p))
-            with ProcessPoolExecutor(max_workers=max_workers) as pool: 
-                res = pool.map(_em_step_body_, args)
-                for i,(C_divide, Z_imp_divide, Z_divide) in enumerate(res):
-                    C += C_divide/n
-                    Z_imp[divide[i]:divide[i+1],:] = Z_imp_divide
-                    Z[divide[i]:divide[i+1],:] = Z_divide
-
-        sigma = np.cov(Z_imp, rowvar=False) + C 
+            # the sums of np.cov accumulated over row chunks, without centering a copy of Z_imp
+            row_weights = np.ones(len(Z_imp)) if weights is None else weights
+            sum_Z = np.dot(row_weights, Z_imp)
+            sum_ZZ = np.zeros((p,p))
+            for start in range(0, len(Z_imp), chunk_size):
+                Z_chunk = Z_imp[start:start+chunk_size]
+                sum_ZZ += np.dot(Z_chunk.T * row_weights[start:start+chunk_size], Z_chunk)
+            sigma = (sum_ZZ - np.outer(sum_Z, sum_Z)/n)/(n-1) + C
         sigma = self._project_to_correlation(sigma)
         return sigma, Z_imp, Z
 
+    def _e_step_body(self, Z, r_lower, r_upper, max_workers=1, num_ord_updates=1, weights=None):
+        """
+        Runs the E-step body on the rows of Z, in the worker pool if max_workers is not 1, 
+        and returns the (weighted) sum over rows of the conditional covariance terms, the imputed latent values and the updated latent values.
+        Without workers, the rows are processed in chunks of the row chunk size of the memory plan, if any
+        """
+        chunk_size = self._row_chunk_size()
+        if max_workers ==1 and (chunk_size is None or chunk_size >= len(Z)):
+            args = (Z, r_lower, r_upper, self.sigma, num_ord_updates, weights)
+            return _em_step_body_(args)
+        if max_workers ==1:
+            C = np.zeros((Z.shape[1], Z.shape[1]))
+            Z_imp = np.empty_like(Z)
+            for start in range(0, len(Z), chunk_size):
+                rows = slice(start, start+chunk_size)
+                C_chunk, Z_imp[rows], Z[rows] = _em_step_body(Z[rows], r_lower[rows], r_upper[rows], self.sigma, num_ord_updates, 
+                                                              None if weights is None else weights[rows])
+                C += C_chunk
+            return C, Z_imp, Z
+        if max_workers is None: 
+            max_workers = min(32, os.cpu_count()+4)
+        return self._em_step_parallel(Z, r_lower, r_upper, self.sigma, max_workers, num_ord_updates, weights)
+
+    def _em_step_active(self, Z, Z_imp, r_lower, r_upper, active_set, active_tol, iteration, max_workers=1, num_ord_updates=1, weights=None):
+        """
+        Executes one step of the active-set EM algorithm. Only the rows that are not frozen are updated: 
+        the rows that changed by less than active_tol at their last update are updated a last time and frozen, 
+        with their contributions to the covariance (sums of the imputed latent values, of their outer products and of 
+        the conditional covariance terms) added to the cache of active_set. Z and Z_imp are updated in place.
+
+        Args:
+            Z (matrix): Latent values
+            Z_imp (matrix): imputed latent values from the previous iteration
+            r_lower, r_upper (matrix): lower and upper bounds on latent ordinals
+            active_set (_ActiveSet): the frozen rows and their cached contributions
+            active_tol (float): the change below which a row is frozen
+            iteration (int): the index of the iteration
+            weights (array or None): the number of times each row is counted
+        Returns:
+            sigma (matrix): an estimate of the covariance of the copula
+        """
+        n = Z.shape[0] if weights is None else weights.sum()
+        active_set.refresh(iteration, self.sigma)
+        stats = [0, 0, 0]
+        freeze = ~active_set.frozen & (active_set.change < active_tol)
+        for rows, to_cache in ((np.nonzero(~active_set.frozen & ~freeze)[0], False), (np.nonzero(freeze)[0], True)):
+            if len(rows) == 0:
+                continue
+            row_weights = np.ones(len(rows)) if weights is None else weights[rows]
+            C, Z_imp_rows, Z_rows = self._e_step_body(Z[rows], r_lower[rows], r_upper[rows], max_workers, num_ord_updates, 
+                                                      None if weights is None else row_weights)
+            active_set.change[rows] = np.max(np.abs(Z_imp_rows - Z_imp[rows]), axis=1, initial=0)
+            Z_imp[rows] = Z_imp_rows
+            Z[rows] = Z_rows
+            contributions = [(Z_imp_rows.T * row_weights) @ Z_imp_rows, row_weights @ Z_imp_rows, C]
+            if to_cache:
+                active_set.add(rows, *contributions)
+            else:
+                stats = [a + b for a,b in zip(stats, contributions)]
+        sum_ZZ, sum_Z, C = [a + b for a,b in zip(stats, [active_set.sum_ZZ, active_set.sum_Z, active_set.C])]
+        sigma = (sum_ZZ - np.outer(sum_Z, sum_Z)/n)/(n-1) + C/n
+        return self._project_to_correlation(sigma)
+
+    def _em_step_parallel(self, Z, r_lower, r_upper, sigma, max_workers, num_ord_updates=1, weights=None, targets=None):
+        """
+        Runs the E-step body over row chunks in the persistent worker pool of the estimator. 
+        Z, r_lower, r_upper and sigma are copied once into shared memory and only the chunk index ranges are sent to the workers. 
+        Rows are sorted by missingness pattern before splitting, so that each pattern is factored by as few workers as possible.
+
+        Args:
+            Z (matrix): Latent values
+            r_lower (matrix): lower bound on latent ordinals
+            r_upper (matrix): upper bound on latent ordinals
+            sigma (matrix): correlation estimate
+            max_workers (positive int): number of workers for parallelism
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals
+            weights (array or None): the number of times each row is counted in C
+            targets (array or None): boolean, true at the latent columns to impute, see _em_step_body
+
+        Returns:
+            C (matrix): the sum over rows of the conditional covariance terms
+            Z_imp (matrix): estimates of latent values
+            Z (matrix): Updated latent values
+        """
+        n,p = Z.shape
+        order = np.concatenate(_group_by_pattern(np.isnan(Z)))
+        pool = self._get_pool(max_workers)
+        pool.put('Z', Z[order])
+        pool.put('r_lower', r_lower[order])
+        pool.put('r_upper', r_upper[order])
+        pool.put('sigma', sigma)
+        if weights is not None:
+            pool.put('weights', weights[order])
+        pool.empty('Z_imp', Z.shape, Z.dtype)
+        divide = n/max_workers * np.arange(max_workers+1)
+        divide = divide.astype(int)
+        ranges = [(divide[i], divide[i+1]) for i in range(max_workers)]
+        C = np.zeros((p,p))
+        for C_divide in pool.map(_em_step_body_shared, ranges, num_ord_updates, weights is not None, targets):
+            C += C_divide
+        Z_imp = np.empty((n,p), dtype=Z.dtype)
+        Z_imp[order] = pool.view('Z_imp')
+        Z[order] = pool.view('Z')
+        return C, Z_imp, Z
+
+    def _get_pool(self, max_workers):
+        """
+        Return the worker pool of the estimator, (re)starting it when the number of workers changes
+        """
+        if self._pool is None or self._pool.max_workers != max_workers:
+            self.close()
+            self._pool = SharedMemoryPool(max_workers)
+        return self._pool
+
+    def __getstate__(self):
+        # the worker pool belongs to the process that started it
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def close(self):
+        """
+        Shut down the worker pool and release its shared memory. A new pool is started on the next parallel call.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
     def _project_to_correlation(self, covariance):
         """
         Projects a covariance to a correlation matrix, normalizing it's diagonal entries. Only checks for diagonal entries to be positive.
+        The correlation matrix is returned with the floating point type sigma_dtype.
 
         Args:
             covariance (matrix): a covariance matrix
@@ -331,39 +1116,13 @@ class ExpectationMaximization():
             raise ZeroDivisionError("unexpected zero covariance for  the latent Z") 
         D_neg_half = 1.0/np.sqrt(D)
         covariance *= D_neg_half
-        return covariance.T * D_neg_half
+        return (covariance.T * D_neg_half).astype(self.sigma_dtype, copy=False)
 
-    def _init_Z_ord(self, Z_ord_lower, Z_ord_upper, seed):
+    def _init_Z_ord(self, Z_ord_lower, Z_ord_upper, rng, chunk_size=None):
         """
-        Initializes the observed latent ordinal values by sampling from a standard
-        Gaussian trucated to the inveral of Z_ord_lower, Z_ord_upper
-
-        Args:
-            Z_ord_lower (matrix): lower range for ordinals
-            Z_ord_upper (matrix): upper range for ordinals
-
-        Returns:
-            Z_ord (range): Samples drawn from gaussian truncated between Z_ord_lower and Z_ord_upper
+        Initializes the observed latent ordinal values, see embody._init_Z_ord
         """
-        Z_ord = np.empty(Z_ord_lower.shape)
-        Z_ord[:] = np.nan
-
-        n, k = Z_ord.shape
-        obs_indices = ~np.isnan(Z_ord_lower)
-
-        u_lower = np.copy(Z_ord_lower)
-        u_lower[obs_indices] = norm.cdf(Z_ord_lower[obs_indices])
-        u_upper = np.copy(Z_ord_upper)
-        u_upper[obs_indices] = norm.cdf(Z_ord_upper[obs_indices])
-        assert all(0<=u_lower[obs_indices]) and all(u_lower[obs_indices] <= u_upper[obs_indices]) and  all(u_upper[obs_indices]<=1)
-
-        np.random.seed(seed)
-        for i in range(n):
-            for j in range(k):
-                if not np.isnan(Z_ord_upper[i,j]) and u_upper[i,j] > 0 and u_lower[i,j]<1:
-                    u_sample = np.random.uniform(u_lower[i,j],u_upper[i,j])
-                    Z_ord[i,j] = norm.ppf(u_sample)
-        return Z_ord
+        return _init_Z_ord(Z_ord_lower, Z_ord_upper, rng, chunk_size)
 
     def _get_scaled_diff(self, prev_sigma, sigma):
         """
@@ -446,5 +1205,38 @@ class ExpectationMaximization():
         return test_stats
 
 
+class _ActiveSet():
+    """
+    Rows frozen by the active-set EM in ExpectationMaximization, with their cached contributions to the covariance
+    """
+    def __init__(self, n, p, check_every=10, refresh_tol=0.05):
+        self.check_every = check_every
+        self.refresh_tol = refresh_tol
+        # change of each row at its last update, infinite until the row is updated
+        self.change = np.full(n, np.inf)
+        self.frozen = np.zeros(n, dtype=bool)
+        self.sigma_ref = None
+        self._reset(p)
+
+    def _reset(self, p):
+        self.frozen[:] = False
+        self.sum_ZZ = np.zeros((p,p))
+        self.sum_Z = np.zeros(p)
+        self.C = np.zeros((p,p))
 
+    def refresh(self, iteration, sigma):
+        """
+        Unfreezes all rows every check_every iterations, or when sigma moved by more than refresh_tol since the last refresh
+        """
+        if self.sigma_ref is not None and iteration % self.check_every != 0:
+            diff = np.linalg.norm(sigma - self.sigma_ref) / np.linalg.norm(self.sigma_ref)
+            if diff <= self.refresh_tol:
+                return
+        self.sigma_ref = sigma.copy()
+        self._reset(sigma.shape[0])
 
+    def add(self, rows, sum_ZZ, sum_Z, C):
+        self.frozen[rows] = True
+        self.sum_ZZ = self.sum_ZZ + sum_ZZ
+        self.sum_Z = self.sum_Z + sum_Z
+        self.C = self.C + C
@@ -1,11 +1,36 @@
 from .transform_function import TransformFunction
 from .expectation_maximization import ExpectationMaximization
-from scipy.stats import norm, truncnorm
+from .memory_plan import _WORKER_BYTES, _TRUNCNORM_BYTES, _FIXED_BYTES
+from .embody import _low_rank_e_step, _low_rank_comp_S, _low_rank_impute, _low_rank_e_step_shared, _low_rank_impute_shared, _unique_rows
+from scipy.stats import norm
+from scipy import sparse
 import numpy as np
+import os
+
+_MEMORY_HINT = 'The memory grows linearly with the number of rows: fit a sample of the rows and impute the others with transform.'
 
 
 class LowRankExpectationMaximization(ExpectationMaximization):
-    def __init__(self, var_types=None, max_ord=20):
+    '''
+    A method to fit a low rank Gaussian copula model from incomplete data and then use the fitted model to impute the missing entries.
+    The copula correlation is modeled as W W^T + sigma I, with W of shape (p, rank).
+
+    Methods
+    -------
+    impute_missing:
+        fit a low rank Gaussian copula model from incomplete data and then use the fitted model to impute the missing entries.
+    fit:
+        fit a low rank Gaussian copula model from incomplete data, without imputing it.
+    transform:
+        impute the missing entries of new data points from the fitted model, without updating the model.
+    '''
+    def __init__(self, var_types=None, max_ord=20, dtype=np.float64, sigma_dtype=np.float64, svd_oversampling=10, svd_power_iter=2):
+        '''
+        dtype is the floating point type of the latent matrices and of the conditional factor moments, 
+        sigma_dtype the one of W and its factorizations.
+        svd_oversampling and svd_power_iter are the number of extra random directions and of power iterations 
+        of the randomized truncated SVD used to initialize W and sigma.
+        '''
         if var_types is not None:
             if not all(var_types['cont'] ^ var_types['ord']):
                 raise ValueError('Inconcistent specification of variable types indexing')
@@ -15,9 +40,16 @@ class LowRankExpectationMaximization(ExpectationMaximization):
             self.cont_indices = None
             self.ord_indices = None
         self.max_ord = max_ord
+        self.dtype = np.dtype(dtype)
+        self.sigma_dtype = np.dtype(sigma_dtype)
+        self.svd_oversampling = svd_oversampling
+        self.svd_power_iter = svd_power_iter
+        self.memory_plan = None
+        self._pool = None
 
 
-    def impute_missing(self, X, rank, threshold=1e-3, max_iter=50, max_ord=20, verbose = False, seed=1):
+    def impute_missing(self, X, rank, threshold=1e-3, max_iter=50, max_ord=20, max_workers=1, collapse_duplicates=False, target_columns=None, 
+                       memory_limit=None, verbose = False, seed=1):
         """
         Fits a low rank Gaussian Copula and imputes missing values in X. After estimating the model parameters W and sigma, 
         a further step to update S (detemined by W, sigma, Z) is implemented for numerical stability
@@ -29,39 +61,115 @@ class LowRankExpectationMaximization(ExpectationMaximization):
             threshold (float): the threshold for scaled difference between covariance estimates at which to stop early
             max_iter (int): the maximum number of iterations for copula estimation
             max_ord: maximum number of levels in any ordinal for detection of ordinal indices
+            max_workers: the maximum number of workers for parallelism
+            collapse_duplicates (bool): if True, identical rows (same observed values and missingness mask) are fitted and imputed once, 
+                weighted by their number of occurrences. The latent ordinals of a distinct row are drawn once by _init_Z_ord, 
+                so all its copies start from the same draw instead of independent ones
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute. 
+                The model is fitted on all columns, but only the missing entries of these columns are imputed, the others are left missing
+            memory_limit (int, str or None): the memory budget of the fit, in bytes or as a string such as '4GB'. 
+                If provided, the row chunk size (at most 4096) and the number of workers (at most max_workers) are chosen so that the planned peak memory fits, 
+                a MemoryError describing the plan is raised before fitting if it cannot, and the plan is kept in memory_plan, see MemoryPlan
             verbose: print iteration information if true
         Returns:
             X_imp (matrix): X with missing values imputed
             W (matrix): an estimate of the latent coefficient matrix of the low rank Gaussian copula
             sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
         """
-        if self.cont_indices is None:
-            self.cont_indices = self.get_cont_indices(X, self.max_ord)
-            self.ord_indices = ~self.cont_indices
+        self._set_var_types(X)
+        estimate = lambda chunk_size, workers: self._memory_estimate(X.shape, rank, chunk_size, workers)
+        with self._memory_planned(memory_limit, estimate, min(X.shape[0], 4096), max_workers, _MEMORY_HINT) as max_workers:
+            Z, inverse = self._fit(X, rank, threshold, max_iter, max_workers, verbose, seed, collapse_duplicates)
+            W, sigma = self.W, self.sigma
+            targets, latent_targets = self._target_masks(target_columns, X.shape[1])
+            self._memory_phase('impute')
+            _, Z_imp = self._impute_latent(Z, W, sigma, max_workers=max_workers, targets=latent_targets) # re-estimate S to ensure numerical stability
+            if inverse is not None:
+                Z_imp = Z_imp[inverse]
+            _order = self.back_to_original_order()
+            X_imp = np.empty(X.shape)
+            # transform back one chunk of rows at a time under a memory plan, all rows otherwise
+            chunk_size = self._row_chunk_size(max(X.shape[0], 1))
+            for start in range(0, X.shape[0], chunk_size):
+                rows = slice(start, start+chunk_size)
+                # Rearrange Z_imp so that it's columns correspond to the columns of X
+                Z_imp_rearranged = Z_imp[rows][:,_order]
+                if np.sum(self.cont_indices) > 0:
+                    X_imp[rows,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X[rows], targets)
+                if np.sum(self.ord_indices) >0:
+                    X_imp[rows,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X[rows], targets)
+
+        return X_imp, W, sigma
 
-        self.transform_function = TransformFunction(X, self.cont_indices, self.ord_indices)
+    def fit(self, X, rank, threshold=1e-3, max_iter=50, max_workers=1, collapse_duplicates=False, memory_limit=None, verbose = False, seed=1):
+        """
+        Fits a low rank Gaussian Copula on X without imputing it. The estimated marginals and model parameters W and sigma are kept,
+        so that transform can later impute new data points from the fitted model.
+        Args:
+            X (matrix): data matrix to fit the model on
+            rank: the rank for low rank Gaussian copula 
+            threshold (float): the threshold for scaled difference between covariance estimates at which to stop early
+            max_iter (int): the maximum number of iterations for copula estimation
+            max_workers: the maximum number of workers for parallelism
+            collapse_duplicates (bool): if True, identical rows are fitted once, weighted by their number of occurrences
+            memory_limit (int, str or None): the memory budget of the fit, see impute_missing
+            verbose: print iteration information if true
+        Returns:
+            self
+        """
+        self._set_var_types(X)
+        estimate = lambda chunk_size, workers: self._memory_estimate(X.shape, rank, chunk_size, workers, impute=False)
+        with self._memory_planned(memory_limit, estimate, min(X.shape[0], 4096), max_workers, _MEMORY_HINT) as max_workers:
+            self._fit(X, rank, threshold, max_iter, max_workers, verbose, seed, collapse_duplicates)
+        return self
+
+    def _fit(self, X, rank, threshold=1e-3, max_iter=50, max_workers=1, verbose = False, seed=1, collapse_duplicates=False):
+        """
+        Estimates the marginals and W, sigma from X, and returns the latent matrix Z (see _fit_covariance) 
+        together with the position of each row of X in it. 
+        With collapse_duplicates, Z only has the distinct rows of X; otherwise it has all rows and the positions are None
+        """
+        self._set_var_types(X)
+        self._memory_phase('marginals')
+        self.transform_function = TransformFunction(X, self.cont_indices, self.ord_indices, dtype=self.dtype)
+        rows, inverse, counts = _unique_rows(X) if collapse_duplicates else (None, None, None)
         # TO DO: consider the order of W
-        W, sigma, Z, C, loglik = self._fit_covariance(X=X, rank=rank, threshold=threshold, max_iter=max_iter, verbose=verbose, seed=seed)
-        S = self._comp_S(Z, W, sigma) # re-estimate S to ensure numerical stability
-        Z_imp = self._impute(Z, S, W)
-        # Rearrange Z_imp so that it's columns correspond to the columns of X
-        #Z_imp_rearranged = np.empty(X.shape)
-        #Z_imp_rearranged[:,ord_indices] = Z_imp[:,:np.sum(ord_indices)]
-        #Z_imp_rearranged[:,cont_indices] = Z_imp[:,np.sum(ord_indices):]
+        W, sigma, Z, C, loglik = self._fit_covariance(X=X, rank=rank, threshold=threshold, max_iter=max_iter, max_workers=max_workers, verbose=verbose, seed=seed, 
+                                                      rows=rows, weights=counts)
+        self.W, self.sigma = W, sigma
+        return Z, inverse
+
+    def transform(self, X, max_workers=1, seed=1, target_columns=None):
+        """
+        Imputes the missing entries of new data points X from the fitted model, without updating it. 
+        The stored marginals and W, sigma are used as they are and no EM iteration is run: 
+        the latent ordinals are re-estimated once and the missing entries are set to their conditional means.
+        Args:
+            X (matrix): data matrix with entries to be imputed, with the same columns as the data the model was fitted on
+            max_workers (positive int): the maximum number of workers for parallelism
+            seed: the seed for the initialization of the latent ordinals
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute, the other missing entries are left missing
+        Returns:
+            X_imp (matrix): X with missing values imputed
+        """
+        targets, latent_targets = self._target_masks(target_columns, X.shape[1])
+        Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, np.random.default_rng(seed))
+        Z_cont = self.transform_function.partial_evaluate_cont_latent(X)
+        Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        U,d,_ = np.linalg.svd(self.W, full_matrices=False)
+        self._e_step(Z, Z_ord_lower, Z_ord_upper, U, d, self.sigma, max_workers)
+        _, Z_imp = self._impute_latent(Z, self.W, self.sigma, U, d, max_workers, latent_targets)
         _order = self.back_to_original_order()
         Z_imp_rearranged = Z_imp[:,_order]
-
         X_imp = np.empty(X.shape)
         if np.sum(self.cont_indices) > 0:
-            #X_imp[:,cont_indices] = self.transform_function.impute_cont_observed(Z_imp_rearranged)
-            X_imp[:,self.cont_indices] = self.transform_function.impute_cont_observed(Z_imp_rearranged)
+            X_imp[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X, targets)
         if np.sum(self.ord_indices) >0:
-            #X_imp[:,ord_indices] = self.transform_function.impute_ord_observed(Z_imp_rearranged)
-            X_imp[:,self.ord_indices] = self.transform_function.impute_ord_observed(Z_imp_rearranged)
-
-        return X_imp, W, sigma
+            X_imp[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X, targets)
+        return X_imp
 
-    def _fit_covariance(self, X, rank, threshold=1e-3, max_iter =100, verbose = False, seed=1):
+    def _fit_covariance(self, X, rank, threshold=1e-3, max_iter =100, max_workers=1, verbose = False, seed=1, rows=None, weights=None):
         """
         Estimate the covariance parameters of the low rank Gaussian copula, W and sigma, 
         using the data in X and return the estimates and related quantity. 
@@ -72,37 +180,33 @@ class LowRankExpectationMaximization(ExpectationMaximization):
             rank: the rank for low rank Gaussian copula 
             threshold (float): the threshold for scaled difference between covariance estimates at which to stop early
             max_iter (int): the maximum number of iterations for copula estimation
+            max_workers (positive int): the maximum number of workers for parallelism 
             verbose: print iteration information if true
+            rows (array or None): if provided, only these rows of X are fitted
+            weights (array or None): the number of times each fitted row is counted, such as its number of duplicates in X
         Returns:
             W (matrix): an estimate of the latent coefficient matrix of the low rank Gaussian copula
             sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
             Z (matrix): the transformed value, at observed continuous entry; the conditional mean, at observed ordinal entry; NA elsewhere
-            C (matrix): 0 at observed continuous entry; the conditional variance, at observed ordinal entry; NA elsewhere
+            C (sparse matrix): 0 at observed continuous entry; the conditional variance, at observed ordinal entry; NA elsewhere
             loglik: log likelihood during iterations, expected to increase every iteration, but possible that it does not (indicating bad fit)
         """
+        self._memory_phase('latent')
         Z_ord_lower, Z_ord_upper = self.transform_function.get_ord_latent()
-        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, seed)
         Z_cont = self.transform_function.get_cont_latent()
+        if rows is not None:
+            Z_ord_lower, Z_ord_upper, Z_cont = Z_ord_lower[rows], Z_ord_upper[rows], Z_cont[rows]
+        rng = np.random.default_rng(seed)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, rng, self._row_chunk_size())
         Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        self._memory_phase('init')
+        W, sigma, Z = self._init_W_sigma(Z, rank, Z_ord_lower, Z_ord_upper, rng, weights)
 
-        # Initialize Z_imp using truncated (low-rank) SVD for missing entries
-        # to obtain initial parameter estimate
-        Z_imp = self._init_impute_svd(Z, rank, Z_ord_lower, Z_ord_upper)
-        corr = np.corrcoef(Z_imp, rowvar=False)
-        u,d,_ = np.linalg.svd(corr, full_matrices=False)
-        sigma = np.mean(d[rank:])
-        W = u[:,:rank] * (np.sqrt(d[:rank] - sigma))
-        W, sigma = self._scale_corr(W, sigma)
-        # Update entries at obseved ordinal locations from SVD initialization
-        if sum(self.ord_indices)>0:
-            Z_ord[~np.isnan(Z_ord)] = Z_imp[:,:sum(self.ord_indices)][~np.isnan(Z_ord)]
-            Z = np.concatenate((Z_ord, Z_cont), axis=1)
-        
-
+        self._memory_phase('em')
         loglik = []
         for i in range(max_iter):
             #print("iteration " + str(i + 1))
-            W_new, sigma_new, C, iterloglik = self._em_step(Z, Z_ord_lower, Z_ord_upper, W, sigma) # YX
+            W_new, sigma_new, C, iterloglik = self._em_step(Z, Z_ord_lower, Z_ord_upper, W, sigma, max_workers, weights) # YX
             # stop early if the change in the correlation estimation is below the threshold
             #loglik.append(-negloglik)
             loglik.append(iterloglik) #YX
@@ -120,56 +224,127 @@ class LowRankExpectationMaximization(ExpectationMaximization):
         return W, sigma, Z, C, loglik
 
 
-    def _comp_S(self, Z, W, sigma):
+    def _init_W_sigma(self, Z, rank, Z_ord_lower, Z_ord_upper, rng, weights=None):
+        """
+        Initial estimate of W and sigma from the correlation of the truncated (low-rank) SVD imputation of Z. 
+        The latent values at observed ordinal entries of Z are replaced, in place, by their SVD imputation. 
+        Args:
+            Z (matrix): the transformed value, at observed continuous entry; the initial latent value, at observed ordinal entry; NA elsewhere
+            rank: the rank for low rank Gaussian copula 
+            Z_ord_lower, Z_ord_upper (matrix): the lower and upper bounds for the latent ordinals
+            rng (np.random.Generator): the random generator of the randomized SVD
+            weights (array or None): the number of times each row is counted in the correlation
+        Returns:
+            W (matrix): an initial estimate of the latent coefficient matrix of the low rank Gaussian copula
+            sigma (scalar): an initial estimate of the latent noise variance of the low rank Gaussian copula
+            Z (matrix): Z, with updated latent ordinals
+        """
+        # Initialize Z_imp using truncated (low-rank) SVD for missing entries
+        # to obtain initial parameter estimate
+        Z_imp = self._init_impute_svd(Z, rank, Z_ord_lower, Z_ord_upper, rng, self._row_chunk_size(4096))
+        if weights is None:
+            corr = np.corrcoef(Z_imp, rowvar=False, dtype=Z_imp.dtype).astype(self.sigma_dtype)
+        else:
+            cov = np.cov(Z_imp, rowvar=False, fweights=weights, dtype=Z_imp.dtype)
+            std = np.sqrt(np.diag(cov))
+            corr = (cov / np.outer(std, std)).astype(self.sigma_dtype)
+        p = corr.shape[0]
+        if rank < p:
+            # the eigenvalues of corr are its singular values and sum to its trace, so only the top rank ones are needed
+            d, u = self._randomized_svd(lambda: (corr[start:start+4096] for start in range(0, p, 4096)), p, rank, rng)
+            sigma = (np.trace(corr) - np.sum(d))/(p - rank)
+        else:
+            u,d,_ = np.linalg.svd(corr, full_matrices=False)
+            sigma = np.mean(d[rank:])
+        W = u[:,:rank] * (np.sqrt(d[:rank] - sigma))
+        W, sigma = self._scale_corr(W, sigma)
+        # Update entries at obseved ordinal locations from SVD initialization
+        num_ord = Z_ord_lower.shape[1]
+        if num_ord>0:
+            Z_ord = Z[:,:num_ord]
+            Z_ord[~np.isnan(Z_ord)] = Z_imp[:,:num_ord][~np.isnan(Z_ord)]
+        return W, sigma, Z
+
+
+    def _impute_latent(self, Z, W, sigma, U=None, d=None, max_workers=1, targets=None):
         """
-        Intermidiate step.
-        It seems that S must be updated using the last obtained W and sigma, otherwise numerical instability happens. 
-        Such problem is not seen in R implementation. Keep an eye.
+        Final imputation stage: computes the decomposition of W once, then the factor S and the imputed Z from it.
+        Args:
+            Z (matrix): the transformed value, at observed continuous entry; the conditional mean, at observed ordinal entry; NA elsewhere
+            W (matrix): an estimate of the latent coefficient matrix of the low rank Gaussian copula
+            sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
+            U, d (matrix, array): left singular vectors and singular values of W, computed from W if not provided
+            max_workers (positive int): the maximum number of workers for parallelism
+            targets (array or None): boolean, true at the columns whose missing entries are imputed, all columns if None
+        Returns:
+            S: a factor used for imputation
+            Zimp (matrix): a copy of Z, but with missing entries replaced by their conditional mean imputation.
+        """
+        if U is None or d is None:
+            U, d, _ = np.linalg.svd(W, full_matrices=False)
+        if max_workers is None: 
+            max_workers = min(32, os.cpu_count()+4)
+        if max_workers > 1:
+            return self._impute_parallel(Z, U, d, sigma, max_workers, targets)
+        S = self._comp_S(Z, W, sigma, U, d)
+        return S, self._impute(Z, S, W, U, targets)
+
+    def _comp_S(self, Z, W, sigma, U=None, d=None):
+        """
+        Intermidiate step, see _low_rank_comp_S.
         Args:
             W (matrix): an estimate of the latent coefficient matrix of the low rank Gaussian copula
             sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
             Z (matrix): the transformed value, at observed continuous entry; the conditional mean, at observed ordinal entry; NA elsewhere
+            U, d (matrix, array): left singular vectors and singular values of W, computed from W if not provided
         Returns:
             S: a factor used for imputation
         """
-        n, k = Z.shape[0], W.shape[1]
-        U, d, _ = np.linalg.svd(W, full_matrices=False)
-        S = np.zeros((n,k))
-        for i in range(n):
-            obs_indices = np.nonzero(~np.isnan(Z[i,:]))[0]
-
-            zi_obs = Z[i,obs_indices]
-            Ui_obs = U[obs_indices,:]
-            UU_obs = np.dot(Ui_obs.T, Ui_obs) # YX: better edit to avoid vector-vector inner product
+        if U is None or d is None:
+            U, d, _ = np.linalg.svd(W, full_matrices=False)
+        return _low_rank_comp_S(Z, U, d, sigma, self._row_chunk_size(4096))
 
-            S[i,:] = np.linalg.solve(UU_obs + sigma * np.diag(1.0/np.square(d)), np.dot(Ui_obs.T, zi_obs))
-        return S
-
-
-
-    def _impute(self, Z, S, W):
+    def _impute(self, Z, S, W, U=None, targets=None):
         """
-        Impute missing values
+        Impute missing values, see _low_rank_impute.
         Args:
             W (matrix): an estimate of the latent coefficient matrix of the low rank Gaussian copula
-            sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
             Z (matrix): the transformed value, at observed continuous entry; the conditional mean, at observed ordinal entry; NA elsewhere
             S: a factor used for imputation
+            U (matrix): left singular vectors of W, computed from W if not provided
+            targets (array or None): boolean, true at the columns whose missing entries are imputed, all columns if None
         Returns:
             Zimp (matrix): a copy of Z, but with missing entries replaced by their conditional mean imputation.
         """
-        n,p = Z.shape
-        Zimp = np.copy(Z)
-        U,d,_ = np.linalg.svd(W, full_matrices=False)
-        for i in range(n):
-            index_m = np.nonzero(np.isnan(Z[i,:]))
-            Zimp[i,index_m] =  np.dot(U[index_m,:], S[i,:])
-        return Zimp
-
-
+        if U is None:
+            U,_,_ = np.linalg.svd(W, full_matrices=False)
+        return _low_rank_impute(Z, S, U, self._row_chunk_size(4096), targets)
 
+    def _impute_parallel(self, Z, U, d, sigma, max_workers, targets=None):
+        """
+        Computes S and the imputed Z over row chunks in the persistent worker pool of the estimator. 
+        Z is copied once into shared memory and each worker writes the rows of its chunk of S and Z_imp.
+        Returns:
+            S: a factor used for imputation
+            Zimp (matrix): a copy of Z, but with missing entries replaced by their conditional mean imputation.
+        """
+        n = Z.shape[0]
+        pool = self._get_pool(max_workers)
+        pool.put('Z', Z)
+        pool.empty('S', (n, U.shape[1]), Z.dtype)
+        pool.empty('Z_imp', Z.shape, Z.dtype)
+        pool.map(_low_rank_impute_shared, self._row_ranges(n, max_workers), U, d, sigma, targets, self._row_chunk_size(4096))
+        return np.copy(pool.view('S')), np.copy(pool.view('Z_imp'))
+
+    def _row_ranges(self, n, max_workers):
+        """
+        Split the rows 0:n into max_workers contiguous (start, stop) ranges
+        """
+        divide = n/max_workers * np.arange(max_workers+1)
+        divide = divide.astype(int)
+        return [(divide[i], divide[i+1]) for i in range(max_workers)]
 
-    def _em_step(self, Z, r_lower, r_upper, W, sigma):
+    def _em_step(self, Z, r_lower, r_upper, W, sigma, max_workers=1, weights=None):
         """
         EM algorithm to estimate the low rank Gaussian copula, W and sigma.
         Args:
@@ -177,120 +352,91 @@ class LowRankExpectationMaximization(ExpectationMaximization):
                         initial conditional mean, at observed ordinal entry (will be updated during iteration); NA elsewhere
             r_lower, r_upper (matrix): the lower and upper bounds for con
             W, sigma: initial estimate for low rank Gaussian copula parameters
+            max_workers (positive int): the maximum number of workers for parallelism
+            weights (array or None): the number of times each row is counted
         Returns:
             W (matrix): an estimate of the latent coefficient matrix of the low rank Gaussian copula
             sigma (scalar): an estimate of the latent noise variance of the low rank Gaussian copula
-            C (matrix): 0 at observed continuous entry; the conditional variance, at observed ordinal entry; NA elsewhere
+            C (sparse matrix): 0 at observed continuous entry; the conditional variance, at observed ordinal entry; NA elsewhere
             loglik: log likelihood during iterations, expected to increase every iteration, but possible that it does not (indicating bad fit)
 
         """
         n,p = Z.shape
-        rank = W.shape[1]
-        if r_lower.shape[1] == 0:
-            num_ord = 0
-        else:
-            num_ord = r_lower.shape[1]
-        negloglik = 0
         U,d,V = np.linalg.svd(W, full_matrices=False)
-        A = np.zeros((n, rank, rank))
-        SS = np.copy(A)
-        S = np.zeros((n,rank))
-        C = np.zeros((n,p))
-
-        # The main loop for the E step, parallelize this later
-        for i in range(n):
-            # indexing
-            obs_indices = np.nonzero(~np.isnan(Z[i,:]))[0]
-            ord_in_obs = np.nonzero(obs_indices < num_ord)
-            ord_obs_indices = obs_indices[ord_in_obs]
-            
-
-            zi_obs = Z[i,obs_indices]
-            Ui_obs = U[obs_indices,:]
-            UU_obs = np.dot(Ui_obs.T, Ui_obs) 
-            # YX: better edit to avoid vector-vector inner product when there is only one observation
-
-            # used in both ordinal and factor block
-            res = np.linalg.solve(UU_obs + sigma * np.diag(1.0/np.square(d)), np.concatenate((np.identity(rank), Ui_obs.T),axis=1))
-            Ai = res[:,:rank]
-            AU = res[:,rank:]
-            A[i,:,:] = Ai
-
-            # when there is an observed ordinal to be imputed and another observed dimension, impute this ordinal
-            if len(obs_indices) >= 2 and len(ord_obs_indices) >= 1:
-                #print("ENTERED INNER LOOP!!!")
-                mu = (zi_obs - np.dot(Ui_obs, np.dot(AU, zi_obs)))/sigma
-                for ind in range(len(obs_indices)):
-                    j = obs_indices[ind]
-                    if j < num_ord:
-                        sigma_ij = sigma/(1 - np.dot(U[j,:].T, np.dot(Ai, U[j,:])))
-                        mu_ij = Z[i,j] - mu[ind] * sigma_ij
-                        mu_ij_new, sigma_ij_new = truncnorm.stats(
-                            a=(r_lower[i,j] - mu_ij) / np.sqrt(sigma_ij),
-                            b=(r_upper[i,j] - mu_ij) / np.sqrt(sigma_ij),
-                            loc=mu_ij, scale=np.sqrt(sigma_ij),moments='mv')
-                        if np.isfinite(sigma_ij_new):
-                            C[i,j] = sigma_ij_new
-                        else:
-                            print("variance was not finite and is: " +str(sigma_ij_new))
-                        if np.isfinite(mu_ij_new):
-                            Z[i,j] = mu_ij_new
-                        else:
-                            print("mean was not finite and is: " +str(mu_ij_new))
-
-            si = np.dot(AU, zi_obs)
-            S[i,:] = si
-            SS[i,:,:] = np.dot(AU * C[i, obs_indices], AU.T) + np.outer(si, si.T)
-            negloglik = negloglik + np.log(sigma) * p + np.log(np.linalg.det(np.identity(rank) + np.outer(d/sigma, d) * UU_obs))
-            negloglik = negloglik + np.sum(zi_obs**2) - np.dot(zi_obs.T, np.dot(Ui_obs, si))
-
-        #print(negloglik)
-        # M-step in W iterate over p
-        W_new = np.copy(W)
-        s = np.sum(C)
-
-        for j in range(p):
-            index_j = np.nonzero(~np.isnan(Z[:,j]))[0]
-            # numerator
-            rj = self._sum_2d_scale(M=S, c=Z[:,j], index=index_j) + np.dot(self._sum_3d_scale(A, c=C[:,j], index=index_j), U[j,:])
-            # denominator
-            Fj = self._sum_3d_scale(SS+sigma*A, c=np.ones(n), index = index_j) 
-            W_new[j,:] = np.linalg.solve(Fj,rj) 
-            s = s -  np.dot(rj, W_new[j,:])
-
-        s1 = s
-        #print('cross numerator: '+str(s1/float(np.sum(~np.isnan(Z)))))
+        F, R, C, z_sq, negloglik = self._e_step(Z, r_lower, r_upper, U, d, sigma, max_workers, weights)
+        if weights is None:
+            weights = np.ones(n)
 
+        # M-step in W: one rank by rank system per column j, with the accumulated denominator Fj and numerator rj
+        W_new = np.linalg.solve(F.astype(W.dtype, copy=False), R[:,:,np.newaxis].astype(W.dtype, copy=False))[:,:,0]
+        s = np.dot(weights, np.asarray(C.sum(axis=1)).ravel()) - np.sum(R * W_new)
 
         # M-step in sigma^2
-        for i in range(n):
-            obs_indices = np.nonzero(~np.isnan(Z[i,:]))
-            zi_obs = Z[i,obs_indices]
-            s += np.sum(zi_obs**2)
-        #print('z numerator: '+str((s-s1)/float(np.sum(~np.isnan(Z)))))
-        
-
-        sigma_new = s/float(np.sum(~np.isnan(Z)))
+        s += z_sq
+        sigma_new = s/float(np.dot(weights, np.sum(~np.isnan(Z), axis=1)))
         #print(sigma_new)
         W_new = np.dot(W_new * d, V)
-        W, sigma = self._scale_corr(W_new, sigma_new)
+        W, sigma = self._scale_corr(W_new.astype(self.sigma_dtype, copy=False), sigma_new)
         #print(sigma)
         loglik = -negloglik/2.0
         return W, sigma, C, loglik
 
 
 
-    def _init_impute_svd(self, Z, rank, Z_ord_lower, Z_ord_upper):
+    def _e_step(self, Z, r_lower, r_upper, U, d, sigma, max_workers=1, weights=None, num_ord_updates=1):
+        """
+        E-step of the low rank Gaussian copula, see _low_rank_e_step. 
+        With more than one worker, the rows are split into contiguous chunks, one per worker of the persistent pool: 
+        Z, r_lower and r_upper are copied once into shared memory, the workers update the latent ordinals in place 
+        and only send back their per column sums, which are added up.
+        Args:
+            Z (matrix): the transformed value, at observed continuous entry; 
+                        current conditional mean, at observed ordinal entry (updated in place); NA elsewhere
+            r_lower, r_upper (matrix): the lower and upper bounds for the latent ordinals
+            U, d (matrix, array): left singular vectors and singular values of W
+            sigma (scalar): the latent noise variance
+            max_workers (positive int): the maximum number of workers for parallelism
+            weights (array or None): the number of times each row is counted
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals
+        Returns:
+            F, R, C, z_sq, negloglik: see _low_rank_e_step
+        """
+        if max_workers is None: 
+            max_workers = min(32, os.cpu_count()+4)
+        if max_workers == 1:
+            return _low_rank_e_step(Z, r_lower, r_upper, U, d, sigma, self._row_chunk_size(4096), weights, num_ord_updates)
+        pool = self._get_pool(max_workers)
+        pool.put('Z', Z)
+        pool.put('r_lower', r_lower)
+        pool.put('r_upper', r_upper)
+        if weights is not None:
+            pool.put('weights', weights)
+        results = pool.map(_low_rank_e_step_shared, self._row_ranges(Z.shape[0], max_workers), U, d, sigma, weights is not None, 
+                           self._row_chunk_size(4096), num_ord_updates)
+        Z[:] = pool.view('Z')
+        F = sum(res[0] for res in results)
+        R = sum(res[1] for res in results)
+        C = sparse.vstack([res[2] for res in results], format='csr')
+        z_sq = sum(res[3] for res in results)
+        negloglik = sum(res[4] for res in results)
+        return F, R, C, z_sq, negloglik
+
+
+    def _init_impute_svd(self, Z, rank, Z_ord_lower, Z_ord_upper, rng=None, chunk_size=4096):
         # first zero initialization on missing entries to obtain SVD
         # then SVD initialization replace zero initialization
         Z_imp = np.copy(Z)
         Z_imp[np.isnan(Z_imp)] = 0.0
 
-        u,s,vh = np.linalg.svd(Z_imp, full_matrices=False)
-        u_low_rank = u[:,:rank]
-        s_low_rank = s[:rank]
-        vh_low_rank = vh[:rank,:]
-        Z_imp = np.dot(u_low_rank * s_low_rank, vh_low_rank) 
+        # the projection of the rows on the top rank right singular vectors equals u_low_rank * s_low_rank, vh_low_rank
+        if rng is None:
+            rng = np.random.default_rng()
+        n = Z_imp.shape[0]
+        read_chunks = lambda: (Z_imp[start:start+chunk_size] for start in range(0, n, chunk_size))
+        _, V = self._randomized_svd(read_chunks, Z.shape[1], rank, rng)
+        V = V.astype(Z_imp.dtype, copy=False)
+        for Z_chunk in read_chunks():
+            Z_chunk[:] = np.dot(np.dot(Z_chunk, V), V.T)
 
         k,p = Z_ord_lower.shape[1], Z.shape[1]
 
@@ -308,6 +454,119 @@ class LowRankExpectationMaximization(ExpectationMaximization):
         return Z_imp
 
 
+    def _memory_estimate(self, shape, rank, chunk_size, max_workers, impute=True):
+        """
+        The planned peak memory of each phase of impute_missing (or of fit if not impute) for a data matrix of the provided shape, 
+        as (bytes of this process, bytes of the worker pool), for MemoryPlan, see ExpectationMaximization._memory_estimate. 
+        Besides the marginals and the latent matrices, which are linear in the number of columns p, 
+        the E-step and the imputation hold rank by rank matrices for the rows of a chunk, and p by rank by rank sums
+        """
+        n, p = shape
+        k = int(np.sum(self.ord_indices))
+        b = self.dtype.itemsize
+        s = np.dtype(self.sigma_dtype).itemsize
+        chunk_size = min(chunk_size, n)
+        # the dimension of the random subspace of the randomized SVD
+        l = min(rank + self.svd_oversampling, p)
+        marginals, marginals_peak = self._marginals_memory(n, p, k)
+        latent, latent_peak = self._latent_memory(n, p, k, chunk_size)
+        # Z, concatenated from the ordinals and the continuous values
+        latent += b*n*p
+        phases = {'marginals': (marginals + marginals_peak, 0), 
+                  'latent': (marginals + max(latent_peak, latent), 0)}
+        # Z_imp, then either its missing mask, the products of a chunk with the subspace and its projection, 
+        # or the copy of Z_imp by np.corrcoef, and the masks and values of the observed ordinals copied back to Z
+        init = b*n*p + max(n*p, b*chunk_size*(l + p), b*n*p, 2*n*k + b*n*k)
+        # the correlation in dtype and in sigma_dtype, and the randomized SVD: the subspace, its basis, 
+        # the sums and the products of a chunk of rows of the correlation (at most 4096 rows), and W
+        svd = (b + s)*p*p + 4*8*p*l + 8*min(p, 4096)*l + 8*p*rank
+        phases['init'] = (marginals + latent + init + svd, 0)
+        # the conditional variances of the observed ordinals (at most n by k) as a sparse matrix, with 32 bit indices, 
+        # for the previous and the current iterations, and while the current one is built, the lists of its rows, columns 
+        # and values and their concatenation. Then the row sums of C, the weights and the number of observed entries of each row, 
+        # and the sums F and R, the outer products of the rows of U, and the new W
+        sums = 2*n*k*(4 + b) + 2*n*k*(2*8 + b) + 3*8*n + 8*(p + 1)*(3*rank*rank + 2*rank) + s*p*rank
+        if max_workers == 1:
+            phases['em'] = (marginals + latent + sums + self._low_rank_e_step_memory(chunk_size, p, k, rank), 0)
+        else:
+            worker_rows = min(chunk_size, -(-n // max_workers))
+            # the shared Z and bounds, and for each worker its process, the E-step temporaries of its rows and its sums
+            pool = b*n*(p + 2*k) + max_workers*(_WORKER_BYTES + self._low_rank_e_step_memory(worker_rows, p, k, rank) + sums // max_workers)
+            phases['em'] = (marginals + latent + sums, pool)
+        if impute:
+            # Z and S are kept; S is computed from the rows sorted by pattern (the missing mask of Z, its grouping and the order), 
+            # then Z_imp and X_imp are built, with the temporaries of a chunk of rows imputed and transformed back
+            imputed = marginals + b*n*(p + rank) + max(n*p + self._pattern_memory(n, p) + 8*n + self._low_rank_comp_S_memory(chunk_size, p, rank), 
+                                                       b*n*p + max(chunk_size*(p + b*p), 8*n*p + self._transform_back_memory(chunk_size, p, k)))
+            if max_workers == 1:
+                phases['impute'] = (imputed, 0)
+            else:
+                # the copies of the shared S and Z_imp, and the shared Z, S and Z_imp
+                worker_rows = -(-n // max_workers)
+                worker = (_WORKER_BYTES + worker_rows*p + self._pattern_memory(worker_rows, p) + 8*worker_rows 
+                          + self._low_rank_comp_S_memory(min(chunk_size, worker_rows), p, rank) + b*worker_rows*(p + rank))
+                phases['impute'] = (imputed, b*n*(2*p + rank) + max_workers*worker)
+        return phases
+
+    def _low_rank_e_step_memory(self, rows, p, k, rank):
+        """
+        The peak memory of the temporaries of embody._low_rank_e_step on a chunk of rows rows with p columns, k of them ordinal
+        """
+        b = self.dtype.itemsize
+        # per entry: the observed mask and as float64, Z with zeros at the missing entries, its squares or its weighted copy
+        entries = rows*p*(1 + 8 + 2*b)
+        # per ordinal: the mask of the ordinals updated, their conditional variances and the temporaries of the updated ordinals 
+        # (the float64 conditional means and the copies of their values and bounds, the float64 standardized bounds and scales, 
+        # the truncated normal temporaries), and their conditional variances C_ord
+        ordinals = rows*k*(1 + 2*b + 4*b + 4*8 + _TRUNCNORM_BYTES + b)
+        # per rank by rank matrix: U_obs^T U_obs and its regularization, the inverse and its copy A in dtype, the second moments, 
+        # the three float64 matrices of the log determinant, the ordinal terms and their products with A, and the F terms
+        matrices = rows*rank*rank*(3*8 + b + b + 3*8 + 3*b + 2*b)
+        # the weights, the count of observed entries of each row, the products of Z with U and the factor means
+        rows_terms = rows*(b + 8 + 2*b*rank)
+        return entries + ordinals + matrices + rows_terms + _FIXED_BYTES
+
+    def _low_rank_comp_S_memory(self, rows, p, rank):
+        """
+        The peak memory of the temporaries of embody._low_rank_comp_S on a chunk of rows rows with p columns
+        """
+        b = self.dtype.itemsize
+        # the observed masks of the chunk, their sorted copy and the inverse, Z with zeros at the missing entries, 
+        # its products with U, and the rank by rank inverses of the patterns (at most one per row) gathered for each row, in dtype
+        patterns = self._num_patterns(rows, p)
+        return rows*(2*p + 8 + b*p + 2*b*rank + b*rank*rank) + patterns*rank*rank*3*8 + _FIXED_BYTES
+
+    def _randomized_svd(self, read_chunks, p, rank, rng):
+        """
+        Randomized truncated SVD of a matrix with p columns that is only accessed through its row chunks, 
+        so that its rows never need to be held in memory at once.
+        A random subspace of dimension rank + svd_oversampling is refined by svd_power_iter subspace iterations with A^T A, 
+        each a pass over the chunks, and the top singular values and right singular vectors are extracted from the projection 
+        of A^T A on that subspace (Rayleigh-Ritz). 
+        Args:
+            read_chunks (callable): returns a new iterable over the row chunks of the matrix A
+            p (int): the number of columns of A
+            rank (int): the number of singular values and vectors returned
+            rng (np.random.Generator): the random generator of the initial subspace
+        Returns:
+            s (array): the top rank singular values of A, in decreasing order
+            V (matrix): p by rank, the corresponding right singular vectors
+        """
+        l = min(rank + self.svd_oversampling, p)
+        G = rng.standard_normal((p, l))
+        for _ in range(self.svd_power_iter + 1):
+            Q, _ = np.linalg.qr(G)
+            G = np.zeros((p, l))
+            for A_chunk in read_chunks():
+                G += np.dot(A_chunk.T, np.dot(A_chunk, Q.astype(A_chunk.dtype, copy=False)))
+        # Q^T A^T A Q, with Q the orthonormal basis of the last iteration
+        eigval, eigvec = np.linalg.eigh(np.dot(Q.T, G))
+        top = np.argsort(eigval)[::-1][:rank]
+        s = np.sqrt(np.maximum(eigval[top], 0))
+        V = np.dot(Q, eigvec[:,top])
+        return s, V
+
+
     def _scale_corr(self, W, sigma):
         p = W.shape[0]
         tr = np.sum(np.square(W), axis=1)
@@ -318,42 +577,14 @@ class LowRankExpectationMaximization(ExpectationMaximization):
 
 
 
-    def _sum_3d_scale(self, M, c, index):
-        res = np.empty((M.shape[1], M.shape[2]))
-        for j in range(M.shape[1]):
-            for k in range(M.shape[2]):
-                #res[j,k] = np.sum(M[:,j,k][index] * c[index])
-                res[j,k] = np.sum(M[index,j,k] * c[index])
-        return res
-
-    def _sum_2d_scale(self, M, c, index):
-        res = np.empty(M.shape[1])
-        for j in range(M.shape[1]):
-            #res[j] = np.sum(M[:,j][index] * c[index])
-            res[j] = np.sum(M[index,j] * c[index])
-        return res
-
     def _impute_missing_oracle(self, X, W, sigma, f = None, finv = None, max_ord_levels = 20):
         # only for continuous matrix
-        n, k = X.shape[0], W.shape[1]
-        cont_indices = self.get_cont_indices(X, max_ord_levels=max_ord_levels) 
+        cont_indices = self.get_cont_indices(X, max_ord=max_ord_levels) 
         ord_indices = ~cont_indices
         self.transform_function = TransformFunction(X, cont_indices, ord_indices)
         Z = self.transform_function.get_cont_latent()
         #Z = X
-        U, d, _ = np.linalg.svd(W, full_matrices=False)
-        S = np.zeros((n,k))
-        for i in range(n):
-            obs_indices = np.nonzero(~np.isnan(Z[i,:]))[0]
-
-            zi_obs = Z[i,obs_indices]
-            Ui_obs = U[obs_indices,:]
-            UU_obs = np.dot(Ui_obs.T, Ui_obs) # YX: better edit to avoid vector-vector inner product
-
-            S[i,:] = np.linalg.solve(UU_obs + sigma * np.diag(1.0/np.square(d)), np.dot(Ui_obs.T, zi_obs))
-
-        S = self._comp_S(Z, W, sigma)
-        Z_imp = self._impute(Z, S, W)
+        _, Z_imp = self._impute_latent(Z, W, sigma)
         X_imp = np.empty(X.shape)
         X_imp = self.transform_function.impute_cont_observed(Z_imp)
         return X_imp
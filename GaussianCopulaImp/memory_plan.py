@@ -0,0 +1,184 @@
+import os
+import re
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# the memory of an idle worker process of the pool, once numpy and scipy are loaded
+_WORKER_BYTES = 80 * 2**20
+# the Python object of an ndarray (its header, shape and strides), 112 bytes, traced at up to 122 bytes
+_ARRAY_BYTES = 128
+# the temporaries of scipy.stats.norm.ppf per element: its argument and output, and the float64 arrays and boolean masks 
+# of its argument checks, traced at up to 74 bytes per element
+_PPF_BYTES = 80
+# the same for scipy.stats.norm.cdf, traced at up to 51 bytes per element
+_CDF_BYTES = 56
+# the temporaries of embody._truncnorm_mean_var per element: its float64 intermediate arrays and masks, traced at up to 174 bytes
+_TRUNCNORM_BYTES = 176
+# the allocations of a phase that do not grow with the data: frames, small lists and the argument checks of scipy, 
+# traced at up to 13 KB for a call of norm.ppf
+_FIXED_BYTES = 2**15
+_UNITS = {'B': 1, 'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+# whether the fits started in the current context trace their memory, see trace_memory
+_tracing = ContextVar('tracing', default=False)
+
+
+def _parse_bytes(memory):
+    """
+    The number of bytes of memory, given as a number of bytes or as a string such as '512MB' or '4 GB' (in powers of 1024)
+    """
+    if isinstance(memory, str):
+        match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?B)?\s*', memory.upper())
+        if match is None:
+            raise ValueError(f'Cannot read the memory size {memory!r}, expected a number of bytes or a string such as "4GB"')
+        return int(float(match.group(1)) * _UNITS[match.group(2) or 'B'])
+    return int(memory)
+
+
+@contextmanager
+def trace_memory():
+    """
+    Traces the memory of the fits run within the block, so that their memory plans record the peak memory observed in each phase. 
+    Tracing is off otherwise, since tracemalloc slows down every allocation: it is meant for diagnostics and tests
+    """
+    token = _tracing.set(True)
+    try:
+        yield
+    finally:
+        _tracing.reset(token)
+
+
+def _format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1024:
+            return f'{nbytes:.0f} {unit}' if unit == 'B' else f'{nbytes:.1f} {unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f} TB'
+
+
+class MemoryPlan():
+    '''
+    The planned peak memory of each phase of a fit, for the row chunk size and the number of workers chosen to fit within a memory limit,
+    together with the peak memory observed in this process while each phase ran, if the fit ran within trace_memory.
+    The planned memory of a phase is split into the memory of this process, and the memory of the worker pool
+    (its processes and shared memory buffers). Both count the arrays allocated by the fit, not the data passed to it.
+    The observed memory is traced by tracemalloc, so it only covers this process.
+
+    Attributes
+    ----------
+    memory_limit: int
+        the memory budget in bytes.
+    chunk_size: int
+        the number of rows processed at once by the chunked phases.
+    max_workers: int
+        the number of workers.
+    planned: dict
+        for each phase, the planned peak memory of this process and of the worker pool, in bytes.
+    observed: dict
+        for each phase that ran, the peak memory traced in this process, in bytes. Empty unless the fit ran within trace_memory.
+
+    Methods
+    -------
+    choose:
+        find the largest number of workers, and then the largest row chunk size, whose planned peak memory fits within the memory limit.
+    trace:
+        trace the memory of this process while the phases of the fit run, within trace_memory.
+    phase:
+        start a phase of the fit, whose observed peak memory is recorded until the next phase starts.
+    '''
+    def __init__(self, memory_limit, chunk_size, max_workers, planned):
+        self.memory_limit = memory_limit
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.planned = planned
+        self.observed = {}
+        self._base = None
+        self._phase = None
+
+    @property
+    def peak(self):
+        """
+        The planned peak memory over the phases, in bytes
+        """
+        return max(sum(planned) for planned in self.planned.values())
+
+    @classmethod
+    def choose(cls, memory_limit, estimate, max_chunk_size, max_workers, min_chunk_size=64, hint=''):
+        """
+        Plans a fit within memory_limit: the number of workers is lowered from max_workers, and for each the row chunk size
+        is halved from max_chunk_size down to min_chunk_size, until the planned peak memory fits.
+
+        Args:
+            memory_limit (int or str): the memory budget, in bytes or as a string such as '4GB'
+            estimate (callable): estimate(chunk_size, max_workers) returns the planned memory of each phase,
+                as (bytes of this process, bytes of the worker pool)
+            max_chunk_size (positive int): the largest row chunk size, usually the number of rows
+            max_workers (positive int or None): the largest number of workers, min(32, os.cpu_count()+4) if None
+            hint (str): appended to the error message when the fit cannot be planned within memory_limit
+        Returns:
+            plan (MemoryPlan): the plan with the most workers, and then the largest chunks, that fits
+        """
+        memory_limit = _parse_bytes(memory_limit)
+        if max_workers is None:
+            max_workers = min(32, os.cpu_count()+4)
+        chunk_sizes = [max(int(max_chunk_size), 1)]
+        while chunk_sizes[-1] > min_chunk_size:
+            chunk_sizes.append(max(chunk_sizes[-1] // 2, min_chunk_size))
+        for workers in range(max_workers, 0, -1):
+            for chunk_size in chunk_sizes:
+                plan = cls(memory_limit, chunk_size, workers, estimate(chunk_size, workers))
+                if plan.peak <= memory_limit:
+                    return plan
+        message = (f'The fit needs an estimated {_format_bytes(plan.peak)}, above the memory limit of {_format_bytes(memory_limit)}, '
+                   f'even with {plan.chunk_size} rows per chunk and a single worker:\n{plan}')
+        raise MemoryError(message + ('\n' + hint if hint else ''))
+
+    @contextmanager
+    def trace(self):
+        """
+        Traces the memory allocated in this process while the block runs, so that phase records the observed peaks. 
+        Nothing is traced unless the block runs within trace_memory. 
+        tracemalloc is started if it is not already, and stopped at the end of the block
+        """
+        if not _tracing.get():
+            yield self
+            return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        self._base = tracemalloc.get_traced_memory()[0]
+        try:
+            yield self
+        finally:
+            self._end_phase()
+            self._base = None
+            if started:
+                tracemalloc.stop()
+
+    def phase(self, name):
+        """
+        Ends the current phase, recording its observed peak, and starts the phase name. 
+        The peak of a phase is counted from the start of trace, and kept over the times the phase runs. Nothing is recorded outside of trace
+        """
+        if self._base is None:
+            return
+        self._end_phase()
+        self._phase = name
+        tracemalloc.reset_peak()
+
+    def _end_phase(self):
+        if self._phase is not None:
+            peak = tracemalloc.get_traced_memory()[1] - self._base
+            self.observed[self._phase] = max(self.observed.get(self._phase, 0), peak)
+            self._phase = None
+
+    def __str__(self):
+        lines = [f'memory limit {_format_bytes(self.memory_limit)}, {self.chunk_size} rows per chunk, {self.max_workers} worker(s)',
+                 f'{"phase":<12}{"planned":>12}{"(workers)":>12}{"observed":>12}']
+        for name, (process, pool) in self.planned.items():
+            observed = _format_bytes(self.observed[name]) if name in self.observed else '-'
+            lines.append(f'{name:<12}{_format_bytes(process + pool):>12}{_format_bytes(pool):>12}{observed:>12}')
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return str(self)
@@ -2,27 +2,32 @@ from .online_transform_function import OnlineTransformFunction
 from scipy.stats import norm, truncnorm
 import numpy as np
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor
 from .expectation_maximization import ExpectationMaximization
 from .embody import _em_step_body_, _em_step_body, _em_step_body_row
+from .online_snapshot import OnlineSnapshot
 from collections import defaultdict
 import os
 
 
 class OnlineExpectationMaximization(ExpectationMaximization):
-    def __init__(self, cont_indices, ord_indices, window_size=200, sigma_init=None):
-        self.transform_function = OnlineTransformFunction(cont_indices, ord_indices, window_size=window_size)
+    def __init__(self, cont_indices, ord_indices, window_size=200, sigma_init=None, dtype=np.float64, sigma_dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.sigma_dtype = np.dtype(sigma_dtype)
+        self.transform_function = OnlineTransformFunction(cont_indices, ord_indices, window_size=window_size, dtype=self.dtype)
         self.cont_indices = cont_indices
         self.ord_indices = ord_indices
         # we assume boolean array of indices
         p = len(cont_indices)
         # By default, sigma corresponds to the correlation matrix of the permuted dataset (ordinals appear first, then continuous)
         if sigma_init is not None:
-            self.sigma = sigma_init
+            self.sigma = np.asarray(sigma_init, dtype=self.sigma_dtype)
         else:
-            self.sigma = np.identity(p)
+            self.sigma = np.identity(p, dtype=self.sigma_dtype)
         # track what iteration the algorithm is on for use in weighting samples
         self.iteration = 1
+        self.memory_plan = None
+        self.snapshot = None
+        self._pool = None
 
 
         # For online/offline evaluation
@@ -103,18 +108,20 @@ class OnlineExpectationMaximization(ExpectationMaximization):
 
 
 
-    # TO DO: add a function attribute which takes estimated model and new point as input to return immediate imputaiton
-    #  that would serve as out-of-sample prediction without updating the model parameter. Computation will be smaller but the complexity is still O(p^3)
-    def partial_fit_and_predict(self, X_batch, max_workers=4, num_ord_updates=2, decay_coef=0.5, sigma_update=True, marginal_update = True, sigma_out=False, seed = 1):
+    def partial_fit_and_predict(self, X_batch, max_workers=4, num_ord_updates=2, decay_coef=0.5, sigma_update=True, marginal_update = True, sigma_out=False, seed = 1, 
+                                target_columns=None):
         """
         Updates the fit of the copula using the data in X_batch and returns the 
-        imputed values and the new correlation for the copula
+        imputed values and the new correlation for the copula.
+        The updated model is published as a new OnlineSnapshot in snapshot, before the batch is transformed back
 
         Args:
             X_batch (matrix): data matrix with entries to use to update copula and be imputed
             max_workers (positive int): the maximum number of workers for parallelism 
             num_ord_updates (positive int): the number of times to re-estimate the latent ordinals per batch
             decay_coef (float in (0,1)): tunes how much to weight new covariance estimates
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute, the other missing entries are left missing. 
+                Only the conditional means of these columns are computed when sigma is neither updated nor returned
         Returns:
             X_imp (matrix): X_batch with missing values imputed
         """
@@ -127,19 +134,23 @@ class OnlineExpectationMaximization(ExpectationMaximization):
         # update marginals with the new batch
         #self.transform_function.partial_fit(X_batch)
         # print("X_batch", X_batch)
-        res = self._fit_covariance(X_batch, max_workers, num_ord_updates, decay_coef, sigma_update, sigma_out, seed)
+        targets, latent_targets = self._target_masks(target_columns, X_batch.shape[1])
+        res = self._fit_covariance(X_batch, max_workers, num_ord_updates, decay_coef, sigma_update, sigma_out, seed, latent_targets)
         if sigma_out:
             Z_batch_imp, sigma = res
         else:
             Z_batch_imp = res
+        if self.snapshot is None or sigma_update or marginal_update:
+            # a single reference assignment, so that readers see either the previous version or this one
+            self.snapshot = OnlineSnapshot(self, 1 if self.snapshot is None else self.snapshot.version + 1)
         # Rearrange Z_imp so that it's columns correspond to the columns of X
         # print("Z_batch_imp", Z_batch_imp)
         Z_imp_rearranged = np.empty(X_batch.shape)
         Z_imp_rearranged[:,self.ord_indices] = Z_batch_imp[:,:np.sum(self.ord_indices)]
         Z_imp_rearranged[:,self.cont_indices] = Z_batch_imp[:,np.sum(self.ord_indices):]
         X_imp = np.empty(X_batch.shape)
-        X_imp[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X_batch)
-        X_imp[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X_batch)
+        X_imp[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X_batch, targets)
+        X_imp[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X_batch, targets)
         #if not update:
             #self.transform_function.window = old_window
             #self.transform_function.update_pos = old_update_pos 
@@ -149,7 +160,7 @@ class OnlineExpectationMaximization(ExpectationMaximization):
         else:
             return X_imp
 
-    def _fit_covariance(self, X_batch, max_workers=4, num_ord_updates=2, decay_coef=0.5, update=True, sigma_out=False, seed = 1):
+    def _fit_covariance(self, X_batch, max_workers=4, num_ord_updates=2, decay_coef=0.5, update=True, sigma_out=False, seed = 1, targets=None):
         """
         Updates the covariance matrix of the gaussian copula using the data 
         in X_batch and returns the imputed latent values corresponding to 
@@ -160,6 +171,8 @@ class OnlineExpectationMaximization(ExpectationMaximization):
             max_workers: the maximum number of workers for parallelism 
             num_ord_updates: the number of times to restimate the latent ordinals per batch
             decay_coef (float in (0,1)): tunes how much to weight new covariance estimates
+            targets (array or None): boolean, true at the latent columns to impute. 
+                Only used when neither update nor sigma_out, since the covariance estimate needs all conditionals
         Returns:
             sigma (matrix): an updated estimate of the covariance of the copula
             Z_imp (matrix): estimates of latent values in X_batch
@@ -167,7 +180,7 @@ class OnlineExpectationMaximization(ExpectationMaximization):
         Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X_batch) 
         #print("ordinal lower size: "+str(Z_ord_lower.shape))
         #print("all missing: "+str(np.all(np.isnan(Z_ord_lower))))
-        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, seed)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, np.random.default_rng(seed))
         Z_cont = self.transform_function.partial_evaluate_cont_latent(X_batch) 
         # Latent variable matrix with columns sorted as ordinal, continuous
         Z = np.concatenate((Z_ord, Z_cont), axis=1)
@@ -178,21 +191,16 @@ class OnlineExpectationMaximization(ExpectationMaximization):
         C = np.zeros((p, p))
         if max_workers is None:
             max_workers = min(32, os.cpu_count()+4)
+        if update or sigma_out:
+            targets = None
         if max_workers==1:
-            C, Z_imp, Z = _em_step_body(Z, Z_ord_lower, Z_ord_upper, prev_sigma, num_ord_updates)
+            C, Z_imp, Z = _em_step_body(Z, Z_ord_lower, Z_ord_upper, prev_sigma, num_ord_updates, targets=targets)
         else:
-            divide = batch_size/max_workers * np.arange(max_workers+1)
-            divide = divide.astype(int)
-            args = [(Z[divide[i]:divide[i+1],:], Z_ord_lower[divide[i]:divide[i+1],:], Z_ord_upper[divide[i]:divide[i+1],:], prev_sigma, num_ord_updates) for i in range(max_workers)]
-            # divide each batch into max_workers parts instead of n parts
-            with ProcessPoolExecutor(max_workers=max_workers) as pool:
-                res = pool.map(_em_step_body_, args)
-                for i,(C_divide, Z_imp_divide, Z_divide) in enumerate(res):
-                    Z_imp[divide[i]:divide[i+1],:] = Z_imp_divide
-                    Z[divide[i]:divide[i+1],:] = Z_divide # not necessary if we only do on EM iteration 
-                    C += C_divide
+            C, Z_imp, Z = self._em_step_parallel(Z, Z_ord_lower, Z_ord_upper, prev_sigma, max_workers, num_ord_updates, targets=targets)
+        if targets is not None:
+            return Z_imp
         C = C/batch_size
-        sigma = np.cov(Z_imp, rowvar=False) + C
+        sigma = np.cov(Z_imp, rowvar=False, dtype=Z_imp.dtype) + C
         #print("Zimp nan: "+str(np.sum(np.isnan(Z_imp))))
         #print("incremental sigma: ")
         #print("sigma nan: "+str(np.sum(np.isnan(sigma))))
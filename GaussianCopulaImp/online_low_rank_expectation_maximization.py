@@ -0,0 +1,190 @@
+from .online_transform_function import OnlineTransformFunction
+from .low_rank_expectation_maximization import LowRankExpectationMaximization
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+
+class OnlineLowRankExpectationMaximization(LowRankExpectationMaximization):
+    '''
+    Online counterpart of LowRankExpectationMaximization: the marginals are estimated from the lookback window of an OnlineTransformFunction,
+    and W and sigma are updated at each new batch of data points from decayed sufficient statistics of the low rank EM.
+    The statistics are kept in the coordinates of the latent factors, so that they can be accumulated across batches fitted with different W.
+    Each batch is imputed at O(p rank^2) cost per row.
+
+    Methods
+    -------
+    fit_one_pass:
+        fit the model on the sequential batches of X and impute each batch with the model fitted on the previous ones.
+    partial_fit_and_predict:
+        update the model with a new batch of data points and impute it.
+    get_sigma:
+        return the copula correlation W W^T + sigma I in the original variable order.
+    '''
+    def __init__(self, cont_indices, ord_indices, rank, window_size=200, W_init=None, sigma_init=None, dtype=np.float64, sigma_dtype=np.float64,
+                 svd_oversampling=10, svd_power_iter=2):
+        '''
+        W_init (p by rank, in the original variable order) and sigma_init provide the initial model. 
+        If sigma_init is None, it is chosen so that W_init W_init^T + sigma_init I has unit diagonal on average. 
+        If W_init is None, both W and sigma are initialized from the first batch as in the offline fit, 
+        and sigma_init must then be None.
+        '''
+        if W_init is None and sigma_init is not None:
+            raise ValueError('sigma_init is only used together with W_init')
+        self.dtype = np.dtype(dtype)
+        self.sigma_dtype = np.dtype(sigma_dtype)
+        self.svd_oversampling = svd_oversampling
+        self.svd_power_iter = svd_power_iter
+        self.transform_function = OnlineTransformFunction(cont_indices, ord_indices, window_size=window_size, dtype=self.dtype)
+        self.cont_indices = cont_indices
+        self.ord_indices = ord_indices
+        self.rank = rank
+        # By default, the rows of W correspond to the permuted variables (ordinals appear first, then continuous)
+        if W_init is not None:
+            W_init = np.asarray(W_init, dtype=self.sigma_dtype)
+            self.W = np.concatenate((W_init[ord_indices], W_init[cont_indices]), axis=0)
+            self.sigma = 1 - np.mean(np.sum(np.square(self.W), axis=1)) if sigma_init is None else sigma_init
+        else:
+            self.W = None
+            self.sigma = None
+        # decayed sufficient statistics of the batches seen so far, each averaged over the rows of its batch
+        self._stats = None
+        # track what iteration the algorithm is on for use in weighting samples
+        self.iteration = 1
+        self.memory_plan = None
+        self._pool = None
+
+    def fit_one_pass(self, X, BATCH_SIZE=10, decay_coef=0.5, batch_c=5, constant_decay_coef = True, max_workers=1, num_ord_updates=1, sigma_diff_output = False):
+        n,p = X.shape
+        Ximp = np.empty(X.shape)
+        j=0
+        if sigma_diff_output:
+            type = {'F', 'S', 'N'} # can be a parameter
+            sigma_old = None
+            sigma_diff = defaultdict(list)
+        while True:
+            start = j*BATCH_SIZE
+            end = min((j+1)*BATCH_SIZE, n)
+            if start >= n:
+                break
+            indices = np.arange(start, end, 1)
+            if not constant_decay_coef:
+                decay_coef = batch_c/(j+batch_c)
+            Ximp[indices,:] = self.partial_fit_and_predict(X[indices,:], max_workers=max_workers, num_ord_updates=num_ord_updates, decay_coef=decay_coef)
+            if sigma_diff_output:
+                sigma_new = self.get_sigma()
+                # the first batch initializes the model
+                if sigma_old is not None:
+                    d = self.get_matrix_diff(sigma_old, sigma_new, type)
+                    for t in type:
+                        sigma_diff[t].append(d[t])
+                sigma_old = sigma_new
+            j += 1
+        if sigma_diff_output:
+            return Ximp, pd.DataFrame(sigma_diff)
+        else:
+            return Ximp
+
+    def partial_fit_and_predict(self, X_batch, max_workers=1, num_ord_updates=1, decay_coef=0.5, sigma_update=True, marginal_update = True, sigma_out=False, seed = 1, 
+                                target_columns=None):
+        """
+        Updates the fit of the low rank copula using the data in X_batch and returns the
+        imputed values and the new correlation for the copula
+
+        Args:
+            X_batch (matrix): data matrix with entries to use to update copula and be imputed
+            max_workers (positive int): the maximum number of workers for parallelism 
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals per batch
+            decay_coef (float in (0,1)): tunes how much to weight the sufficient statistics of the new batch
+            sigma_update (bool): if False, W, sigma and the sufficient statistics are left unchanged
+            marginal_update (bool): if False, the marginal window is left unchanged
+            sigma_out (bool): if True, the updated copula correlation is also returned
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute, the other missing entries are left missing
+        Returns:
+            X_imp (matrix): X_batch with missing values imputed
+            sigma (matrix): the copula correlation in the original variable order, if sigma_out
+        """
+        if marginal_update:
+            self.transform_function.partial_fit(X_batch)
+        targets, latent_targets = self._target_masks(target_columns, X_batch.shape[1])
+        Z_batch_imp, W, sigma = self._fit_covariance(X_batch, max_workers, num_ord_updates, decay_coef, sigma_update, seed, latent_targets)
+        # Rearrange Z_imp so that it's columns correspond to the columns of X
+        _order = self.back_to_original_order()
+        Z_imp_rearranged = Z_batch_imp[:,_order]
+        X_imp = np.empty(X_batch.shape)
+        X_imp[:,self.cont_indices] = self.transform_function.partial_evaluate_cont_observed(Z_imp_rearranged, X_batch, targets)
+        X_imp[:,self.ord_indices] = self.transform_function.partial_evaluate_ord_observed(Z_imp_rearranged, X_batch, targets)
+        if sigma_out:
+            return X_imp, self.get_sigma(W, sigma)
+        else:
+            return X_imp
+
+    def _fit_covariance(self, X_batch, max_workers=1, num_ord_updates=1, decay_coef=0.5, update=True, seed = 1, targets=None):
+        """
+        Updates W and sigma using the data in X_batch and returns the imputed latent values of X_batch,
+        from the model before the update as in the full rank online EM, together with the updated W and sigma.
+        The E-step statistics of the batch are mapped from the coordinates of the singular vectors of W to those of the latent factors t,
+        with E[t_i] = V D^{-1} S_i for W = U D V^T, and blended with the previous statistics with weight decay_coef.
+
+        Args:
+            X_batch (matrix): data matrix with which to update copula and with entries to be imputed
+            max_workers: the maximum number of workers for parallelism 
+            num_ord_updates: the number of times to restimate the latent ordinals per batch
+            decay_coef (float in (0,1)): tunes how much to weight the sufficient statistics of the new batch
+            update (bool): if True, W, sigma and the sufficient statistics are updated
+            targets (array or None): boolean, true at the latent columns whose missing entries are imputed, all columns if None
+        Returns:
+            Z_imp (matrix): estimates of latent values in X_batch
+            W (matrix): the updated estimate of the latent coefficient matrix
+            sigma (scalar): the updated estimate of the latent noise variance
+        """
+        Z_ord_lower, Z_ord_upper = self.transform_function.partial_evaluate_ord_latent(X_batch)
+        rng = np.random.default_rng(seed)
+        Z_ord = self._init_Z_ord(Z_ord_lower, Z_ord_upper, rng)
+        Z_cont = self.transform_function.partial_evaluate_cont_latent(X_batch)
+        # Latent variable matrix with columns sorted as ordinal, continuous
+        Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        batch_size = Z.shape[0]
+        if self.W is None:
+            W, sigma, Z = self._init_W_sigma(Z, self.rank, Z_ord_lower, Z_ord_upper, rng)
+            if update:
+                self.W, self.sigma = W, sigma
+        else:
+            W, sigma = self.W, self.sigma
+        U,d,V = np.linalg.svd(W, full_matrices=False)
+        F, R, C, z_sq, _ = self._e_step(Z, Z_ord_lower, Z_ord_upper, U, d, sigma, max_workers, num_ord_updates=num_ord_updates)
+        _, Z_imp = self._impute_latent(Z, W, sigma, U, d, max_workers, targets)
+
+        # E[t_i] = M S_i
+        M = V.T / d
+        stats = {'F': np.matmul(np.matmul(M, F), M.T)/batch_size,
+                 'R': np.dot(R, M.T)/batch_size,
+                 'zz': (z_sq + C.sum())/batch_size,
+                 'count': np.sum(~np.isnan(Z))/batch_size}
+        if self._stats is not None:
+            stats = {k: decay_coef*v + (1 - decay_coef)*self._stats[k] for k,v in stats.items()}
+        # M-step: one rank by rank system per column j
+        W_new = np.linalg.solve(stats['F'], stats['R'][:,:,np.newaxis])[:,:,0]
+        sigma_new = (stats['zz'] - np.sum(stats['R'] * W_new))/stats['count']
+        W_new, sigma_new = self._scale_corr(W_new.astype(self.sigma_dtype, copy=False), sigma_new)
+        if update:
+            self.W, self.sigma, self._stats = W_new, sigma_new, stats
+            self.iteration += 1
+        return Z_imp, W_new, sigma_new
+
+    def marginal_update(self, X_batch):
+        '''
+        Useful as empirical distribution information for each variable
+
+        '''
+        self.transform_function.partial_fit(X_batch)
+
+    def get_sigma(self, W=None, sigma=None):
+        """
+        Return the copula correlation matrix W W^T + sigma I corresponding to the original variable order.
+        """
+        if W is None:
+            W, sigma = self.W, self.sigma
+        _order = self.back_to_original_order()
+        W_rearranged = W[_order]
+        return np.dot(W_rearranged, W_rearranged.T) + sigma * np.identity(W.shape[0])
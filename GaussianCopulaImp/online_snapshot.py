@@ -0,0 +1,82 @@
+from .embody import _em_step_body, _precision, _init_Z_ord
+from .online_transform_function import _read_only_copy
+import numpy as np
+
+
+class OnlineSnapshot():
+    '''
+    An immutable version of the Gaussian copula fitted online: the copula correlation and the marginal windows
+    of an ExpectationMaximization fitted by partial_fit_and_predict, as they were when the version was published.
+    The learner publishes a new snapshot after each batch by replacing its snapshot attribute, a single reference assignment,
+    so that other threads can read the latest snapshot and impute from it while batches are ingested, without locks.
+    A snapshot holds read-only copies of the few arrays it reads, made when it is published, and no reference to the learner,
+    so that it stays valid for as long as a reader holds it.
+
+    Attributes
+    ----------
+    version: int
+        the number of batches ingested when the snapshot was published.
+    sigma: numpy array
+        numpy array of shape (p, p), the copula correlation matrix with the ordinals first.
+    precision: numpy array or None
+        the inverse of sigma used by the E-step, None if sigma is not numerically positive definite.
+
+    Methods
+    -------
+    transform:
+        impute the missing entries of new data points from the snapshot.
+    get_sigma:
+        return the copula correlation in the original variable order.
+    '''
+    __slots__ = ('version', 'sigma', 'precision', '_marginals', '_order')
+
+    def __init__(self, model, version):
+        '''
+        model is the ExpectationMaximization whose current copula and marginal windows are published as the version.
+        '''
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'sigma', _read_only_copy(model.sigma))
+        precision = _precision(self.sigma) if len(self.sigma) > 0 else None
+        object.__setattr__(self, 'precision', None if precision is None else _read_only_copy(precision))
+        object.__setattr__(self, '_marginals', model.transform_function.frozen_copy())
+        object.__setattr__(self, '_order', _read_only_copy(model.back_to_original_order()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('OnlineSnapshot is immutable')
+
+    def transform(self, X, num_ord_updates=1, seed=1, target_columns=None):
+        """
+        Imputes the missing entries of new data points X from the snapshot, see ExpectationMaximization.transform.
+        The snapshot is not modified, so that any number of threads can impute from it at once
+
+        Args:
+            X (matrix): data matrix with entries to be imputed, with the same columns as the data the model was fitted on
+            num_ord_updates (positive int): the number of times to re-estimate the latent ordinals
+            seed: the seed for the initialization of the latent ordinals
+            target_columns (array or None): the indices, or a boolean mask, of the columns to impute, the other missing entries are left missing
+        Returns:
+            X_imp (matrix): X with missing values imputed
+        """
+        marginals = self._marginals
+        targets = latent_targets = None
+        if target_columns is not None:
+            targets = np.zeros(X.shape[1], dtype=bool)
+            targets[np.asarray(target_columns)] = True
+            latent_targets = np.concatenate((targets[marginals.ord_indices], targets[marginals.cont_indices]))
+        Z_ord_lower, Z_ord_upper = marginals.partial_evaluate_ord_latent(X)
+        Z_ord = _init_Z_ord(Z_ord_lower, Z_ord_upper, np.random.default_rng(seed))
+        Z_cont = marginals.partial_evaluate_cont_latent(X)
+        Z = np.concatenate((Z_ord, Z_cont), axis=1)
+        _, Z_imp, _ = _em_step_body(Z, Z_ord_lower, Z_ord_upper, self.sigma, num_ord_updates, targets=latent_targets, precision=self.precision)
+        # Rearrange Z_imp so that it's columns correspond to the columns of X
+        Z_imp_rearranged = Z_imp[:,self._order]
+        X_imp = np.empty(X.shape)
+        X_imp[:,marginals.cont_indices] = marginals.partial_evaluate_cont_observed(Z_imp_rearranged, X, targets)
+        X_imp[:,marginals.ord_indices] = marginals.partial_evaluate_ord_observed(Z_imp_rearranged, X, targets)
+        return X_imp
+
+    def get_sigma(self):
+        """
+        The copula correlation matrix in the original variable order
+        """
+        return self.sigma[np.ix_(self._order, self._order)]
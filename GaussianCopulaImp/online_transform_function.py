@@ -1,12 +1,44 @@
 import numpy as np
 from scipy.stats import norm
-from statsmodels.distributions.empirical_distribution import ECDF
+from .transform_function import _ecdf_sorted, _quantile_sorted, _inverse_ecdf_sorted
+
+
+def _replace_sorted(sorted_data, removed, inserted):
+    """
+    Remove the values removed from the sorted array sorted_data and insert the values inserted, keeping the result sorted.
+    Positions are found by binary search and the update is a single vectorized delete and insert, instead of a full sort.
+    """
+    if len(removed) >= len(sorted_data):
+        return np.sort(inserted)
+    removed = np.sort(removed)
+    # shift repeated values to consecutive positions so that each copy is removed once
+    positions = np.searchsorted(sorted_data, removed, side='left') + np.arange(len(removed)) - np.searchsorted(removed, removed, side='left')
+    kept = np.delete(sorted_data, positions)
+    inserted = np.sort(inserted)
+    return np.insert(kept, np.searchsorted(kept, inserted), inserted)
+
+def _read_only_copy(array):
+    """
+    A copy of array that cannot be modified in place
+    """
+    array = np.array(array)
+    array.flags.writeable = False
+    return array
+
+def _sorted_ord_threshold(sorted_data):
+    """
+    half the min difference between two distinct values of the sorted data, nan if there is a single distinct value
+    """
+    gaps = np.diff(sorted_data)
+    gaps = gaps[gaps > 0]
+    return np.min(gaps)/2.0 if len(gaps) > 0 else np.nan
+
 
 
 class OnlineTransformFunction():
-    def __init__(self, cont_indices, ord_indices, X=None, window_size=100):
+    def __init__(self, cont_indices, ord_indices, X=None, window_size=100, dtype=np.float64):
         """
-        Require window_size to be positive integers.
+        Require window_size to be positive integers. The latent values and bounds are returned with the floating point type dtype.
 
         To initialize the window, 
         for continuous columns, sample standatd normal with mean and variance determined by the first batch of observation;
@@ -17,9 +49,13 @@ class OnlineTransformFunction():
         self.ord_indices = ord_indices
         p = len(cont_indices)
         self.window_size = window_size
+        self.dtype = np.dtype(dtype)
         #self.window = np.array([[np.nan for x in range(p)] for y in range(self.window_size)]).astype(np.float64)
         self.window = np.ones((self.window_size, p), dtype=np.float64) * np.nan
         self.update_pos = np.zeros(p, dtype=np.int64)
+        # the window of each column kept in sorted order, and the ordinal level spacing in the window
+        self.sorted_window = np.copy(self.window)
+        self.ord_thresholds = np.ones(p) * np.nan
         if X is not None:
             self.partial_fit(X)
         
@@ -47,24 +83,42 @@ class OnlineTransformFunction():
                         self.window[:,j].fill(0)
                     else:
                         self.window[:, j] = np.random.randint(min_ord, max_ord+1, size=self.window_size)
-        # update for new data
-        for row in X_batch:
-            for col_num in range(len(row)):
-                data = row[col_num]
-                if not np.isnan(data):
-                    self.window[self.update_pos[col_num], col_num] = data
-                    self.update_pos[col_num] += 1 
-                    if self.update_pos[col_num] >= self.window_size:
-                        self.update_pos[col_num] = 0
+            self.sorted_window = np.sort(self.window, axis=0)
+        # update for new data: the ring buffer and the sorted window of each column are updated with one bulk write and evict
+        for col_num in range(X_batch.shape[1]):
+            x_col = X_batch[:, col_num]
+            x_obs = x_col[~np.isnan(x_col)]
+            k = len(x_obs)
+            if k == 0:
+                continue
+            # only the last window_size values remain in the window
+            x_new = x_obs[-self.window_size:]
+            positions = (self.update_pos[col_num] + np.arange(k - len(x_new), k)) % self.window_size
+            evicted = self.window[positions, col_num]
+            self.window[positions, col_num] = x_new
+            self.update_pos[col_num] = (self.update_pos[col_num] + k) % self.window_size
+            self.sorted_window[:, col_num] = _replace_sorted(self.sorted_window[:, col_num], evicted, x_new)
+        for j in np.flatnonzero(self.ord_indices):
+            self.ord_thresholds[j] = _sorted_ord_threshold(self.sorted_window[:, j])
 
 
+    def frozen_copy(self):
+        """
+        A copy of the marginals for the partial_evaluate methods only: it holds read-only copies of the sorted windows 
+        and of the ordinal thresholds, and an empty ring buffer, so that it cannot be updated and later partial_fit calls do not affect it
+        """
+        frozen = OnlineTransformFunction(_read_only_copy(self.cont_indices), _read_only_copy(self.ord_indices), window_size=0, dtype=self.dtype)
+        frozen.sorted_window = _read_only_copy(self.sorted_window)
+        frozen.ord_thresholds = _read_only_copy(self.ord_thresholds)
+        return frozen
+
     def partial_evaluate_cont_latent(self, X_batch):
         """
         Obtain the latent continuous values corresponding to X_batch 
         """
         X_cont = X_batch[:,self.cont_indices]
-        window_cont = self.window[:,self.cont_indices]
-        Z_cont = np.empty(X_cont.shape)
+        window_cont = self.sorted_window[:,self.cont_indices]
+        Z_cont = np.empty(X_cont.shape, dtype=self.dtype)
         Z_cont[:] = np.nan
         for i in range(np.sum(self.cont_indices)):
             # INPUT THE WINDOW FOR EVERY COLUMN
@@ -77,82 +131,85 @@ class OnlineTransformFunction():
         Obtain the latent ordinal values corresponding to X_batch
         """
         X_ord = X_batch[:,self.ord_indices]
-        window_ord = self.window[:,self.ord_indices]
-        Z_ord_lower = np.empty(X_ord.shape)
+        window_ord = self.sorted_window[:,self.ord_indices]
+        thresholds_ord = self.ord_thresholds[self.ord_indices]
+        Z_ord_lower = np.empty(X_ord.shape, dtype=self.dtype)
         Z_ord_lower[:] = np.nan
-        Z_ord_upper = np.empty(X_ord.shape)
+        Z_ord_upper = np.empty(X_ord.shape, dtype=self.dtype)
         Z_ord_upper[:] = np.nan
         for i in range(np.sum(self.ord_indices)):
             missing = np.isnan(X_ord[:,i])
             # INPUT THE WINDOW FOR EVERY COLUMN
-            Z_ord_lower[~missing,i], Z_ord_upper[~missing,i] = self.get_ord_latent(X_ord[~missing,i], window_ord[:,i])
+            Z_ord_lower[~missing,i], Z_ord_upper[~missing,i] = self.get_ord_latent(X_ord[~missing,i], window_ord[:,i], thresholds_ord[i])
         return Z_ord_lower, Z_ord_upper
 
-    def partial_evaluate_cont_observed(self, Z_batch, X_batch=None):
+    def partial_evaluate_cont_observed(self, Z_batch, X_batch=None, target_columns=None):
         """
-        Transform the latent continous variables in Z_batch into corresponding observations
+        Transform the latent continous variables in Z_batch into corresponding observations.
+        If target_columns (boolean, over all columns) is provided, the other columns are left as they are in X_batch
         """
         Z_cont = Z_batch[:,self.cont_indices]
         if X_batch is None:
             X_batch = np.zeros(Z_batch.shape) * np.nan
         X_cont = X_batch[:,self.cont_indices]
         X_cont_imp = np.copy(X_cont)
-        window_cont = self.window[:,self.cont_indices]
-        for i in range(np.sum(self.cont_indices)):
+        window_cont = self.sorted_window[:,self.cont_indices]
+        targets = np.ones(X_cont.shape[1], dtype=bool) if target_columns is None else target_columns[self.cont_indices]
+        for i in np.flatnonzero(targets):
             # if X_batch is not provided, missing will be 1:n
             missing = np.isnan(X_cont[:,i])
             if np.sum(missing)>0:
                 X_cont_imp[missing,i] = self.get_cont_observed(Z_cont[missing,i], window_cont[:,i])
         return X_cont_imp
 
-    def partial_evaluate_ord_observed(self, Z_batch, X_batch=None):
+    def partial_evaluate_ord_observed(self, Z_batch, X_batch=None, target_columns=None):
         """
-        Transform the latent ordinal variables in Z_batch into corresponding observations
+        Transform the latent ordinal variables in Z_batch into corresponding observations.
+        If target_columns (boolean, over all columns) is provided, the other columns are left as they are in X_batch
         """
         Z_ord = Z_batch[:,self.ord_indices]
         if X_batch is None:
             X_batch = np.zeros(Z_batch.shape) * np.nan
         X_ord = X_batch[:, self.ord_indices]
         X_ord_imp = np.copy(X_ord)
-        window_ord = self.window[:,self.ord_indices]
-        for i in range(np.sum(self.ord_indices)):
+        window_ord = self.sorted_window[:,self.ord_indices]
+        targets = np.ones(X_ord.shape[1], dtype=bool) if target_columns is None else target_columns[self.ord_indices]
+        for i in np.flatnonzero(targets):
             missing = np.isnan(X_ord[:,i])
             if np.sum(missing)>0:
                 X_ord_imp[missing,i] = self.get_ord_observed(Z_ord[missing,i], window_ord[:,i])
         return X_ord_imp
 
-    def get_cont_latent(self, x_batch_obs, window):
+    def get_cont_latent(self, x_batch_obs, sorted_window):
         """
         Return the latent variables corresponding to the continuous entries of 
-        self.X. Estimates the CDF columnwise with the empyrical CDF
+        x_batch_obs. Estimates the CDF with the empyrical CDF of the sorted window
         """
-        ecdf = ECDF(window)
-        l = len(window)
-        q = (l / (l + 1.0)) * ecdf(x_batch_obs)
+        l = len(sorted_window)
+        q = (l / (l + 1.0)) * _ecdf_sorted(sorted_window, x_batch_obs)
         q[q==0] = l/(l+1)/2
         if any(q==0):
             print("In get_cont_latent, 0 quantile appears")
         return norm.ppf(q)
 
-    def get_cont_observed(self, z_batch_missing, window):
+    def get_cont_observed(self, z_batch_missing, sorted_window):
         """
         Applies marginal scaling to convert the latent entries in Z corresponding
         to continuous entries to the corresponding imputed oberserved value
         """
         quantiles = norm.cdf(z_batch_missing)
-        return np.quantile(window, quantiles)
+        return _quantile_sorted(sorted_window, quantiles)
 
-    def get_ord_latent(self, x_batch_obs, window):
+    def get_ord_latent(self, x_batch_obs, sorted_window, threshold=None):
         """
-        get the cdf at each point in X_batch
+        get the cdf at each point in X_batch, using the sorted window and 
+        half the min difference between its levels (computed from the window if not provided)
         """
-        # the lower endpoint of the interval for the cdf
-        ecdf = ECDF(window)
-        unique = np.unique(window)
-        if unique.shape[0] > 1:
-            threshold = np.min(np.abs(unique[1:] - unique[:-1]))/2.0
-            z_lower_obs = norm.ppf(ecdf(x_batch_obs - threshold))
-            z_upper_obs = norm.ppf(ecdf(x_batch_obs + threshold))
+        if threshold is None:
+            threshold = _sorted_ord_threshold(sorted_window)
+        if not np.isnan(threshold):
+            z_lower_obs = norm.ppf(_ecdf_sorted(sorted_window, x_batch_obs - threshold))
+            z_upper_obs = norm.ppf(_ecdf_sorted(sorted_window, x_batch_obs + threshold))
         else:
             z_upper_obs = np.inf
             z_lower_obs = -np.inf
@@ -165,15 +222,10 @@ class OnlineTransformFunction():
         return z_lower_obs, z_upper_obs
 
 
-    def get_ord_observed(self, z_batch_missing, window, DECIMAL_PRECISION = 3):
+    def get_ord_observed(self, z_batch_missing, sorted_window, DECIMAL_PRECISION = 3):
         """
         Gets the inverse CDF of Q_batch
         returns: the Q_batch quantiles of the ordinals seen thus far
         """
-        n = len(window)
         x = norm.cdf(z_batch_missing)
-        # round to avoid numerical errors in ceiling function
-        quantile_indices = np.ceil(np.round_((n + 1) * x - 1, DECIMAL_PRECISION))
-        quantile_indices = np.clip(quantile_indices, a_min=0,a_max=n-1).astype(int)
-        sort = np.sort(window)
-        return sort[quantile_indices]        
+        return _inverse_ecdf_sorted(sorted_window, x, DECIMAL_PRECISION)
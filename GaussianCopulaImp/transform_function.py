@@ -1,87 +1,243 @@
 import numpy as np
-from statsmodels.distributions.empirical_distribution import ECDF
+import tempfile
 from scipy.stats import norm
+
+
+def _ecdf_sorted(sorted_data, x):
+    """
+    Evaluates the empirical CDF of sorted_data at x, with a single binary search
+    """
+    return np.searchsorted(sorted_data, x, side='right') / len(sorted_data)
+
+def _quantile_sorted(sorted_data, q):
+    """
+    Equivalent to np.quantile(sorted_data, q) with linear interpolation, for already sorted data
+    """
+    n = len(sorted_data)
+    h = (n - 1) * np.asarray(q)
+    lower = np.clip(np.floor(h), 0, n - 1).astype(int)
+    upper = np.minimum(lower + 1, n - 1)
+    frac = h - lower
+    return sorted_data[lower] + frac * (sorted_data[upper] - sorted_data[lower])
+
+def _inverse_ecdf_sorted(sorted_data, x, DECIMAL_PRECISION = 3):
+    """
+    computes the inverse ecdf (quantile) for x with ecdf given by the already sorted data
+    """
+    n = len(sorted_data)
+    # round to avoid numerical errors in ceiling function
+    quantile_indices = np.ceil(np.round((n + 1) * x - 1, DECIMAL_PRECISION))
+    quantile_indices = np.clip(quantile_indices, a_min=0,a_max=n-1).astype(int)
+    return sorted_data[quantile_indices]
+
+def _ord_threshold(sorted_data):
+    """
+    half the min differenence between two ordinal levels of the sorted data
+    """
+    unique = sorted_data[np.concatenate(([True], np.diff(sorted_data) > 0))]
+    return np.min(unique[1:] - unique[:-1])/2.0
+
+
+def _sorted_columns_from_chunks(read_chunks, scratch_dir=None):
+    """
+    Collects the sorted observed values of each column from the row chunks of the data, out of core. 
+    A first pass counts the observed values of each column, a second pass writes them into the region of their column 
+    in a memory-mapped scratch file, and the regions are then sorted in place one at a time, 
+    so that the memory held is a chunk, or the pages of the column being sorted, which the system can evict.
+
+    Args:
+        read_chunks (callable): returns a new iterable over the row chunks of the data, always in the same order, each time it is called
+        scratch_dir: the directory of the scratch file. The default temporary directory if None
+    Returns:
+        sorted_columns (list): the sorted non-nan values of each column, as float64 views of the scratch file
+        n (int): the total number of rows
+    """
+    counts = None
+    n = 0
+    for X_chunk in read_chunks():
+        X_chunk = np.asarray(X_chunk)
+        if counts is None:
+            counts = np.zeros(X_chunk.shape[1], dtype=np.int64)
+        counts += np.count_nonzero(~np.isnan(X_chunk), axis=0)
+        n += X_chunk.shape[0]
+    if counts is None:
+        return [], 0
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    # the file is deleted once closed, while its mapping stays valid as long as a sorted column refers to it
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch:
+        store = np.memmap(scratch, dtype=np.float64, mode='w+', shape=(max(offsets[-1], 1),))
+    ends = offsets[:-1].copy()
+    for X_chunk in read_chunks():
+        for j, x_col in enumerate(np.asarray(X_chunk).T):
+            x_obs = x_col[~np.isnan(x_col)]
+            store[ends[j]:ends[j]+len(x_obs)] = x_obs
+            ends[j] += len(x_obs)
+    sorted_columns = []
+    for j in range(len(counts)):
+        sorted_col = store[offsets[j]:offsets[j+1]]
+        sorted_col.sort()
+        sorted_columns.append(sorted_col)
+    return sorted_columns, n
+
+
 class TransformFunction():
-    def __init__(self, X, cont_indices, ord_indices):
+    def __init__(self, X, cont_indices, ord_indices, dtype=np.float64):
+        """
+        Estimates the marginals of X. For each column, the sorted observed values are stored once,
+        together with the ordinal level spacing for ordinal columns, so that every forward and inverse marginal mapping
+        is a single binary search or gather. The latent values and bounds are returned with the floating point type dtype.
+        """
         self.X = X
+        sorted_columns = [np.sort(x_col[~np.isnan(x_col)]) for x_col in X.T]
+        self._set_marginals(sorted_columns, X.shape[0], cont_indices, ord_indices, dtype)
+
+    @classmethod
+    def from_sorted_columns(cls, sorted_columns, n, cont_indices, ord_indices, dtype=np.float64):
+        """
+        Builds the marginals from the sorted observed values of each column, without keeping the data matrix, 
+        e.g. when the data is only read in row chunks. 
+        Only the partial_evaluate_* methods are available, since the others evaluate self.X.
+
+        Args:
+            sorted_columns (list): the sorted non-nan values of each column, possibly memory-mapped, which are kept as they are
+            n (int): the number of rows of the data
+        """
+        transform_function = cls.__new__(cls)
+        transform_function.X = None
+        transform_function._set_marginals(sorted_columns, n, cont_indices, ord_indices, dtype)
+        return transform_function
+
+    def _set_marginals(self, sorted_columns, n, cont_indices, ord_indices, dtype):
         self.ord_indices = ord_indices
         self.cont_indices = cont_indices
+        self.dtype = np.dtype(dtype)
+        self.n = n
+        self.cont_sorted = [sorted_columns[j] for j in np.flatnonzero(cont_indices)]
+        self.ord_sorted = [sorted_columns[j] for j in np.flatnonzero(ord_indices)]
+        self.ord_thresholds = [_ord_threshold(sorted_col) for sorted_col in self.ord_sorted]
+
+    def add_columns(self, other):
+        """
+        Appends the marginals of other, estimated on new columns of the same rows, after the existing columns.
+        The existing marginals are kept as they are.
+
+        Args:
+            other (TransformFunction): the marginals of the new columns
+        """
+        if other.n != self.n:
+            raise ValueError(f'The new columns must have one row per row of the data, {self.n}, got {other.n}')
+        self.cont_indices = np.concatenate((self.cont_indices, other.cont_indices))
+        self.ord_indices = np.concatenate((self.ord_indices, other.ord_indices))
+        self.cont_sorted = self.cont_sorted + other.cont_sorted
+        self.ord_sorted = self.ord_sorted + other.ord_sorted
+        self.ord_thresholds = self.ord_thresholds + other.ord_thresholds
+        if self.X is not None:
+            self.X = np.concatenate((self.X, other.X), axis=1) if other.X is not None else None
 
     def get_cont_latent(self):
         """
-        Return the latent variables corresponding to the continuous entries of 
+        Return the latent variables corresponding to the continuous entries of
         self.X. Estimates the CDF columnwise with the empyrical CDF
         """
-        X_cont = self.X[:,self.cont_indices]
-        Z_cont = np.empty(X_cont.shape)
-        n = self.X.shape[0]
-        for i, x_col in enumerate(X_cont.T):
-            missing = np.isnan(x_col)
-            x_col_noNan = x_col[~missing]
-            ecdf = ECDF(x_col_noNan)
-            Z_cont[:,i] = norm.ppf((n / (n + 1.0)) * ecdf(x_col))
+        return self.partial_evaluate_cont_latent(self.X)
+
+    def get_ord_latent(self):
+        """
+        Return the lower and upper ranges of the latent variables corresponding
+        to the ordinal entries of X. Estimates the CDF columnwise with the empyrical CDF
+        """
+        return self.partial_evaluate_ord_latent(self.X)
+
+    def impute_cont_observed(self, Z, target_columns=None):
+        """
+        Applies marginal scaling to convert the latent entries in Z corresponding
+        to continuous entries to the corresponding imputed oberserved value
+        """
+        return self.partial_evaluate_cont_observed(Z, self.X, target_columns)
+
+    def impute_ord_observed(self, Z, target_columns=None):
+        """
+        Applies marginal scaling to convert the latent entries in Z corresponding
+        to ordinal entries to the corresponding imputed oberserved value
+        """
+        return self.partial_evaluate_ord_observed(Z, self.X, target_columns)
+
+    def partial_evaluate_cont_latent(self, X_batch):
+        """
+        Obtain the latent continuous values corresponding to X_batch, using the marginals estimated from self.X.
+        Entries below the smallest value seen in self.X are mapped to half of the smallest empirical quantile.
+        """
+        X_batch_cont = X_batch[:,self.cont_indices]
+        Z_cont = np.empty(X_batch_cont.shape, dtype=self.dtype)
+        n = self.n
+        for i, sorted_col in enumerate(self.cont_sorted):
+            missing = np.isnan(X_batch_cont[:,i])
+            q = (n / (n + 1.0)) * _ecdf_sorted(sorted_col, X_batch_cont[:,i])
+            q[q==0] = (n / (n + 1.0)) / len(sorted_col) / 2.0
+            Z_cont[:,i] = norm.ppf(q)
             # re-add the nan values
             Z_cont[missing,i] = np.nan
         return Z_cont
 
-    def get_ord_latent(self):
+    def partial_evaluate_ord_latent(self, X_batch):
         """
-        Return the lower and upper ranges of the latent variables corresponding 
-        to the ordinal entries of X. Estimates the CDF columnwise with the empyrical CDF
+        Obtain the lower and upper ranges of the latent ordinal values corresponding to X_batch,
+        using the marginals estimated from self.X
         """
-        X_ord = self.X[:,self.ord_indices]
-        Z_ord_lower = np.empty(X_ord.shape)
-        Z_ord_upper = np.empty(X_ord.shape)
-        for i, x_col in enumerate(X_ord.T):
-            missing = np.isnan(x_col)
-            x_col_noNan = x_col[~missing]
-            ecdf = ECDF(x_col_noNan)
-            unique = np.unique(x_col_noNan)
-            # half the min differenence between two ordinals
-            threshold = np.min(np.abs(unique[1:] - unique[:-1]))/2.0
-            Z_ord_lower[:,i] = norm.ppf(ecdf(x_col - threshold))
-            Z_ord_upper[:,i] = norm.ppf(ecdf(x_col + threshold))
+        X_batch_ord = X_batch[:,self.ord_indices]
+        Z_ord_lower = np.empty(X_batch_ord.shape, dtype=self.dtype)
+        Z_ord_upper = np.empty(X_batch_ord.shape, dtype=self.dtype)
+        for i, (sorted_col, threshold) in enumerate(zip(self.ord_sorted, self.ord_thresholds)):
+            missing = np.isnan(X_batch_ord[:,i])
+            Z_ord_lower[:,i] = norm.ppf(_ecdf_sorted(sorted_col, X_batch_ord[:,i] - threshold))
+            Z_ord_upper[:,i] = norm.ppf(_ecdf_sorted(sorted_col, X_batch_ord[:,i] + threshold))
             # re-add the nan values
             Z_ord_lower[missing,i] = np.nan
             Z_ord_upper[missing,i] = np.nan
         return Z_ord_lower, Z_ord_upper
 
-    def impute_cont_observed(self, Z):
+    def partial_evaluate_cont_observed(self, Z_batch, X_batch=None, target_columns=None):
         """
-        Applies marginal scaling to convert the latent entries in Z corresponding
-        to continuous entries to the corresponding imputed oberserved value
+        Transform the latent continous variables in Z_batch into corresponding observations.
+        Only the entries missing in X_batch are imputed; if X_batch is not provided, all entries are transformed.
+        If target_columns (boolean, over all columns) is provided, the other columns are left as they are in X_batch.
         """
-        X_cont = self.X[:, self.cont_indices]
-        Z_cont = Z[:, self.cont_indices]
-        X_imp = np.copy(X_cont)
-        for i, x_col in enumerate(X_cont.T):
-            missing = np.isnan(x_col)
+        Z_cont = Z_batch[:, self.cont_indices]
+        if X_batch is None:
+            X_batch = np.zeros(Z_batch.shape) * np.nan
+        X_imp = np.copy(X_batch[:, self.cont_indices])
+        targets = np.ones(X_imp.shape[1], dtype=bool) if target_columns is None else target_columns[self.cont_indices]
+        for i, sorted_col in enumerate(self.cont_sorted):
+            if not targets[i]:
+                continue
+            missing = np.isnan(X_imp[:,i])
             # Only impute missing entries
-            X_imp[missing,i] = np.quantile(x_col[~missing], norm.cdf(Z_cont[missing,i]))
+            if np.sum(missing)>0:
+                X_imp[missing,i] = _quantile_sorted(sorted_col, norm.cdf(Z_cont[missing,i]))
         return X_imp
 
-    def impute_ord_observed(self, Z):
+    def partial_evaluate_ord_observed(self, Z_batch, X_batch=None, target_columns=None):
         """
-        Applies marginal scaling to convert the latent entries in Z corresponding
-        to ordinal entries to the corresponding imputed oberserved value
+        Transform the latent ordinal variables in Z_batch into corresponding observations.
+        Only the entries missing in X_batch are imputed; if X_batch is not provided, all entries are transformed.
+        If target_columns (boolean, over all columns) is provided, the other columns are left as they are in X_batch.
         """
-        X_ord = self.X[:, self.ord_indices]
-        Z_ord = Z[:, self.ord_indices]
-        X_imp = np.copy(X_ord)
-        for i, x_col in enumerate(X_ord.T):
-            missing = np.isnan(x_col)
+        Z_ord = Z_batch[:, self.ord_indices]
+        if X_batch is None:
+            X_batch = np.zeros(Z_batch.shape) * np.nan
+        X_imp = np.copy(X_batch[:, self.ord_indices])
+        targets = np.ones(X_imp.shape[1], dtype=bool) if target_columns is None else target_columns[self.ord_indices]
+        for i, sorted_col in enumerate(self.ord_sorted):
+            if not targets[i]:
+                continue
+            missing = np.isnan(X_imp[:,i])
             # only impute missing entries
-            X_imp[missing,i] = self.inverse_ecdf(x_col[~missing], norm.cdf(Z_ord[missing,i]))
+            if np.sum(missing)>0:
+                X_imp[missing,i] = _inverse_ecdf_sorted(sorted_col, norm.cdf(Z_ord[missing,i]))
         return X_imp
 
     def inverse_ecdf(self, data, x, DECIMAL_PRECISION = 3):
         """
         computes the inverse ecdf (quantile) for x with ecdf given by data
         """
-        n = len(data)
-        # round to avoid numerical errors in ceiling function
-        quantile_indices = np.ceil(np.round_((n + 1) * x - 1, DECIMAL_PRECISION))
-        quantile_indices = np.clip(quantile_indices, a_min=0,a_max=n-1).astype(int)
-        sort = np.sort(data)
-        return sort[quantile_indices]
-
+        return _inverse_ecdf_sorted(np.sort(data), x, DECIMAL_PRECISION)
@@ -0,0 +1,143 @@
+import numpy as np
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# shared memory segments attached by the current worker process, keyed by segment name
+_attached = {}
+
+
+def _open_segment(name):
+    """
+    Attach an existing shared memory segment without handing it over to the resource tracker of this process
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track argument
+        return shared_memory.SharedMemory(name=name)
+
+
+def _attach(specs):
+    """
+    Return numpy views of the shared arrays described by specs. Segments are attached once per worker process
+    and kept open until the pool replaces them with new segments.
+
+    Args:
+        specs (dict): (segment name, shape, dtype) for each array key
+    Returns:
+        arrays (dict): numpy views of the shared arrays for each array key
+    """
+    names = {name for name, _, _ in specs.values()}
+    for name in list(_attached):
+        if name not in names:
+            _attached.pop(name).close()
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        if name not in _attached:
+            _attached[name] = _open_segment(name)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+    return arrays
+
+
+def _run_chunk(args):
+    """
+    Run func on the rows start:stop of the shared arrays, needed to dereference args to support parallelism
+    """
+    func, specs, start, stop, func_args = args
+    return func(_attach(specs), start, stop, *func_args)
+
+
+def _free(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # a view of the buffer is still alive, the memory is released together with it
+        pass
+    segment.unlink()
+
+
+def _release(executor, segments):
+    executor.shutdown(wait=True)
+    for segment in segments.values():
+        _free(segment)
+    segments.clear()
+
+
+class SharedMemoryPool():
+    '''
+    A long-lived process pool whose workers operate on numpy arrays held in shared memory.
+    Arrays are written once into named shared memory buffers, which are reused across calls as long as they are large enough,
+    so that only the row ranges of each chunk and a few small arguments are pickled to the workers.
+
+    Attributes
+    ----------
+    max_workers: int
+        the number of worker processes
+
+    Methods
+    -------
+    put:
+        copy an array into the shared buffer of a key
+    empty:
+        return the shared buffer of a key, resized to the requested shape
+    map:
+        run a function over row ranges of the shared buffers in the worker processes
+    shutdown:
+        stop the workers and release the shared memory
+    '''
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._segments = {}
+        self._specs = {}
+        self._finalizer = weakref.finalize(self, _release, self._executor, self._segments)
+
+    def empty(self, key, shape, dtype=np.float64):
+        """
+        Return a view of the shared buffer of key with the provided shape and dtype, allocating a larger buffer if needed.
+        The content of the returned array is undefined.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        segment = self._segments.get(key)
+        if segment is None or segment.size < nbytes:
+            if segment is not None:
+                _free(segment)
+            segment = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._segments[key] = segment
+        self._specs[key] = (segment.name, tuple(shape), dtype.str)
+        return self.view(key)
+
+    def put(self, key, array):
+        """
+        Copy array into the shared buffer of key and return the shared view
+        """
+        view = self.empty(key, array.shape, array.dtype)
+        view[...] = array
+        return view
+
+    def view(self, key):
+        """
+        Return the shared view of key as last set by put or empty
+        """
+        name, shape, dtype = self._specs[key]
+        return np.ndarray(shape, dtype=dtype, buffer=self._segments[key].buf)
+
+    def map(self, func, ranges, *args):
+        """
+        Evaluate func(arrays, start, stop, *args) for each (start, stop) in ranges in the worker processes,
+        where arrays is a dict of the shared views. func must be defined at module level and may write its output into the shared views.
+
+        Returns:
+            results (list): the return values of func, in the order of ranges
+        """
+        specs = dict(self._specs)
+        tasks = [(func, specs, start, stop, args) for start, stop in ranges]
+        return list(self._executor.map(_run_chunk, tasks))
+
+    def shutdown(self):
+        """
+        Stop the worker processes and release the shared memory
+        """
+        self._finalizer()
@@ -14,7 +14,6 @@ setup(
         'numpy',
         'pandas',
         'scipy',
-        'statsmodels',
         'tqdm'
     ]
 )
\ No newline at end of file
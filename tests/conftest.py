@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+
+def _mixed_data(n=600, p=6, k=2, seed=0, missing=0.25):
+    """
+    Mixed data from a Gaussian copula with equicorrelated variables, the first k of them ordinal with four levels
+
+    Returns:
+        X (matrix): the complete data
+        X_mask (matrix): X with a fraction missing of its entries, chosen at random, set to nan
+    """
+    rng = np.random.default_rng(seed)
+    sigma = 0.5 * np.ones((p, p)) + 0.5 * np.identity(p)
+    X = rng.multivariate_normal(np.zeros(p), sigma, size=n)
+    X[:, :k] = np.digitize(X[:, :k], [-1, 0, 1])
+    X_mask = X.copy()
+    X_mask[rng.random(X.shape) < missing] = np.nan
+    return X, X_mask
+
+
+@pytest.fixture
+def mixed_data():
+    return _mixed_data
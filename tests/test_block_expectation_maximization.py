@@ -0,0 +1,39 @@
+import numpy as np
+from GaussianCopulaImp.expectation_maximization import ExpectationMaximization
+from GaussianCopulaImp.block_expectation_maximization import BlockExpectationMaximization
+
+
+def test_block_copula_is_block_diagonal(mixed_data):
+    _, X_mask = mixed_data()
+    blocks = [[0, 2, 4], [1, 3, 5]]
+    out = BlockExpectationMaximization(blocks=blocks).impute_missing(X_mask)
+    sigma = out['copula_corr']
+    np.testing.assert_array_equal(sigma[np.ix_(blocks[0], blocks[1])], 0)
+    expected = ExpectationMaximization().impute_missing(X_mask[:, blocks[0]])
+    np.testing.assert_allclose(sigma[np.ix_(blocks[0], blocks[0])], expected['copula_corr'], atol=0.02)
+    assert not np.isnan(out['imputed_data']).any()
+
+
+def test_block_screening_finds_independent_groups(mixed_data):
+    _, first = mixed_data(n=1000, p=3, k=1, seed=1)
+    _, second = mixed_data(n=1000, p=3, k=0, seed=2)
+    columns = np.random.default_rng(0).permutation(6)
+    X_mask = np.concatenate((first, second), axis=1)[:, columns]
+    model = BlockExpectationMaximization()
+    model.impute_missing(X_mask)
+    # columns[j] is the source column of column j, the first three coming from the first group
+    expected = [np.flatnonzero(columns < 3).tolist(), np.flatnonzero(columns >= 3).tolist()]
+    assert sorted(block.tolist() for block in model.blocks) == sorted(expected)
+
+
+def test_block_screening_keeps_weakly_correlated_pairs():
+    rng = np.random.default_rng(0)
+    sigma = np.identity(4)
+    sigma[0, 1] = sigma[1, 0] = 0.1
+    sigma[2, 3] = sigma[3, 2] = 0.5
+    X_mask = rng.multivariate_normal(np.zeros(4), sigma, size=20000)
+    X_mask[rng.random(X_mask.shape) < 0.25] = np.nan
+    model = BlockExpectationMaximization()
+    model.fit(X_mask, max_iter=5)
+    # a fixed floor of 0.1 on the threshold would split the weak pair, which is far above the sampling noise at this n
+    assert sorted(block.tolist() for block in model.blocks) == [[0, 1], [2, 3]]
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from scipy.stats import truncnorm
+from GaussianCopulaImp.embody import _em_step_body, _em_step_body_row, _em_step_body_shared, _truncnorm_mean_var
+from GaussianCopulaImp.worker_pool import SharedMemoryPool
+
+
+def _latent(n, p, k, seed=0):
+    """
+    Latent values of n rows with k ordinals first, their bounds, and a random correlation matrix. 
+    The missingness patterns are random, with some complete rows and one row with nothing observed
+    """
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(p, p))
+    sigma = A @ A.T + p * np.identity(p)
+    sigma /= np.sqrt(np.outer(np.diag(sigma), np.diag(sigma)))
+    Z = rng.multivariate_normal(np.zeros(p), sigma, size=n)
+    r_lower = np.floor(Z[:, :k]) - 0.5
+    r_upper = r_lower + 1
+    Z[:, :k] = rng.uniform(r_lower, r_upper)
+    missing = rng.random((n, p)) < rng.uniform(0, 0.6, size=(n, 1))
+    missing[0] = True
+    missing[1:4] = False
+    Z[missing] = np.nan
+    r_lower[missing[:, :k]] = np.nan
+    r_upper[missing[:, :k]] = np.nan
+    return Z, r_lower, r_upper, sigma
+
+
+def _em_step_rows(Z, r_lower, r_upper, sigma, num_ord_updates, weights):
+    p = Z.shape[1]
+    C = np.zeros((p, p))
+    Z_imp = np.empty(Z.shape)
+    for i in range(Z.shape[0]):
+        C_row, Z_imp[i], Z[i], _ = _em_step_body_row(Z[i], r_lower[i], r_upper[i], sigma, num_ord_updates)
+        C += weights[i] * C_row
+    return C, Z_imp, Z
+
+
+@pytest.mark.parametrize('p', [6, 30])
+@pytest.mark.parametrize('k', [0, 3])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_em_step_body_matches_rows(p, k, weighted):
+    Z, r_lower, r_upper, sigma = _latent(120, p, k)
+    weights = np.random.default_rng(1).integers(1, 4, size=len(Z)) if weighted else np.ones(len(Z))
+    C_rows, Z_imp_rows, Z_rows = _em_step_rows(Z.copy(), r_lower, r_upper, sigma, 2, weights)
+    C, Z_imp, Z_new = _em_step_body(Z.copy(), r_lower, r_upper, sigma, 2, weights if weighted else None)
+    np.testing.assert_allclose(Z_new, Z_rows, rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(Z_imp, Z_imp_rows, rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(C, C_rows, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('p', [6, 30])
+def test_em_step_body_imputes_only_targets(p):
+    Z, r_lower, r_upper, sigma = _latent(80, p, 2)
+    targets = np.zeros(p, dtype=bool)
+    targets[[1, p - 1]] = True
+    _, Z_imp_all, _ = _em_step_body(Z.copy(), r_lower, r_upper, sigma, 1)
+    _, Z_imp, _ = _em_step_body(Z.copy(), r_lower, r_upper, sigma, 1, targets=targets)
+    observed = ~np.isnan(Z)
+    np.testing.assert_allclose(Z_imp[:, targets], Z_imp_all[:, targets], rtol=1e-10, atol=1e-10)
+    assert np.array_equal(~np.isnan(Z_imp[:, ~targets]), observed[:, ~targets])
+
+
+def test_em_step_body_shared_matches_em_step_body():
+    pool = SharedMemoryPool(2)
+    try:
+        # the second call needs larger buffers than the first
+        for n in [50, 200]:
+            Z, r_lower, r_upper, sigma = _latent(n, 8, 3, seed=n)
+            C_expected, Z_imp_expected, Z_expected = _em_step_body(Z.copy(), r_lower, r_upper, sigma, 2)
+            pool.put('Z', Z)
+            pool.put('r_lower', r_lower)
+            pool.put('r_upper', r_upper)
+            pool.put('sigma', sigma)
+            pool.empty('Z_imp', Z.shape)
+            C = sum(pool.map(_em_step_body_shared, [(0, n//2), (n//2, n)], 2))
+            np.testing.assert_allclose(C, C_expected, rtol=1e-10, atol=1e-10)
+            np.testing.assert_allclose(pool.view('Z_imp'), Z_imp_expected, rtol=1e-10, atol=1e-10)
+            np.testing.assert_allclose(pool.view('Z'), Z_expected, rtol=1e-10, atol=1e-10)
+    finally:
+        pool.shutdown()
+
+def test_truncnorm_matches_scipy():
+    rng = np.random.default_rng(0)
+    a = rng.normal(scale=2, size=500)
+    b = a + rng.exponential(scale=1.5, size=500)
+    a[:50] = -np.inf
+    b[50:100] = np.inf
+    loc, scale = rng.normal(size=500), rng.uniform(0.5, 2, size=500)
+    mean, var = _truncnorm_mean_var(a, b, loc, scale)
+    expected_mean, expected_var = truncnorm.stats(a, b, loc, scale, moments='mv')
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(var, expected_var, rtol=1e-8, atol=1e-12)
+
+
+@pytest.mark.parametrize('a, b', [(8, 9), (-40, -39), (30, np.inf), (-np.inf, -30), (-12, -11.9), (37, 38)])
+def test_truncnorm_matches_scipy_in_the_tails(a, b):
+    mean, var = _truncnorm_mean_var(np.array([a]), np.array([b]))
+    expected_mean, expected_var = truncnorm.stats(a, b, moments='mv')
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-12)
+    np.testing.assert_allclose(var, expected_var, rtol=1e-8)
+
+
+@pytest.mark.parametrize('a', [-20.0, -3.0, 0.3, 5.0, 25.0])
+@pytest.mark.parametrize('width', [1e-3, 1e-6, 1e-9])
+def test_truncnorm_narrow_intervals_tend_to_uniform(a, width):
+    # scipy's closed form cancels catastrophically here, the density is nearly flat over the interval
+    mean, var = _truncnorm_mean_var(np.array([a]), np.array([a + width]))
+    assert a <= mean[0] <= a + width
+    np.testing.assert_allclose(mean, a + width/2, rtol=0, atol=max(1, abs(a)) * (width**2 + 1e-15))
+    np.testing.assert_allclose(var, width**2/12, rtol=max(1e-6, (a*width)**2))
+
+
+def test_truncnorm_empty_interval_is_nan():
+    mean, var = _truncnorm_mean_var(np.array([1.0, 0.0]), np.array([0.5, 0.0]))
+    assert np.isnan(mean[0]) and np.isnan(var[0])
+    assert mean[1] == 0 and var[1] == 0
+
+
+def test_em_step_body_warns_on_bad_truncated_normal_stats_without_printing(capsys):
+    Z, r_lower, r_upper, sigma = _latent(20, 6, 3)
+    # an empty interval has no truncated normal moments
+    row = np.flatnonzero(~np.isnan(Z[:, 0]) & (np.sum(~np.isnan(Z), axis=1) >= 2))[0]
+    r_lower[row, 0], r_upper[row, 0] = 1.0, 0.0
+    Z_ord = Z[row, 0]
+    with pytest.warns(RuntimeWarning, match='Bad truncated normal stats'):
+        _em_step_body(Z, r_lower, r_upper, sigma, 1)
+    assert capsys.readouterr().out == ''
+    assert Z[row, 0] == Z_ord
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from GaussianCopulaImp.expectation_maximization import ExpectationMaximization
+
+
+def _count_e_step_rows(monkeypatch):
+    """
+    Records the number of rows of each E-step of ExpectationMaximization
+    """
+    counts = []
+    e_step_body = ExpectationMaximization._e_step_body
+    def counted(self, Z, *args, **kwargs):
+        counts.append(len(Z))
+        return e_step_body(self, Z, *args, **kwargs)
+    monkeypatch.setattr(ExpectationMaximization, '_e_step_body', counted)
+    return counts
+
+
+def test_transform_imputes_new_rows_without_updating_the_model(mixed_data):
+    X, X_mask = mixed_data(n=1000)
+    model = ExpectationMaximization().fit(X_mask[:800])
+    sigma = model.sigma.copy()
+    X_imp = model.transform(X_mask[800:])
+    np.testing.assert_array_equal(model.sigma, sigma)
+    observed = ~np.isnan(X_mask[800:])
+    np.testing.assert_array_equal(X_imp[observed], X[800:][observed])
+    assert not np.isnan(X_imp).any()
+    np.testing.assert_array_equal(model.transform(X_mask[800:]), X_imp)
+    # the correlated columns predict the missing entries better than the column means
+    error = np.abs(X_imp - X[800:])[~observed].mean()
+    mean_error = np.abs(np.nanmean(X_mask[:800], axis=0) - X[800:])[~observed].mean()
+    assert error < 0.9 * mean_error
+
+
+def test_chunked_fit_matches_in_memory_fit(mixed_data, tmp_path):
+    _, X_mask = mixed_data()
+    path = tmp_path / 'X_mask.npy'
+    np.save(path, X_mask)
+    expected = ExpectationMaximization().impute_missing(X_mask)
+    small = ExpectationMaximization().impute_missing_chunked(str(path), out=str(tmp_path / 'X_imp.npy'), chunk_size=64)
+    large = ExpectationMaximization().impute_missing_chunked(X_mask, chunk_size=1000)
+    # the correlation follows the same iterations, while the imputation runs one more E-step on the final correlation
+    np.testing.assert_allclose(small['copula_corr'], expected['copula_corr'], atol=1e-12)
+    np.testing.assert_allclose(small['imputed_data'], large['imputed_data'], atol=1e-12)
+    np.testing.assert_allclose(np.load(tmp_path / 'X_imp.npy'), large['imputed_data'], atol=1e-12)
+    assert not np.isnan(large['imputed_data']).any()
+
+
+def test_float32_matches_float64(mixed_data):
+    _, X_mask = mixed_data()
+    out64 = ExpectationMaximization().impute_missing(X_mask)
+    model = ExpectationMaximization(dtype=np.float32, sigma_dtype=np.float32)
+    out32 = model.impute_missing(X_mask)
+    assert model.sigma.dtype == np.float32
+    np.testing.assert_allclose(out32['copula_corr'], out64['copula_corr'], atol=1e-4)
+    np.testing.assert_allclose(out32['imputed_data'], out64['imputed_data'], atol=1e-3)
+
+
+def test_collapse_duplicates_imputes_duplicates_alike(mixed_data):
+    _, X_mask = mixed_data(n=150)
+    X_repeated = np.repeat(X_mask, 4, axis=0)
+    expected = ExpectationMaximization().impute_missing(X_repeated)
+    out = ExpectationMaximization().impute_missing(X_repeated, collapse_duplicates=True)
+    for copy in range(1, 4):
+        np.testing.assert_array_equal(out['imputed_data'][copy::4], out['imputed_data'][::4])
+    np.testing.assert_allclose(out['copula_corr'], expected['copula_corr'], atol=0.02)
+
+
+def test_target_columns_impute_only_targets(mixed_data):
+    X, X_mask = mixed_data()
+    model = ExpectationMaximization().fit(X_mask[:400])
+    expected = model.transform(X_mask[400:])
+    out = model.transform(X_mask[400:], target_columns=[1, 4])
+    targets = np.isin(np.arange(X.shape[1]), [1, 4])
+    np.testing.assert_allclose(out[:, targets], expected[:, targets], atol=1e-12)
+    np.testing.assert_array_equal(np.isnan(out[:, ~targets]), np.isnan(X_mask[400:, ~targets]))
+
+
+def test_active_set_freezes_converged_rows(mixed_data, monkeypatch):
+    _, X_mask = mixed_data(n=2000, p=8, k=3)
+    counts = _count_e_step_rows(monkeypatch)
+    expected = ExpectationMaximization().impute_missing(X_mask, threshold=1e-4, max_iter=30)
+    rows_default = sum(counts)
+    counts.clear()
+    out = ExpectationMaximization().impute_missing(X_mask, threshold=1e-4, max_iter=30, active_tol=1e-2)
+    # most rows are frozen after a few iterations, and their cached contributions are reused
+    assert sum(counts) < 0.7 * rows_default
+    np.testing.assert_allclose(out['copula_corr'], expected['copula_corr'], atol=5e-3)
+
+
+def _original_sigma(model):
+    order = model.back_to_original_order()
+    return model.sigma[np.ix_(order, order)]
+
+
+def test_add_columns_matches_a_refit(mixed_data):
+    X, X_mask = mixed_data(n=2000, p=6, k=2)
+    refit = ExpectationMaximization().fit(X_mask)
+    model = ExpectationMaximization().fit(X_mask[:, :4])
+    model.add_columns(X_mask[:, 4:])
+    assert model.sigma.shape == (6, 6)
+    np.testing.assert_allclose(_original_sigma(model), _original_sigma(refit), atol=0.05)
+    missing = np.isnan(X_mask[:, 4:])
+    error = np.abs(model.transform(X_mask)[:, 4:] - X[:, 4:])[missing].mean()
+    expected_error = np.abs(refit.transform(X_mask)[:, 4:] - X[:, 4:])[missing].mean()
+    assert error < 1.1 * expected_error
+    np.testing.assert_array_equal(model.transform_function.X, X_mask)
+
+
+def test_add_columns_needs_the_data_of_a_chunked_fit(mixed_data):
+    _, X_mask = mixed_data()
+    model = ExpectationMaximization()
+    model.impute_missing_chunked(X_mask[:, :4], chunk_size=100)
+    with pytest.raises(ValueError):
+        model.add_columns(X_mask[:, 4:])
+    model.add_columns(X_mask[:, 4:], X=X_mask[:, :4])
+    assert model.transform(X_mask).shape == X_mask.shape
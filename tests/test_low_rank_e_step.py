@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from GaussianCopulaImp.embody import _truncnorm_mean_var, _low_rank_e_step
+
+
+def _low_rank_latent(n=300, p=8, k=3, rank=2, seed=0):
+    rng = np.random.default_rng(seed)
+    W = rng.normal(size=(p, rank)) / np.sqrt(rank + 1)
+    Z = rng.normal(size=(n, rank)) @ W.T + 0.5 * rng.normal(size=(n, p))
+    r_lower = np.floor(Z[:, :k]) - 0.5
+    r_upper = r_lower + 1
+    Z[rng.random(Z.shape) < 0.25] = np.nan
+    missing = np.isnan(Z[:, :k])
+    r_lower[missing] = np.nan
+    r_upper[missing] = np.nan
+    # start the latent ordinals at the middle of their intervals
+    Z[:, :k] = (r_lower + r_upper) / 2
+    U, d, _ = np.linalg.svd(W, full_matrices=False)
+    return Z, r_lower, r_upper, U, d, 0.25
+
+
+def _e_step_rows(Z, r_lower, r_upper, U, d, sigma):
+    """
+    The E-step one row at a time, with its own solve and determinant
+    """
+    n, p = Z.shape
+    rank, num_ord = U.shape[1], r_lower.shape[1]
+    F = np.zeros((p, rank, rank))
+    R = np.zeros((p, rank))
+    negloglik = 0
+    for i in range(n):
+        obs = np.flatnonzero(~np.isnan(Z[i]))
+        ord_obs = obs[obs < num_ord]
+        z_obs, U_obs = Z[i, obs], U[obs]
+        UU_obs = U_obs.T @ U_obs
+        AU = np.linalg.solve(UU_obs + sigma * np.diag(1.0/np.square(d)), U_obs.T)
+        A = np.linalg.inv(UU_obs + sigma * np.diag(1.0/np.square(d)))
+        c = np.zeros(len(obs))
+        if len(obs) >= 2 and len(ord_obs) >= 1:
+            mu = (z_obs - U_obs @ (AU @ z_obs))/sigma
+            sigma_ij = sigma/(1 - np.sum((U[ord_obs] @ A) * U[ord_obs], axis=1))
+            mu_ij = Z[i, ord_obs] - mu[:len(ord_obs)] * sigma_ij
+            std_ij = np.sqrt(sigma_ij)
+            mean, var = _truncnorm_mean_var((r_lower[i, ord_obs] - mu_ij)/std_ij, (r_upper[i, ord_obs] - mu_ij)/std_ij, mu_ij, std_ij)
+            c[:len(ord_obs)] = var
+            Z[i, ord_obs] = mean
+        S = AU @ z_obs
+        SS = (AU * c) @ AU.T + np.outer(S, S)
+        F[obs] += SS + sigma * A
+        R[obs] += np.outer(Z[i, obs], S) + c[:, np.newaxis] * (U_obs @ A)
+        negloglik += p*np.log(sigma) + np.log(np.linalg.det(np.identity(rank) + np.outer(d/sigma, d) * UU_obs))
+        negloglik += np.sum(z_obs**2) - z_obs @ (U_obs @ S)
+    return F, R, negloglik
+
+
+@pytest.mark.parametrize('chunk_size', [7, 4096])
+def test_e_step_matches_rows(chunk_size):
+    Z, r_lower, r_upper, U, d, sigma = _low_rank_latent()
+    Z_rows = Z.copy()
+    F_rows, R_rows, negloglik_rows = _e_step_rows(Z_rows, r_lower, r_upper, U, d, sigma)
+    F, R, C, z_sq, negloglik = _low_rank_e_step(Z, r_lower, r_upper, U, d, sigma, chunk_size=chunk_size)
+    np.testing.assert_allclose(Z, Z_rows, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(F, F_rows, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(R, R_rows, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(z_sq, np.nansum(Z_rows**2), rtol=1e-10)
+    np.testing.assert_allclose(negloglik, negloglik_rows, rtol=1e-10)
+    # only the observed ordinals have a conditional variance
+    assert C.nnz <= np.sum(~np.isnan(Z[:, :r_lower.shape[1]]))
+
+
+def test_repeated_ordinal_updates_match_repeated_e_steps():
+    Z, r_lower, r_upper, U, d, sigma = _low_rank_latent()
+    Z_once = Z.copy()
+    for _ in range(3):
+        expected = _low_rank_e_step(Z_once, r_lower, r_upper, U, d, sigma, chunk_size=64)
+    Z_repeated = Z.copy()
+    F, R, C, z_sq, negloglik = _low_rank_e_step(Z_repeated, r_lower, r_upper, U, d, sigma, chunk_size=64, num_ord_updates=3)
+    np.testing.assert_allclose(Z_repeated, Z_once, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(F, expected[0], rtol=1e-10)
+    np.testing.assert_allclose(R, expected[1], rtol=1e-10)
+    np.testing.assert_allclose(C.toarray(), expected[2].toarray(), rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(z_sq, expected[3], rtol=1e-10)
+    np.testing.assert_allclose(negloglik, expected[4], rtol=1e-10)
+
+def test_non_finite_ordinal_moments_warn_without_printing(capsys):
+    Z, r_lower, r_upper, U, d, sigma = _low_rank_latent(n=20)
+    # an empty interval has no truncated normal moments
+    row = np.flatnonzero(~np.isnan(Z[:, 0]) & (np.sum(~np.isnan(Z), axis=1) >= 2))[0]
+    r_lower[row, 0], r_upper[row, 0] = 1.0, 0.0
+    Z_ord = Z[row, 0]
+    with pytest.warns(RuntimeWarning, match='not finite'):
+        _low_rank_e_step(Z, r_lower, r_upper, U, d, sigma)
+    assert capsys.readouterr().out == ''
+    assert Z[row, 0] == Z_ord
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from GaussianCopulaImp.low_rank_expectation_maximization import LowRankExpectationMaximization
+
+
+def test_transform_imputes_new_rows_without_updating_the_model(mixed_data):
+    X, X_mask = mixed_data(n=500, p=12, k=4)
+    model = LowRankExpectationMaximization().fit(X_mask[:400], rank=2)
+    W, sigma = model.W.copy(), model.sigma
+    X_imp = model.transform(X_mask[400:])
+    np.testing.assert_array_equal(model.W, W)
+    assert model.sigma == sigma
+    observed = ~np.isnan(X_mask[400:])
+    np.testing.assert_array_equal(X_imp[observed], X[400:][observed])
+    assert not np.isnan(X_imp).any()
+    error = np.abs(X_imp - X[400:])[~observed].mean()
+    mean_error = np.abs(np.nanmean(X_mask[:400], axis=0) - X[400:])[~observed].mean()
+    assert error < 0.9 * mean_error
+
+
+def test_float32_matches_float64(mixed_data):
+    _, X_mask = mixed_data(n=400, p=12, k=4)
+    expected, _, _ = LowRankExpectationMaximization().impute_missing(X_mask, rank=3)
+    out, _, _ = LowRankExpectationMaximization(dtype=np.float32).impute_missing(X_mask, rank=3)
+    np.testing.assert_allclose(out, expected, atol=1e-2)
+
+
+def test_workers_match_a_single_process(mixed_data):
+    _, X_mask = mixed_data(n=400, p=12, k=4)
+    expected, _, _ = LowRankExpectationMaximization().impute_missing(X_mask, rank=3)
+    model = LowRankExpectationMaximization()
+    try:
+        out, _, _ = model.impute_missing(X_mask, rank=3, max_workers=2)
+    finally:
+        model.close()
+    np.testing.assert_allclose(out, expected, atol=1e-10)
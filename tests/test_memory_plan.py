@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import tracemalloc
+from GaussianCopulaImp.expectation_maximization import ExpectationMaximization
+from GaussianCopulaImp.low_rank_expectation_maximization import LowRankExpectationMaximization
+from GaussianCopulaImp.memory_plan import _parse_bytes, trace_memory
+
+
+def _assert_within_plan(plan):
+    assert plan.observed
+    for name, peak in plan.observed.items():
+        assert peak <= sum(plan.planned[name]), f'{name}: observed {peak} above planned {plan.planned[name]}\n{plan}'
+
+
+def test_parse_bytes():
+    assert _parse_bytes('2GB') == 2 * 2**30
+    assert _parse_bytes(' 1.5 kb') == 1536
+    assert _parse_bytes(1000) == 1000
+    with pytest.raises(ValueError):
+        _parse_bytes('a lot')
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('shape', [(200, 3, 1), (2000, 20, 10), (5000, 4, 4), (20000, 2, 0)])
+def test_em_plan_bounds_traced_peaks(mixed_data, shape, dtype):
+    n, p, k = shape
+    _, X_mask = mixed_data(n, p, k, missing=0.2)
+    model = ExpectationMaximization(dtype=dtype)
+    with trace_memory():
+        model.impute_missing(X_mask, max_iter=3, memory_limit='200MB')
+    _assert_within_plan(model.memory_plan)
+
+
+def test_em_plan_chunks_rows_to_fit(mixed_data):
+    _, X_mask = mixed_data(20000, 10, 3, missing=0.2)
+    model = ExpectationMaximization()
+    with trace_memory():
+        model.impute_missing(X_mask, max_iter=3, memory_limit='15MB')
+    assert model.memory_plan.chunk_size < X_mask.shape[0]
+    _assert_within_plan(model.memory_plan)
+
+
+def test_online_plan_bounds_traced_peaks(mixed_data):
+    _, X_mask = mixed_data(2000, 5, 2, missing=0.2)
+    cont_indices = np.arange(5) >= 2
+    model = ExpectationMaximization(var_types={'cont': cont_indices, 'ord': ~cont_indices})
+    with trace_memory():
+        model.impute_missing_online(X_mask, batch_size=100, window_size=200, memory_limit='200MB')
+    _assert_within_plan(model.memory_plan)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('shape', [(100, 10, 5, 2), (2000, 50, 20, 5)])
+def test_low_rank_plan_bounds_traced_peaks(mixed_data, shape, dtype):
+    n, p, k, rank = shape
+    _, X_mask = mixed_data(n, p, k, missing=0.2)
+    model = LowRankExpectationMaximization(dtype=dtype)
+    with trace_memory():
+        model.impute_missing(X_mask, rank=rank, max_iter=3, memory_limit='300MB')
+    _assert_within_plan(model.memory_plan)
+
+
+def test_plan_is_not_traced_by_default(mixed_data):
+    _, X_mask = mixed_data(200, 3, 1, missing=0.2)
+    model = ExpectationMaximization()
+    model.impute_missing(X_mask, max_iter=3, memory_limit='200MB')
+    assert model.memory_plan.observed == {}
+    assert not tracemalloc.is_tracing()
+
+
+def test_plan_too_large_raises_before_fitting(mixed_data):
+    _, X_mask = mixed_data(2000, 20, 10, missing=0.2)
+    model = ExpectationMaximization()
+    with pytest.raises(MemoryError):
+        model.impute_missing(X_mask, memory_limit='1MB')
+    assert model.sigma is None
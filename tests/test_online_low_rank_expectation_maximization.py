@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from GaussianCopulaImp.low_rank_expectation_maximization import LowRankExpectationMaximization
+from GaussianCopulaImp.online_low_rank_expectation_maximization import OnlineLowRankExpectationMaximization
+
+
+def test_online_fit_approaches_the_offline_fit(mixed_data):
+    X, X_mask = mixed_data(n=2000, p=10, k=3)
+    cont_indices = np.arange(10) >= 3
+    # the windows of the online marginals are initialized from the global random state
+    np.random.seed(0)
+    model = OnlineLowRankExpectationMaximization(cont_indices, ~cont_indices, rank=2, window_size=500)
+    X_imp = model.fit_one_pass(X_mask, BATCH_SIZE=100, num_ord_updates=2)
+    observed = ~np.isnan(X_mask)
+    np.testing.assert_array_equal(X_imp[observed], X[observed])
+    assert not np.isnan(X_imp).any()
+    offline = LowRankExpectationMaximization(var_types={'cont': cont_indices, 'ord': ~cont_indices}).fit(X_mask, rank=2)
+    W = offline.W[offline.back_to_original_order()]
+    np.testing.assert_allclose(model.get_sigma(), W @ W.T + offline.sigma * np.identity(10), atol=0.1)
+
+
+def test_sigma_init_needs_w_init():
+    cont_indices = np.arange(4) >= 1
+    with pytest.raises(ValueError):
+        OnlineLowRankExpectationMaximization(cont_indices, ~cont_indices, rank=2, sigma_init=0.5)
+    W_init = np.full((4, 2), 0.5)
+    model = OnlineLowRankExpectationMaximization(cont_indices, ~cont_indices, rank=2, W_init=W_init, sigma_init=0.5)
+    assert model.sigma == 0.5
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from GaussianCopulaImp.expectation_maximization import ExpectationMaximization
+from GaussianCopulaImp.online_expectation_maximization import OnlineExpectationMaximization
+
+
+def test_online_em_publishes_snapshots(mixed_data):
+    _, X_mask = mixed_data(n=300, p=5, missing=0.2)
+    cont_indices = np.array([False, False, True, True, True])
+    model = OnlineExpectationMaximization(cont_indices, ~cont_indices, window_size=100)
+    assert model.snapshot is None
+    model.partial_fit_and_predict(X_mask[:100], max_workers=1)
+    assert model.snapshot.version == 1
+    np.testing.assert_array_equal(model.snapshot.sigma, model.sigma)
+    np.testing.assert_allclose(model.snapshot.precision @ model.sigma, np.identity(5), atol=1e-8)
+
+
+@pytest.mark.parametrize('online', [True, False])
+def test_held_snapshot_is_unchanged_by_later_batches(mixed_data, online):
+    _, X_mask = mixed_data(n=300, p=5, missing=0.2)
+    cont_indices = np.array([False, False, True, True, True])
+    if online:
+        model = OnlineExpectationMaximization(cont_indices, ~cont_indices, window_size=100)
+    else:
+        model = ExpectationMaximization(var_types={'cont': cont_indices, 'ord': ~cont_indices})
+        model.impute_missing_online(X_mask[:100], batch_size=50, window_size=100)
+    model.partial_fit_and_predict(X_mask[100:200], max_workers=1)
+    snapshot = model.snapshot
+    sigma = snapshot.sigma.copy()
+    X_imp = snapshot.transform(X_mask[200:])
+    model.partial_fit_and_predict(X_mask[200:], max_workers=1)
+    assert model.snapshot is not snapshot
+    assert model.snapshot.version == snapshot.version + 1
+    assert not np.array_equal(model.sigma, sigma)
+    np.testing.assert_array_equal(snapshot.sigma, sigma)
+    np.testing.assert_array_equal(snapshot.transform(X_mask[200:]), X_imp)
+    with pytest.raises(ValueError):
+        snapshot.sigma[0, 0] = 0
+    with pytest.raises(AttributeError):
+        snapshot.sigma = None
+
+
+def test_snapshot_transform_matches_model_transform(mixed_data):
+    _, X_mask = mixed_data(n=300, p=5, missing=0.2)
+    cont_indices = np.array([False, False, True, True, True])
+    model = ExpectationMaximization(var_types={'cont': cont_indices, 'ord': ~cont_indices})
+    model.impute_missing_online(X_mask[:200], batch_size=50, window_size=100)
+    expected = model.transform(X_mask[200:], target_columns=[1, 3])
+    np.testing.assert_allclose(model.snapshot.transform(X_mask[200:], target_columns=[1, 3]), expected, equal_nan=True)
+    order = model.back_to_original_order()
+    np.testing.assert_array_equal(model.snapshot.get_sigma(), model.sigma[np.ix_(order, order)])
@@ -0,0 +1,20 @@
+import numpy as np
+from GaussianCopulaImp.transform_function import _ecdf_sorted, _quantile_sorted, _sorted_columns_from_chunks
+
+
+def test_sorted_marginals_match_their_definitions():
+    rng = np.random.default_rng(0)
+    data = np.sort(np.round(rng.normal(size=300), 1))
+    x = np.concatenate((rng.normal(size=100), data[:20], [-np.inf, np.inf]))
+    np.testing.assert_array_equal(_ecdf_sorted(data, x), (data[np.newaxis, :] <= x[:, np.newaxis]).mean(axis=1))
+    q = np.concatenate((rng.random(100), [0, 1]))
+    np.testing.assert_allclose(_quantile_sorted(data, q), np.quantile(data, q), rtol=1e-12, atol=1e-12)
+
+
+def test_sorted_columns_from_chunks_are_sorted_out_of_core(mixed_data, tmp_path):
+    _, X_mask = mixed_data()
+    sorted_columns, n = _sorted_columns_from_chunks(lambda: (X_mask[start:start+64] for start in range(0, len(X_mask), 64)), tmp_path)
+    assert n == len(X_mask)
+    for sorted_col, x_col in zip(sorted_columns, X_mask.T):
+        assert isinstance(sorted_col, np.memmap)
+        np.testing.assert_array_equal(sorted_col, np.sort(x_col[~np.isnan(x_col)]))